@@ -0,0 +1,431 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from pothole_detection import (DEFAULT_MODEL_PATH, DETECTION_DTYPE, ImageTransform, ONNXWrapper, box_centers,
+                               cluster_potholes, decode_image, determine_road_priority, encode_image,
+                               estimate_pothole_depths, find_images, load_model, render_annotated_image,
+                               score_detections)
+from pothole_serialization import dumps, loads, orjson
+from similarity_index import IVFIndex, normalize_rows
+
+
+# --- Reference Implementations ---
+
+def legacy_cluster_potholes(positions, proximity_threshold):
+    """
+    The original all-pairs BFS from determine_road_priority, kept as the
+    correctness and speed reference for cluster_potholes.
+    """
+    potholes_list = [{'position': tuple(p)} for p in positions]
+    clusters, processed = [], set()
+    for i, p1 in enumerate(potholes_list):
+        if i in processed: continue
+        cluster, q = [i], [i]
+        processed.add(i)
+        while q:
+            curr = q.pop(0)
+            for j, p2 in enumerate(potholes_list):
+                if j not in processed and np.linalg.norm(np.array(p1['position']) - np.array(p2['position'])) < proximity_threshold:
+                    processed.add(j)
+                    cluster.append(j)
+                    q.append(j)
+        clusters.append(cluster)
+    return clusters
+
+
+def legacy_json_dumps(obj):
+    """
+    The Flask JSON provider's former encoder: a recursive copy converting
+    datetimes and bytes, then a second pass through json.dumps.
+    """
+    def convert(o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        elif isinstance(o, bytes):
+            return base64.b64encode(o).decode('utf-8')
+        elif isinstance(o, dict):
+            return {k: convert(v) for k, v in o.items()}
+        elif isinstance(o, (list, tuple)):
+            return [convert(v) for v in o]
+        return o
+    return json.dumps(convert(obj), ensure_ascii=False)
+
+
+# --- Benchmarks ---
+
+def _time(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_clustering(sizes, proximity_threshold=150, legacy_max=2000, seed=0):
+    """
+    Times cluster_potholes on synthetic detections spread over an area that
+    grows with the detection count (constant density, like a stitched
+    orthomosaic), and checks its output against the legacy BFS where that is
+    still affordable.
+    """
+    rng = np.random.default_rng(seed)
+    print(f"{'detections':>10} {'grid (ms)':>10} {'legacy (ms)':>12} {'speedup':>8} {'identical':>9}")
+    for n in sizes:
+        side = int(np.sqrt(n) * 120)  # ~1 pothole per 120x120 px cell
+        positions = rng.integers(0, side, size=(n, 2))
+        grid_time, grid_clusters = _time(cluster_potholes, positions, proximity_threshold)
+        if n <= legacy_max:
+            legacy_time, legacy_clusters = _time(legacy_cluster_potholes, positions, proximity_threshold, repeat=1)
+            identical = legacy_clusters == grid_clusters
+            print(f"{n:>10} {grid_time * 1000:>10.2f} {legacy_time * 1000:>12.2f} "
+                  f"{legacy_time / grid_time:>7.1f}x {str(identical):>9}")
+        else:
+            print(f"{n:>10} {grid_time * 1000:>10.2f} {'-':>12} {'-':>8} {'-':>9}")
+
+
+def synthetic_complaints(count, image_bytes=4096, seed=0):
+    """Complaint dicts shaped like the dashboard's, with raw image bytes and datetimes left for the encoder."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, image_bytes, dtype=np.uint8).tobytes()
+    start = datetime.datetime(2024, 1, 1)
+    return [{
+        'id': i, 'text': f"Pothole near junction {i}, getting worse after the rain",
+        'location_lat': float(12.9 + rng.random()), 'location_lon': float(77.5 + rng.random()),
+        'issue_type': 'Pothole', 'status': 'Submitted', 'upvotes': int(rng.integers(0, 50)),
+        'remarks': '', 'username': f"user{i % 97}", 'reporter_name': f"Reporter {i % 97}",
+        'is_duplicate': bool(i % 7 == 0), 'original_report_id': i - 1 if i % 7 == 0 and i else None,
+        'user_id': i % 97, 'submitted_at': start + datetime.timedelta(minutes=int(i), microseconds=int(i) * 37),
+        'image': image,
+    } for i in range(count)]
+
+
+def synthetic_assessment(potholes, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "source": "image_from_memory", "road_priority": "High", "image_size": [4000, 3000],
+        "total_potholes": potholes, "priority_distribution": {"High": potholes},
+        "cluster_count": 0, "clusters": [],
+        "potholes": [{'id': i, 'bbox': rng.integers(0, 3000, 4).tolist(), 'priority': 'High',
+                      'depth_score': float(rng.random()), 'confidence': float(rng.random())}
+                     for i in range(potholes)],
+    }
+
+
+def benchmark_serialization(complaint_counts, pothole_counts=(10, 100, 1000), repeat=5):
+    """
+    Compares the former two-pass encoding with the single-pass serializer on
+    complaint lists (the dashboard payload) and on detection results, which
+    used to be dumped to an indented string, parsed back and dumped again.
+    """
+    print(f"encoder: {'orjson ' + orjson.__version__ if orjson is not None else 'json (stdlib fallback)'}")
+    print(f"{'payload':<22} {'MB':>7} {'legacy (ms)':>12} {'single-pass (ms)':>17} {'speedup':>8} {'identical':>9}")
+    cases = [(f"complaints x{n}", synthetic_complaints(n), legacy_json_dumps) for n in complaint_counts]
+    cases += [(f"assessment x{n}", {'result': synthetic_assessment(n)},
+               lambda obj: json.dumps({'result': json.loads(json.dumps(obj['result'], indent=2))}))
+              for n in pothole_counts]
+    for label, payload, legacy in cases:
+        legacy_time, legacy_out = _time(legacy, payload, repeat=repeat)
+        new_time, new_out = _time(dumps, payload, repeat=repeat)
+        identical = json.loads(legacy_out) == loads(new_out)
+        print(f"{label:<22} {len(new_out) / 1e6:>7.2f} {legacy_time * 1000:>12.2f} {new_time * 1000:>17.2f} "
+              f"{legacy_time / new_time:>7.1f}x {str(identical):>9}")
+
+
+def synthetic_embeddings(count, dim, topics=None, noise=0.6, seed=0):
+    """
+    Embeddings clustered around `topics` random directions, like complaints
+    that mostly describe a few recurring problems (uniform random vectors
+    have no neighbourhood structure and are a worst case for any ANN index).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(topics or max(1, count // 50), dim)).astype(np.float32)
+    return centers[rng.integers(0, len(centers), count)] + noise * rng.normal(size=(count, dim)).astype(np.float32)
+
+
+def benchmark_similarity(sizes, dims=(384, 2048), nprobes=(4, 16, 64), k=10, queries=200, seed=0):
+    """
+    Compares IVFIndex search with an exact scan (one matrix-vector product
+    and a partial sort) on synthetic embeddings: build time, median query
+    latency, and recall@k against the exact top k. Queries are perturbed
+    copies of stored vectors.
+    """
+    print(f"{'vectors':>9} {'dim':>5} {'build (s)':>10} {'exact (ms)':>11} {'nprobe':>7} {'ivf (ms)':>9} "
+          f"{'speedup':>8} {'recall@' + str(k):>9}")
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        for dim in dims:
+            vectors = synthetic_embeddings(n, dim, seed=seed)
+            start = time.perf_counter()
+            index = IVFIndex(dim)
+            for offset in range(0, n, 10000):  # incremental inserts, retrained in the background
+                index.add(range(offset, min(offset + 10000, n)), vectors[offset:offset + 10000])
+            index.wait()
+            build_time = time.perf_counter() - start
+            matrix = normalize_rows(vectors)
+            query_set = vectors[rng.choice(n, queries)] + 0.3 * rng.normal(size=(queries, dim)).astype(np.float32)
+
+            exact, exact_ms = [], []
+            for query in query_set:
+                start = time.perf_counter()
+                scores = matrix @ normalize_rows(query)[0]
+                top = np.argpartition(scores, -k)[-k:]
+                exact_ms.append((time.perf_counter() - start) * 1000)
+                exact.append(set(top.tolist()))
+            exact_median = float(np.median(exact_ms))
+
+            for nprobe in nprobes:
+                ivf_ms, recall = [], []
+                for query, truth in zip(query_set, exact):
+                    start = time.perf_counter()
+                    found = index.search(query, k, nprobe=nprobe)
+                    ivf_ms.append((time.perf_counter() - start) * 1000)
+                    recall.append(len(truth & {item_id for item_id, _ in found}) / k)
+                ivf_median = float(np.median(ivf_ms))
+                print(f"{n:>9} {dim:>5} {build_time:>10.2f} {exact_median:>11.3f} {nprobe:>7} {ivf_median:>9.3f} "
+                      f"{exact_median / ivf_median:>7.1f}x {np.mean(recall):>9.3f}")
+
+
+# --- Stage Benchmarks ---
+
+def make_tiny_model(path, imgsz=640, anchors=8400):
+    """
+    Writes a minimal YOLO-shaped ONNX model (one strided conv + reshape to
+    (batch, 5, anchors)) so the stage suite runs where the real weights are
+    not available. Its timings measure the pipeline around the model, not
+    the detector itself.
+    """
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    stride = int(round(imgsz / np.sqrt(anchors)))
+    cells = imgsz // stride
+    rng = np.random.default_rng(0)
+    weights = (rng.standard_normal((5, 3, stride, stride)) * 0.01).astype(np.float32)
+    gy, gx = np.mgrid[0:cells, 0:cells]
+    grid = np.zeros((1, 5, cells * cells), np.float32)
+    grid[0, 0] = gx.ravel() * stride + stride / 2
+    grid[0, 1] = gy.ravel() * stride + stride / 2
+    grid[0, 2:4] = stride * 1.5
+    nodes = [
+        helper.make_node('Conv', ['images', 'W'], ['conv'], kernel_shape=[stride, stride], strides=[stride, stride]),
+        helper.make_node('Reshape', ['conv', 'shape'], ['flat']),
+        helper.make_node('Add', ['flat', 'grid'], ['shifted']),
+        helper.make_node('Split', ['shifted', 'split'], ['xywh', 'logits'], axis=1),
+        helper.make_node('Sigmoid', ['logits'], ['scores']),
+        helper.make_node('Concat', ['xywh', 'scores'], ['output0'], axis=1),
+    ]
+    initializers = [numpy_helper.from_array(weights, 'W'),
+                    numpy_helper.from_array(np.array([0, 5, cells * cells], np.int64), 'shape'),
+                    numpy_helper.from_array(grid, 'grid'),
+                    numpy_helper.from_array(np.array([4, 1], np.int64), 'split')]
+    graph = helper.make_graph(
+        nodes, 'tiny_pothole_detector',
+        [helper.make_tensor_value_info('images', TensorProto.FLOAT, ['batch', 3, imgsz, imgsz])],
+        [helper.make_tensor_value_info('output0', TensorProto.FLOAT, ['batch', 5, cells * cells])], initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+
+def synthetic_road_image(width, height, seed=0):
+    """Grey asphalt-like noise with dark blotches, so depth scoring and JPEG coding see realistic content."""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(120, 18, (height // 4 + 1, width // 4 + 1, 3)).clip(0, 255).astype(np.uint8)
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+    for _ in range(12):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(width // 40 + 1, width // 10 + 2)), int(rng.integers(height // 40 + 1, height // 10 + 2)))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, (40, 40, 40), -1)
+    return image
+
+
+def synthetic_detections(width, height, count, seed=0):
+    """`count` scored detections with boxes of 2-10% of the image side, spread over the frame."""
+    rng = np.random.default_rng(seed)
+    w = rng.uniform(0.02, 0.1, count) * width
+    h = rng.uniform(0.02, 0.1, count) * height
+    x1 = rng.uniform(0, width - w)
+    y1 = rng.uniform(0, height - h)
+    detections = np.zeros(count, dtype=DETECTION_DTYPE)
+    detections['bbox'] = np.stack([x1, y1, x1 + w, y1 + h], axis=1)
+    detections['confidence'] = rng.uniform(0.3, 0.95, count)
+    return detections
+
+
+def synthetic_raw_output(count, anchors=8400, imgsz=640, seed=0):
+    """A (5, anchors) model output row with `count` candidates above 0.25 confidence."""
+    rng = np.random.default_rng(seed)
+    output = np.empty((5, anchors), dtype=np.float32)
+    output[0:2] = rng.uniform(0, imgsz, (2, anchors))
+    output[2:4] = rng.uniform(8, 80, (2, anchors))
+    output[4] = rng.uniform(0, 0.2, anchors)
+    output[4, rng.choice(anchors, size=min(count, anchors), replace=False)] = rng.uniform(0.3, 0.95, min(count, anchors))
+    return output
+
+
+def _median_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def benchmark_stages(model_path, resolutions, detection_counts, sample_images=(), repeat=10, imgsz=640):
+    """
+    Times each pipeline stage in isolation and returns {"stage@input": median ms}.
+    Image-sized stages run per resolution (synthetic images, plus any sample
+    images); detection-sized stages run per detection count.
+    """
+    results = {}
+    results['load_model@cold'] = _median_ms(lambda: load_model(model_path, cache_optimized=False), max(1, repeat // 5))
+    load_model(model_path)  # populate the optimized-graph cache
+    results['load_model@cached'] = _median_ms(lambda: load_model(model_path), max(1, repeat // 5))
+    model = load_model(model_path)
+
+    inputs = [(f"{w}x{h}", synthetic_road_image(w, h)) for w, h in resolutions]
+    for path in sample_images:
+        image = cv2.imread(path)
+        if image is not None:
+            inputs.append((f"{os.path.basename(path)}({image.shape[1]}x{image.shape[0]})", image))
+
+    batch = model.preprocessor.batch_buffer(imgsz, 1)
+    for label, image in inputs:
+        encoded = encode_image(image, 'jpeg', 90)[0]
+        h, w = image.shape[:2]
+        results[f'decode_full@{label}'] = _median_ms(lambda: decode_image(encoded), repeat)
+        results[f'decode_reduced@{label}'] = _median_ms(lambda: decode_image(encoded, min_short_side=imgsz), repeat)
+        results[f'preprocess@{label}'] = _median_ms(lambda: model.preprocessor(image, imgsz, out=batch[0]), repeat)
+        results[f'session_run@{label}'] = _median_ms(lambda: model.infer(batch), repeat)
+
+        detections = synthetic_detections(w, h, 50)
+        results[f'depth@{label}'] = _median_ms(lambda: estimate_pothole_depths(image, detections['bbox']), repeat)
+        score_detections(image, detections)
+        assessment = {
+            'road_priority': 'High', 'image_size': [w, h],
+            'clusters': [c for c in cluster_potholes(box_centers(detections['bbox']), 150) if len(c) > 1],
+            'potholes': [{'id': i, 'bbox': b, 'priority': p, 'confidence': c} for i, (b, p, c) in enumerate(zip(
+                detections['bbox'].tolist(), ('Low', 'Medium', 'High') * len(detections), detections['confidence'].tolist()))],
+        }
+        results[f'annotate@{label}'] = _median_ms(lambda: render_annotated_image(image, assessment), repeat)
+        annotated = render_annotated_image(image, assessment)
+        results[f'encode_jpeg@{label}'] = _median_ms(lambda: encode_image(annotated, 'jpeg', 95), repeat)
+
+    transform = ImageTransform(1.0, 1.0, 0, 0, imgsz, imgsz)
+    for count in detection_counts:
+        raw = synthetic_raw_output(count, imgsz=imgsz)
+        results[f'postprocess_nms@n={count}'] = _median_ms(lambda: ONNXWrapper.postprocess(raw, transform), repeat)
+        image = inputs[0][1] if inputs else synthetic_road_image(1920, 1080)
+        detections = synthetic_detections(image.shape[1], image.shape[0], count)
+        score_detections(image, detections)
+        results[f'road_priority@n={count}'] = _median_ms(
+            lambda: determine_road_priority(detections, 150, image.shape[:2]), repeat)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_delta_ms=0.05):
+    """
+    Returns the stages slower than baseline by more than `tolerance` (as a
+    fraction) and `min_delta_ms` (so sub-millisecond noise does not fail CI).
+    """
+    regressions = []
+    for stage, ms in results.items():
+        base = baseline.get(stage)
+        if base is not None and ms > base * (1 + tolerance) and ms - base > min_delta_ms:
+            regressions.append((stage, base, ms))
+    return regressions
+
+
+def print_stage_results(results, baseline=None):
+    print(f"{'stage':<48} {'median ms':>10} {'baseline':>10} {'change':>8}")
+    for stage, ms in results.items():
+        base = (baseline or {}).get(stage)
+        if base:
+            print(f"{stage:<48} {ms:>10.3f} {base:>10.3f} {(ms / base - 1) * 100:>+7.1f}%")
+        else:
+            print(f"{stage:<48} {ms:>10.3f} {'-':>10} {'-':>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the pothole detection pipeline.")
+    parser.add_argument("--suite", choices=['stages', 'clustering', 'serialization', 'similarity', 'all'], default='all', help="Which benchmarks to run.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10, 50, 100, 500, 1000, 2000, 5000, 10000, 50000],
+                        help="Detection counts to benchmark clustering at.")
+    parser.add_argument("--proximity", type=float, default=150, help="Proximity threshold in pixels.")
+    parser.add_argument("--legacy-max", type=int, default=2000,
+                        help="Largest detection count to also run the O(n^2) legacy clustering on.")
+    parser.add_argument("--complaints", type=int, nargs='+', default=[100, 1000, 10000],
+                        help="Complaint list lengths for the serialization suite.")
+    parser.add_argument("--vectors", type=int, nargs='+', default=[10000, 100000],
+                        help="Index sizes for the similarity suite.")
+    parser.add_argument("--dims", type=int, nargs='+', default=[384, 2048],
+                        help="Embedding sizes for the similarity suite (text and image features).")
+    parser.add_argument("--nprobe", type=int, nargs='+', default=[4, 16, 64],
+                        help="Inverted lists scanned per query in the similarity suite.")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL_PATH,
+                        help="ONNX model for the stage suite; a tiny generated model is used if it does not exist.")
+    parser.add_argument("--resolutions", nargs='+', default=['640x480', '1920x1080', '4000x3000'],
+                        help="Synthetic image sizes (WxH) for image-sized stages.")
+    parser.add_argument("--detections", type=int, nargs='+', default=[10, 100, 1000],
+                        help="Detection counts for NMS and road-priority stages.")
+    parser.add_argument("--images", type=str, help="Optional directory of sample images to add to the stage suite.")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs per stage (median is reported).")
+    parser.add_argument("--baseline", type=str, help="Baseline JSON to compare the stage suite against.")
+    parser.add_argument("--save-baseline", type=str, help="Write stage results to this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown vs. baseline before a stage counts as regressed (0.25 = 25%%).")
+
+    args = parser.parse_args()
+
+    if args.suite in ('clustering', 'all'):
+        print("--- Clustering (determine_road_priority) ---")
+        benchmark_clustering(args.sizes, args.proximity, args.legacy_max)
+
+    if args.suite in ('serialization', 'all'):
+        print("\n--- Serialization (JSON responses) ---")
+        benchmark_serialization(args.complaints)
+
+    if args.suite in ('similarity', 'all'):
+        print("\n--- Similarity search (IVF index vs. exact scan) ---")
+        benchmark_similarity(args.vectors, args.dims, args.nprobe)
+
+    if args.suite in ('stages', 'all'):
+        model_path = args.model
+        if not os.path.exists(model_path):
+            model_path = make_tiny_model(os.path.join(tempfile.mkdtemp(), 'tiny_pothole_detector.onnx'))
+            print(f"{args.model} not found, using generated model {model_path}")
+        resolutions = [tuple(int(v) for v in r.lower().split('x')) for r in args.resolutions]
+        sample_images = find_images(args.images) if args.images else []
+
+        print("\n--- Pipeline stages ---")
+        results = benchmark_stages(model_path, resolutions, args.detections, sample_images, repeat=args.repeat)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['stages']
+        print_stage_results(results, baseline)
+
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as f:
+                json.dump({'model': os.path.basename(model_path), 'repeat': args.repeat,
+                           'stages': {k: round(v, 4) for k, v in results.items()}}, f, indent=2)
+            print(f"Baseline written to {args.save_baseline}")
+
+        if baseline is not None:
+            regressions = compare_to_baseline(results, baseline, args.tolerance)
+            for stage, base, ms in regressions:
+                print(f"REGRESSION {stage}: {base:.3f} ms -> {ms:.3f} ms (+{(ms / base - 1) * 100:.0f}%)")
+            if regressions:
+                sys.exit(1)
+            print(f"No stage regressed more than {args.tolerance:.0%} against {args.baseline}")
@@ -4,12 +4,15 @@ import os
 # --- Configuration ---
 # Ensure this path points to your application's database
 APP_DB = os.path.join(os.path.dirname(__file__), 'enivaran.db')
+# Saved similarity index over complaint features (see flask_app.py)
+SIMILARITY_INDEX_DIR = os.path.join(os.path.dirname(__file__), 'similarity_index')
 
 def clear_all_data():
     """
     Connects to the database and erases all data from the complaints,
-    users, upvotes, and pothole_detections tables. It also resets the
-    auto-increment counters for these tables.
+    complaint_features, users, upvotes, pothole_detections, detected_potholes
+    and geo_tile_stats tables, zeroes pothole_stats, and resets the auto-increment counters for
+    these tables. The saved similarity index is deleted too, since complaint ids are reused afterwards.
     """
     if not os.path.exists(APP_DB):
         print(f"Error: Database file not found at '{APP_DB}'")
@@ -25,7 +28,7 @@ def clear_all_data():
             print("Temporarily disabled foreign key constraints.")
 
             # List of tables to clear
-            tables_to_clear = ['complaints', 'users', 'upvotes', 'pothole_detections']
+            tables_to_clear = ['complaints', 'complaint_features', 'users', 'upvotes', 'pothole_detections', 'detected_potholes', 'geo_tile_stats']
             
             for table in tables_to_clear:
                 # Check if table exists before trying to delete from it
@@ -39,6 +42,14 @@ def clear_all_data():
                 else:
                     print(f"Table '{table}' not found, skipping.")
 
+            # pothole_stats is a running total of detected_potholes, so it is reset rather than deleted
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pothole_stats'")
+            if cursor.fetchone():
+                cursor.execute('''UPDATE pothole_stats SET total_potholes = 0, high_priority_count = 0,
+                                  medium_priority_count = 0, low_priority_count = 0,
+                                  last_updated = CURRENT_TIMESTAMP WHERE id = 1''')
+                print("Pothole statistics have been reset.")
+
             # Re-enable foreign key constraints
             cursor.execute('PRAGMA foreign_keys = ON')
             print("Re-enabled foreign key constraints.")
@@ -47,10 +58,24 @@ def clear_all_data():
             conn.commit()
             print("\nDatabase has been successfully cleared.")
 
+        clear_similarity_index()
+
     except sqlite3.Error as e:
         print(f"\nAn error occurred: {e}")
         # The 'with' statement will automatically handle rollback on error
 
+def clear_similarity_index():
+    """Deletes the saved similarity index files, so stale vectors are not served for reused complaint ids."""
+    if not os.path.isdir(SIMILARITY_INDEX_DIR):
+        return
+    for name in os.listdir(SIMILARITY_INDEX_DIR):
+        if name.endswith(('.npz', '.npz.tmp')):
+            try:
+                os.remove(os.path.join(SIMILARITY_INDEX_DIR, name))
+                print(f"Deleted saved similarity index '{name}'.")
+            except OSError as e:
+                print(f"Could not delete saved similarity index '{name}': {e}")
+
 if __name__ == '__main__':
     # Confirmation prompt to prevent accidental execution
     confirm = input("Are you absolutely sure you want to erase all user and complaint data? This action is irreversible. (yes/no): ")
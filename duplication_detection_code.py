@@ -1,26 +1,45 @@
 import numpy as np
 import json
 import os
+import sqlite3
 from PIL import Image
 import torch
 import torchvision.models as models
 import torchvision.transforms as transforms
 from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sentence_transformers import SentenceTransformer
-import geopy.distance
+import math
 from collections import defaultdict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 import xgboost as xgb
 from sklearn.preprocessing import StandardScaler
+from similarity_index import normalize_rows
 import warnings
 warnings.filterwarnings('ignore')
 
-def decode_image_bytes(image_bytes):
+# Image feature extraction: ResNet50 mini-batch size, threads decoding/transforming images
+# and torch intra-op threads (0 = one per core).
+FEATURE_BATCH_SIZE = int(os.getenv('DUPLICATE_FEATURE_BATCH_SIZE', '32'))
+FEATURE_DECODE_WORKERS = int(os.getenv('DUPLICATE_DECODE_WORKERS', '4'))
+TORCH_THREADS = int(os.getenv('DUPLICATE_TORCH_THREADS', '0'))
+
+TEXT_MODEL_NAME = 'paraphrase-MiniLM-L6-v2'
+# Bump when feature preprocessing changes, so stored vectors are recomputed
+FEATURE_VERSION = 1
+
+# ResNet50 input is a 224 crop of the image resized to 256 on its short side, so JPEGs can be
+# decoded at a reduced DCT scale that still covers 256x256.
+DRAFT_SIZE = (256, 256)
+
+def decode_image_bytes(image_bytes, draft_size=None):
     """
     Helper to decode image bytes (from SQLite BLOB) to a numpy array (for PIL or OpenCV).
     Args:
         image_bytes: Raw image bytes (e.g., from SQLite BLOB)
+        draft_size: Optional (width, height) the image is only needed at; JPEGs are then decoded
+            at the smallest DCT scale that still covers it
     Returns:
         image_array: Decoded numpy array (RGB, as used by PIL)
     """
@@ -28,15 +47,263 @@ def decode_image_bytes(image_bytes):
     from PIL import Image
     import io
     try:
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        return image
+        image = Image.open(io.BytesIO(image_bytes))
+        if draft_size:
+            image.draft('RGB', draft_size)
+        return image.convert('RGB')
     except Exception as e:
         print(f"Error decoding image bytes: {e}")
         # Return a default white image if decoding fails
         return Image.new('RGB', (224, 224), color='white')
 
+class FeatureStore:
+    """
+    Complaint feature vectors persisted in an SQLite side table, keyed by
+    complaint id and feature kind ('image' or 'text') and tagged with the
+    fingerprint of the model that produced them, so a restart only computes
+    features for complaints that are new or were embedded by another model.
+    Vectors are stored as float16, which is far below the precision the
+    similarity thresholds need, and come back as float32.
+    """
+    TABLE = 'complaint_features'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        if not self._ready:
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {self.TABLE} (
+                                complaint_id INTEGER NOT NULL,
+                                kind TEXT NOT NULL,
+                                fingerprint TEXT NOT NULL,
+                                vector BLOB NOT NULL,
+                                PRIMARY KEY (complaint_id, kind)) WITHOUT ROWID""")
+            self._ready = True
+        return conn
+
+    def load(self, fingerprints):
+        """
+        Reads every stored vector whose fingerprint matches `fingerprints`
+        ({kind: fingerprint}; None skips a kind) in one query.
+        Returns {kind: {complaint_id: vector}}.
+        """
+        kinds = {kind: fp for kind, fp in fingerprints.items() if fp}
+        loaded = {kind: {} for kind in fingerprints}
+        if not kinds:
+            return loaded
+        try:
+            with closing(self._connect()) as conn, conn:
+                rows = conn.execute(
+                    f"SELECT kind, complaint_id, vector FROM {self.TABLE} WHERE "
+                    + ' OR '.join('(kind = ? AND fingerprint = ?)' for _ in kinds) + ' ORDER BY kind',
+                    [value for pair in kinds.items() for value in pair]).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error loading stored features: {e}")
+            return loaded
+        for kind in kinds:
+            kind_rows = [row for row in rows if row[0] == kind]
+            if not kind_rows:
+                continue
+            # One conversion for the whole kind; every row is a view into it
+            matrix = np.frombuffer(b''.join(row[2] for row in kind_rows), dtype=np.float16)
+            matrix = matrix.reshape(len(kind_rows), -1).astype(np.float32)
+            loaded[kind] = {row[1]: vector for row, vector in zip(kind_rows, matrix)}
+        return loaded
+
+    def save(self, rows):
+        """Stores (complaint_id, kind, fingerprint, vector) rows, replacing older versions."""
+        if not rows:
+            return
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {self.TABLE} (complaint_id, kind, fingerprint, vector) VALUES (?, ?, ?, ?)",
+                    [(int(cid), kind, fp, np.asarray(vector, dtype=np.float16).tobytes())
+                     for cid, kind, fp, vector in rows])
+        except sqlite3.Error as e:
+            print(f"Error saving features: {e}")
+
+    def prune(self, complaints_table='complaints'):
+        """Drops vectors of complaints that no longer exist (complaint ids can be reused after a reset)."""
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(f"DELETE FROM {self.TABLE} WHERE complaint_id NOT IN (SELECT id FROM {complaints_table})")
+        except sqlite3.Error as e:
+            print(f"Error pruning stored features: {e}")
+
+class EmbeddingMatrix:
+    """
+    Feature vectors of the stored reports kept as one contiguous float32
+    matrix of L2-normalized rows, so scoring a query against any set of
+    reports is a single matrix-vector product. Capacity doubles when full,
+    keeping appends amortized O(dim). Zero vectors stay zero and score 0
+    against everything, as with sklearn's cosine_similarity. The original
+    row norms are kept too, so `raw_rows` can give back the unnormalized vectors.
+    """
+
+    def __init__(self, capacity=256):
+        self._initial_capacity = max(1, capacity)
+        self._data = None
+        self._norms = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    @property
+    def rows(self):
+        """View of the filled rows"""
+        if self._data is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._data[:self._size]
+
+    @property
+    def raw_rows(self):
+        """The filled rows scaled back to the vectors they were added as"""
+        return self.rows * self._norms[:self._size, None] if self._data is not None else self.rows
+
+    def _reserve(self, size, dim):
+        if self._data is None:
+            self._data = np.zeros((max(self._initial_capacity, size), dim), dtype=np.float32)
+            self._norms = np.zeros(len(self._data), dtype=np.float32)
+            return
+        capacity, width = self._data.shape
+        if size <= capacity and dim <= width:
+            return
+        # Wider vectors (the TF-IDF fallback once it is fitted) widen the matrix; the
+        # older rows are zero-padded, which leaves every dot product unchanged
+        grown = np.zeros((max(size, 2 * capacity) if size > capacity else capacity, max(dim, width)),
+                         dtype=np.float32)
+        grown[:self._size, :width] = self._data[:self._size]
+        self._data = grown
+        if len(grown) > len(self._norms):
+            self._norms = np.concatenate([self._norms, np.zeros(len(grown) - len(self._norms), dtype=np.float32)])
+
+    def extend(self, vectors):
+        """Appends one row per vector; returns the index of the first"""
+        raw = np.array(vectors, dtype=np.float32, ndmin=2)
+        vectors = normalize_rows(raw)
+        start = self._size
+        if not len(vectors):
+            return start
+        self._reserve(start + len(vectors), vectors.shape[1])
+        self._data[start:start + len(vectors), :vectors.shape[1]] = vectors
+        self._norms[start:start + len(vectors)] = np.linalg.norm(np.nan_to_num(raw), axis=1)
+        self._size += len(vectors)
+        return start
+
+    def append(self, vector):
+        """Appends one row; returns its index"""
+        return self.extend([np.ravel(vector)])
+
+    def scores(self, query, indices=None):
+        """Cosine similarity of `query` to every stored row, or to the rows at `indices`"""
+        rows = self.rows if indices is None else self.rows[indices]
+        query = normalize_rows(np.ravel(query))[0]
+        width = rows.shape[1]
+        if len(query) != width:
+            # Dimensions past the matrix width are zero in every row
+            query = query[:width] if len(query) > width else np.pad(query, (0, width - len(query)))
+        return rows @ query
+
+EARTH_RADIUS_KM = 6371.0088  # Mean Earth radius
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def haversine_km(lat, lon, lats, lons):
+    """Great-circle distances in km from (lat, lon) to each point of (lats, lons), all in degrees"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class SpatialIndex:
+    """
+    Report locations bucketed by issue type into grid cells `cell_km` of
+    latitude high (longitude cells span the same number of degrees, so a
+    query away from the equator just visits a few more of them). A radius
+    query only measures the reports in cells overlapping the radius, with
+    vectorized haversine, so its cost follows the local density of reports
+    rather than the size of the whole history.
+    """
+
+    def __init__(self, cell_km):
+        # Shrunk slightly so a whole number of longitude cells spans the globe and they tile exactly
+        self._lon_cells = math.ceil(360 / (cell_km / KM_PER_DEGREE))
+        self.cell_deg = 360 / self._lon_cells
+        self._cells = defaultdict(list)  # (issue_type, lat cell, lon cell) -> report indices
+        self._by_type = defaultdict(list)  # issue_type -> report indices
+        self._coords = np.full((256, 2), np.nan)  # report index -> (lat, lon) in degrees
+
+    def _cell(self, lat, lon):
+        # Longitude cells wrap around the antimeridian
+        return math.floor(lat / self.cell_deg), math.floor((lon + 180) / self.cell_deg) % self._lon_cells
+
+    def add(self, index, issue_type, location):
+        """Indexes report `index`; reports without a usable location are left out"""
+        try:
+            lat, lon = float(location[0]), float(location[1])
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError(f"coordinates out of range: {location}")
+        except (TypeError, ValueError, IndexError) as e:
+            print(f"Error indexing location of report {index}: {e}")
+            return
+        if index >= len(self._coords):
+            grown = np.full((max(index + 1, 2 * len(self._coords)), 2), np.nan)
+            grown[:len(self._coords)] = self._coords
+            self._coords = grown
+        self._coords[index] = (lat, lon)
+        self._cells[(issue_type,) + self._cell(lat, lon)].append(index)
+        self._by_type[issue_type].append(index)
+
+    def coords(self, indices):
+        """(lat, lon) rows of the reports at `indices` (NaN for unindexed reports)"""
+        indices = np.asarray(indices, dtype=np.intp)
+        coords = np.full((len(indices), 2), np.nan)
+        known = indices < len(self._coords)
+        coords[known] = self._coords[indices[known]]
+        return coords
+
+    def query(self, issue_type, location, radius_km):
+        """
+        Finds the reports of `issue_type` within `radius_km` of `location`.
+        Returns (indices, distances in km), in index order.
+        """
+        lat, lon = float(location[0]), float(location[1])
+        members = self._by_type.get(issue_type)
+        if not members:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        reach_lat = radius_km / KM_PER_DEGREE
+        # A degree of longitude shrinks with cos(latitude); size the span for the poleward edge
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + reach_lat)))
+        reach_lon = min(180.0, reach_lat / cos_lat) if cos_lat > 1e-9 else 180.0
+        lat_cells = range(math.floor((lat - reach_lat) / self.cell_deg),
+                          math.floor((lat + reach_lat) / self.cell_deg) + 1)
+        lon_cells = {b % self._lon_cells for b in range(math.floor((lon + 180 - reach_lon) / self.cell_deg),
+                                                          math.floor((lon + 180 + reach_lon) / self.cell_deg) + 1)}
+        if len(lat_cells) * len(lon_cells) >= len(members):
+            # Radius large for the cell size: measuring every report of this type is cheaper
+            candidates = np.array(members, dtype=np.intp)
+        else:
+            candidates = np.array([i for a in lat_cells for b in lon_cells
+                                   for i in self._cells.get((issue_type, a, b), ())], dtype=np.intp)
+            candidates.sort()
+        if not len(candidates):
+            return candidates, np.zeros(0)
+        coords = self._coords[candidates]
+        distances = haversine_km(lat, lon, coords[:, 0], coords[:, 1])
+        within = distances <= radius_km
+        return candidates[within], distances[within]
+
 class CivicIssueDuplicateDetector:
-    def __init__(self, n_clusters=None, location_threshold=0.1, text_similarity_threshold=0.8):
+    def __init__(self, n_clusters=None, location_threshold=0.1, text_similarity_threshold=0.8,
+                 feature_batch_size=FEATURE_BATCH_SIZE, decode_workers=FEATURE_DECODE_WORKERS,
+                 torch_threads=TORCH_THREADS, feature_store=None, similarity_index=None):
         """
         Initialize the duplicate detection model using unsupervised clustering
 
@@ -44,13 +311,34 @@ class CivicIssueDuplicateDetector:
             n_clusters: Number of clusters for K-means. Should be set to the number of unique complaints with the same location area, problem type (e.g., pothole, manhole cover removed, etc.), and time of reporting. (default: None - will be determined dynamically)
             location_threshold: Max distance in km to consider location similar (default: 0.1 km = 100m)
             text_similarity_threshold: Threshold for text similarity (default: 0.8)
+            feature_batch_size: Images per ResNet50 forward pass when extracting features in bulk
+            decode_workers: Threads decoding and transforming images ahead of the model
+            torch_threads: Torch intra-op threads (default: one per core)
+            feature_store: Optional FeatureStore persisting the features of reports that have an 'id'
+            similarity_index: Optional SimilarityIndex for city-wide search over the features of reports that have an 'id'
         """
+        self.feature_store = feature_store
+        self.similarity_index = similarity_index
+        self._stored_features = {'image': {}, 'text': {}}
+        self.feature_batch_size = max(1, feature_batch_size)
+        self.decode_workers = max(1, decode_workers)
+        self._decode_pool = None
+
+        # Explicit thread counts, so the backbone does not compete with the decode threads for every core
+        torch.set_num_threads(torch_threads or os.cpu_count() or 1)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # Can only be set once per process, before any inter-op work
+
         # Initialize image feature extractor (ResNet50) with error handling
         try:
             self.image_model = models.resnet50(weights='DEFAULT')
             self.image_model.eval()
             # Remove the classification layer
             self.image_model = torch.nn.Sequential(*(list(self.image_model.children())[:-1]))
+            # NHWC lets the CPU convolution kernels skip layout conversions between layers
+            self.image_model = self.image_model.to(memory_format=torch.channels_last)
             self.image_model_available = True
             print("ResNet50 model loaded successfully")
         except Exception as e:
@@ -69,7 +357,7 @@ class CivicIssueDuplicateDetector:
         
         # Text embedding model with error handling
         try:
-            self.text_model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+            self.text_model = SentenceTransformer(TEXT_MODEL_NAME)
             self.text_model_available = True
             print("SentenceTransformer model loaded successfully")
         except Exception as e:
@@ -92,9 +380,9 @@ class CivicIssueDuplicateDetector:
         self.text_similarity_threshold = text_similarity_threshold
         
         # Storage for processed data and clusters
-        self.image_features_db = []
+        self.image_features_db = EmbeddingMatrix()
         self.location_db = []
-        self.text_embeddings_db = []
+        self.text_embeddings_db = EmbeddingMatrix()
         self.text_raw_db = []  # Store raw text for TF-IDF fallback
         self.issue_types_db = []
         self.reports_db = []
@@ -105,7 +393,7 @@ class CivicIssueDuplicateDetector:
         
         # Cluster assignments
         self.image_clusters = []
-        self.location_clusters = defaultdict(list)  # Will store indices by location grid
+        self.spatial_index = SpatialIndex(location_threshold)  # Indices by issue type and location grid cell
         self.issue_type_clusters = defaultdict(list)  # Will store indices by issue type
         
         # XGBoost model and scaler
@@ -113,59 +401,163 @@ class CivicIssueDuplicateDetector:
         self.scaler = None
         self.has_enough_data_for_xgboost = False
         
-    def extract_image_features(self, image_input):
+    def feature_fingerprints(self):
         """
-        Extract image features using ResNet50 or fallback to basic features.
-        image_input can be a file path, PIL Image, or image bytes (from SQLite BLOB).
+        Identifies the models behind each feature kind. None for the fallbacks,
+        whose features are not worth persisting (TF-IDF also depends on the texts seen so far).
         """
-        try:
-            # Handle different input types
-            if isinstance(image_input, str) and os.path.exists(image_input):
-                image = Image.open(image_input).convert('RGB')
-            elif isinstance(image_input, Image.Image):
-                image = image_input
-            elif isinstance(image_input, bytes):
-                image = decode_image_bytes(image_input)
-            elif image_input is None:
-                # Return zero features if no image provided
-                return np.zeros(2048) if self.image_model_available else np.zeros(100)
+        image_available = self.image_model_available and self.image_model is not None
+        text_available = self.text_model_available and self.text_model is not None
+        return {
+            'image': f"resnet50:{models.ResNet50_Weights.DEFAULT}:v{FEATURE_VERSION}" if image_available else None,
+            'text': f"sbert:{TEXT_MODEL_NAME}:v{FEATURE_VERSION}" if text_available else None,
+        }
+
+    def load_stored_features(self):
+        """
+        Reads all stored features that match the current models in one query.
+        add_reports then uses them for reports with those ids instead of recomputing.
+        Returns the ids that have every available kind stored.
+        """
+        if self.feature_store is None:
+            return set()
+        fingerprints = self.feature_fingerprints()
+        self._stored_features = self.feature_store.load(fingerprints)
+        complete = None
+        for kind, fingerprint in fingerprints.items():
+            if fingerprint:
+                ids = set(self._stored_features[kind])
+                complete = ids if complete is None else complete & ids
+        return complete or set()
+
+    def open_similarity_index(self):
+        """Loads the saved similarity index built from the current models; add_reports then keeps it current"""
+        if self.similarity_index is not None:
+            self.similarity_index.open(self.feature_fingerprints())
+
+    def find_similar(self, kind, query, k=10, exclude=()):
+        """
+        City-wide search: the `k` indexed reports whose `kind` ('text' or
+        'image') features are most similar to `query`, which is a complaint id
+        in the index or a report dictionary as for add_report.
+        Returns (complaint_id, similarity) pairs, best first.
+        """
+        index = self.similarity_index.get(kind) if self.similarity_index is not None else None
+        if index is None:
+            return []
+        if isinstance(query, dict):
+            if kind == 'image':
+                vector = self.extract_image_features(
+                    query.get('image_bytes') or query.get('image_array') or query.get('image_path'))
             else:
-                # If it's a numpy array, convert to PIL Image
-                try:
-                    if isinstance(image_input, np.ndarray):
-                        image = Image.fromarray(image_input.astype('uint8'))
-                    else:
-                        return np.zeros(2048) if self.image_model_available else np.zeros(100)
-                except Exception:
-                    return np.zeros(2048) if self.image_model_available else np.zeros(100)
-            
+                vector = self.extract_text_features(query.get('text'))
+        else:
+            vector = index.vector(query)
+            if vector is None:
+                return []
+        return index.search(vector, k, exclude=exclude)
+
+    def _load_image(self, image_input):
+        """
+        Decodes a file path, PIL Image, image bytes (from SQLite BLOB) or array
+        into an RGB PIL Image. Returns None when there is no usable image.
+        """
+        if isinstance(image_input, str) and os.path.exists(image_input):
+            image = Image.open(image_input)
+            image.draft('RGB', DRAFT_SIZE)
+            return image.convert('RGB')
+        elif isinstance(image_input, Image.Image):
+            return image_input
+        elif isinstance(image_input, bytes):
+            return decode_image_bytes(image_input, draft_size=DRAFT_SIZE)
+        elif isinstance(image_input, np.ndarray):
+            return Image.fromarray(image_input.astype('uint8'))
+        return None
+
+    @staticmethod
+    def _basic_image_features(image):
+        """Color histogram and statistics, used when ResNet50 is unavailable"""
+        image_array = np.array(image.resize((64, 64)))
+        # Simple color histogram as features
+        hist_r = np.histogram(image_array[:,:,0], bins=10, range=(0,255))[0]
+        hist_g = np.histogram(image_array[:,:,1], bins=10, range=(0,255))[0]
+        hist_b = np.histogram(image_array[:,:,2], bins=10, range=(0,255))[0]
+        # Add some basic statistics
+        mean_rgb = np.mean(image_array, axis=(0,1))
+        std_rgb = np.std(image_array, axis=(0,1))
+        features = np.concatenate([hist_r, hist_g, hist_b, mean_rgb, std_rgb])
+        # Pad to 100 features
+        if len(features) < 100:
+            features = np.pad(features, (0, 100 - len(features)), 'constant')
+        return features[:100]
+
+    def _prepare_image(self, image_input):
+        """
+        Decodes and transforms one image on a decode thread. Returns the
+        normalized CHW tensor (basic features without ResNet50), or None for
+        a zero feature vector.
+        """
+        try:
+            image = self._load_image(image_input)
+            if image is None:
+                return None
             if self.image_model_available and self.image_model is not None:
-                # Use ResNet50 features
-                image_tensor = self.image_transform(image).unsqueeze(0)
-                with torch.no_grad():
-                    features = self.image_model(image_tensor)
-                return features.squeeze().numpy()
-            else:
-                # Fallback to basic image features (histogram)
-                image_array = np.array(image.resize((64, 64)))
-                # Simple color histogram as features
-                hist_r = np.histogram(image_array[:,:,0], bins=10, range=(0,255))[0]
-                hist_g = np.histogram(image_array[:,:,1], bins=10, range=(0,255))[0]
-                hist_b = np.histogram(image_array[:,:,2], bins=10, range=(0,255))[0]
-                # Add some basic statistics
-                mean_rgb = np.mean(image_array, axis=(0,1))
-                std_rgb = np.std(image_array, axis=(0,1))
-                features = np.concatenate([hist_r, hist_g, hist_b, mean_rgb, std_rgb])
-                # Pad to 100 features
-                if len(features) < 100:
-                    features = np.pad(features, (0, 100 - len(features)), 'constant')
-                return features[:100]
-                
+                return self.image_transform(image)
+            return self._basic_image_features(image)
         except Exception as e:
             print(f"Error extracting image features: {e}")
-            # Return appropriate zero vector based on model availability
-            return np.zeros(2048) if self.image_model_available else np.zeros(100)
-    
+            return None
+
+    def _get_decode_pool(self):
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPoolExecutor(self.decode_workers, thread_name_prefix='duplicate-decode')
+        return self._decode_pool
+
+    def extract_image_features_batch(self, image_inputs):
+        """
+        Extract image features for many images at once.
+        Images are decoded and transformed on the decode threads, one
+        mini-batch ahead of ResNet50, which runs on stacked mini-batches of
+        `feature_batch_size` under torch.inference_mode.
+        Returns an (n, 2048) float32 array ((n, 100) with the basic fallback) in
+        input order; missing or unreadable images get zero rows.
+        """
+        use_model = self.image_model_available and self.image_model is not None
+        features = np.zeros((len(image_inputs), 2048 if use_model else 100), dtype=np.float32)
+        pool = self._get_decode_pool()
+        chunks = [range(start, min(start + self.feature_batch_size, len(image_inputs)))
+                  for start in range(0, len(image_inputs), self.feature_batch_size)]
+
+        def submit(chunk):
+            return [pool.submit(self._prepare_image, image_inputs[i]) for i in chunk]
+
+        pending = submit(chunks[0]) if chunks else []
+        for k, chunk in enumerate(chunks):
+            prepared = [future.result() for future in pending]
+            # Keep the decode threads busy with the next chunk while the model runs on this one
+            pending = submit(chunks[k + 1]) if k + 1 < len(chunks) else []
+            rows = [i for i, item in zip(chunk, prepared) if item is not None]
+            if not rows:
+                continue
+            items = [item for item in prepared if item is not None]
+            try:
+                if use_model:
+                    batch = torch.stack(items).contiguous(memory_format=torch.channels_last)
+                    with torch.inference_mode():
+                        features[rows] = self.image_model(batch).flatten(1).numpy()
+                else:
+                    features[rows] = np.stack(items)
+            except Exception as e:
+                print(f"Error extracting image features: {e}")
+        return features
+
+    def extract_image_features(self, image_input):
+        """
+        Extract image features using ResNet50 or fallback to basic features.
+        image_input can be a file path, PIL Image, or image bytes (from SQLite BLOB).
+        """
+        return self.extract_image_features_batch([image_input])[0]
+
     def extract_text_features(self, text):
         """Extract text embeddings using Sentence-BERT or TF-IDF fallback"""
         if not text or not isinstance(text, str):
@@ -203,65 +595,115 @@ class CivicIssueDuplicateDetector:
         except Exception as e:
             print(f"Error extracting text features: {e}")
             return np.zeros(384)  # Default sentence-bert size
-    
-    def location_to_grid(self, location):
-        """Convert location to grid cell for clustering"""
-        try:
-            # Using a simple grid approach for location clustering
-            # Each grid cell is approximately location_threshold x location_threshold km
-            lat, lon = location
-            lat_grid = int(lat / self.location_threshold)
-            lon_grid = int(lon / self.location_threshold)
-            return (lat_grid, lon_grid)
-        except Exception as e:
-            print(f"Error converting location to grid: {e}")
-            return (0, 0)  # Default grid position
+
+    def extract_text_features_batch(self, texts):
+        """Extract text embeddings for many texts; Sentence-BERT encodes them in batches"""
+        texts = [text if text and isinstance(text, str) else "" for text in texts]
+        if self.text_model_available and self.text_model is not None:
+            try:
+                return list(self.text_model.encode(texts, batch_size=64))
+            except Exception as e:
+                print(f"Error extracting text features: {e}")
+        return [self.extract_text_features(text) for text in texts]
     
     def add_report(self, report):
         """
         Add a new report to the database.
         report: Dictionary with at least 'text', 'location', 'issue_type', and either 'image_path', 'image_bytes', or 'image_array'.
         """
+        return self.add_reports([report])[0]
+
+    def add_reports(self, reports):
+        """
+        Add many reports to the database, extracting their features in batches.
+        Each report is a dictionary as for add_report.
+        Returns the index of each added report, or None for reports that could not be added.
+        """
+        indices = [None] * len(reports)
         try:
-            # Validate required fields
-            required_fields = ['text', 'location', 'issue_type']
-            for field in required_fields:
-                if field not in report:
-                    raise ValueError(f"Missing required field: {field}")
-            
-            # Extract features
-            image_input = report.get('image_bytes') or report.get('image_array') or report.get('image_path')
-            image_features = self.extract_image_features(image_input)
-            text_embedding = self.extract_text_features(report['text'])
-            location = report['location']
-            issue_type = report['issue_type']
-
-            # Store features and report
-            index = len(self.reports_db)
-            self.image_features_db.append(image_features)
-            self.text_embeddings_db.append(text_embedding)
-            self.text_raw_db.append(report['text'])  # Store raw text for TF-IDF
-            self.location_db.append(location)
-            self.issue_types_db.append(issue_type)
-            self.reports_db.append(report)
-
-            # Add to location grid
-            location_grid = self.location_to_grid(location)
-            self.location_clusters[location_grid].append(index)
-
-            # Add to issue type clusters
-            self.issue_type_clusters[issue_type].append(index)
-
-            # Check if we have enough data to train XGBoost
-            self.check_and_train_xgboost()
-
-            # Return the added index
-            return index
-            
+            valid = []
+            for position, report in enumerate(reports):
+                # Validate required fields
+                missing = [field for field in ('text', 'location', 'issue_type') if field not in report]
+                if missing:
+                    print(f"Error adding report: Missing required field: {missing[0]}")
+                    continue
+                valid.append(position)
+            if not valid:
+                return indices
+
+            # Extract features, reusing stored ones where available
+            fingerprints = self.feature_fingerprints()
+            image_features = self._stored_or_computed(
+                'image', [reports[p] for p in valid], fingerprints['image'],
+                lambda todo: self.extract_image_features_batch(
+                    [r.get('image_bytes') or r.get('image_array') or r.get('image_path') for r in todo]))
+            # The TF-IDF fallback is fitted on the texts stored so far, so it stays one report at a time
+            text_embeddings = None
+            if self.text_model_available and self.text_model is not None:
+                text_embeddings = self._stored_or_computed(
+                    'text', [reports[p] for p in valid], fingerprints['text'],
+                    lambda todo: self.extract_text_features_batch([r['text'] for r in todo]))
+
+            if self.similarity_index is not None:
+                ids = [reports[p].get('id') for p in valid]
+                self.similarity_index.add('image', ids, image_features)
+                if text_embeddings is not None:
+                    self.similarity_index.add('text', ids, text_embeddings)
+
+            for j, position in enumerate(valid):
+                report = reports[position]
+                text_embedding = (text_embeddings[j] if text_embeddings is not None
+                                  else self.extract_text_features(report['text']))
+                location = report['location']
+                issue_type = report['issue_type']
+
+                # Store features and report
+                index = len(self.reports_db)
+                self.image_features_db.append(image_features[j])
+                self.text_embeddings_db.append(text_embedding)
+                self.text_raw_db.append(report['text'])  # Store raw text for TF-IDF
+                self.location_db.append(location)
+                self.issue_types_db.append(issue_type)
+                self.reports_db.append(report)
+
+                # Add to spatial index
+                self.spatial_index.add(index, issue_type, location)
+
+                # Add to issue type clusters
+                self.issue_type_clusters[issue_type].append(index)
+                indices[position] = index
+
+                # Check if we have enough data to train XGBoost. This happens after the report that
+                # completes it, so the model is trained on the same reports however callers batch them
+                if not self.has_enough_data_for_xgboost:
+                    self.check_and_train_xgboost()
+
+            # Return the added indices
+            return indices
+
         except Exception as e:
-            print(f"Error adding report: {e}")
-            return None
-    
+            print(f"Error adding reports: {e}")
+            return indices
+
+    def _stored_or_computed(self, kind, reports, fingerprint, compute):
+        """
+        Returns one `kind` feature vector per report: taken from the loaded
+        feature store rows when present, otherwise computed in one batch by
+        `compute(reports)` and, for reports with an id, saved to the store.
+        """
+        stored = self._stored_features.get(kind, {})
+        vectors = [stored.pop(report['id'], None) if 'id' in report else None for report in reports]
+        todo = [j for j, vector in enumerate(vectors) if vector is None]
+        if todo:
+            computed = compute([reports[j] for j in todo])
+            for j, vector in zip(todo, computed):
+                vectors[j] = vector
+            if self.feature_store is not None and fingerprint:
+                self.feature_store.save([(reports[j]['id'], kind, fingerprint, vectors[j])
+                                         for j in todo if reports[j].get('id') is not None])
+        return vectors
+
     def build_clusters(self):
         """Build clusters from all added reports"""
         try:
@@ -278,7 +720,7 @@ class CivicIssueDuplicateDetector:
                     random_state=42,
                     n_init=10
                 )
-                self.image_clusters = self.image_kmeans.fit_predict(np.array(self.image_features_db))
+                self.image_clusters = self.image_kmeans.fit_predict(self.image_features_db.raw_rows)
         except Exception as e:
             print(f"Error building clusters: {e}")
             self.image_clusters = [0] * len(self.reports_db)  # Default all to cluster 0
@@ -307,23 +749,24 @@ class CivicIssueDuplicateDetector:
             X = []
             y = []  # Pseudo-labels based on current similarity metrics
             
-            # Compare each report with every other report
+            # Compare each report with every later report of the same issue type
             for i in range(len(self.reports_db)):
-                for j in range(i+1, len(self.reports_db)):
-                    # Skip if different issue types
-                    if self.issue_types_db[i] != self.issue_types_db[j]:
-                        continue
-                        
-                    # Extract features for this pair
-                    text_sim = cosine_similarity([self.text_embeddings_db[i]], [self.text_embeddings_db[j]])[0][0]
-                    image_sim = cosine_similarity([self.image_features_db[i]], [self.image_features_db[j]])[0][0]
-                    
-                    # Calculate location similarity
-                    loc1 = self.location_db[i]
-                    loc2 = self.location_db[j]
-                    dist = geopy.distance.distance(loc1, loc2).kilometers
-                    loc_sim = 1.0 - min(1.0, dist/self.location_threshold)
-                    
+                later = [j for j in range(i+1, len(self.reports_db))
+                         if self.issue_types_db[i] == self.issue_types_db[j]]
+                if not later:
+                    continue
+                # One matrix-vector product per modality for all of report i's pairs
+                text_sims = self.text_embeddings_db.scores(self.text_embeddings_db[i], later)
+                image_sims = self.image_features_db.scores(self.image_features_db[i], later)
+
+                # Calculate location similarity (vectorized haversine; unknown locations count as far apart)
+                lat, lon = self.spatial_index.coords([i])[0]
+                coords = self.spatial_index.coords(later)
+                dists = haversine_km(lat, lon, coords[:, 0], coords[:, 1])
+                loc_sims = np.nan_to_num(1.0 - np.minimum(1.0, dists / self.location_threshold))
+
+                for j, text_sim, image_sim, loc_sim in zip(later, text_sims.tolist(), image_sims.tolist(),
+                                                           loc_sims.tolist()):
                     # Create feature vector for this pair
                     features = [text_sim, image_sim, loc_sim, 
                                int(self.issue_types_db[i] == self.issue_types_db[j])]
@@ -382,83 +825,67 @@ class CivicIssueDuplicateDetector:
             new_location = new_report['location']
             new_issue_type = new_report['issue_type']
 
+            # Candidates: reports of the same issue type within the location threshold
+            try:
+                candidates, distances = self.spatial_index.query(new_issue_type, new_location,
+                                                                 self.location_threshold)
+            except (TypeError, ValueError, IndexError) as e:
+                print(f"Invalid location in new report: {e}")
+                return False, [], 0.0
+            if not len(candidates):
+                return False, [], 0.0
+            candidates = candidates.tolist()
+
+            # Text and image similarity: one matrix-vector product per modality over all candidates
+            text_sims = self.text_embeddings_db.scores(new_text_embedding, candidates)
+            image_sims = self.image_features_db.scores(new_image_features, candidates)
+
+            # Calculate location similarity
+            location_sims = 1.0 - np.minimum(1.0, distances / self.location_threshold)
+
+            # Use XGBoost model if available, trained, and enough data
+            use_xgboost = (
+                self.xgb_model is not None
+                and self.has_enough_data_for_xgboost
+                and len(self.reports_db) > 10  # Reduced threshold for XGBoost usage
+                and self.scaler is not None
+            )
+            if use_xgboost:
+                # Feature vectors of all candidates (the issue types match by construction)
+                features = np.column_stack([text_sims, image_sims, location_sims, np.ones(len(candidates))])
+                # Probability of being duplicate, for all candidates in one call
+                probs = self.xgb_model.predict_proba(self.scaler.transform(features))[:, 1]
+
             # Storage for results
             similarities = []
+            for k, idx in enumerate(candidates):
+                report = self.reports_db[idx]
+                text_sim, image_sim, location_sim = float(text_sims[k]), float(image_sims[k]), float(location_sims[k])
 
-            # Check each report in the database
-            for idx, report in enumerate(self.reports_db):
-                try:
-                    # Check issue type match first
-                    if report['issue_type'] != new_issue_type:
-                        continue
-
-                    # Check location proximity
-                    dist = geopy.distance.distance(new_location, self.location_db[idx]).kilometers
-                    if dist > self.location_threshold:
-                        continue
-
-                    # Text similarity
-                    text_sim = cosine_similarity([new_text_embedding], [self.text_embeddings_db[idx]])[0][0]
-
-                    # Image similarity
-                    image_sim = cosine_similarity([new_image_features], [self.image_features_db[idx]])[0][0]
-
-                    # Handle NaN values in similarities
-                    if np.isnan(text_sim):
-                        text_sim = 0.0
-                    if np.isnan(image_sim):
-                        image_sim = 0.0
-
-                    # Calculate location similarity
-                    location_sim = 1.0 - min(1.0, dist / self.location_threshold)
-
-                    # Add debug information to see the scores
-                    print(f"DEBUG: Comparing with Report ID {report.get('id', idx)}: "
-                          f"Text Sim={text_sim:.2f}, Image Sim={image_sim:.2f}, Loc Sim={location_sim:.2f}")
-
-                    # Use XGBoost model if available, trained, and enough data
-                    if (
-                        self.xgb_model is not None
-                        and self.has_enough_data_for_xgboost
-                        and len(self.reports_db) > 10  # Reduced threshold for XGBoost usage
-                        and self.scaler is not None
-                    ):
-                        # Create feature vector
-                        features = [[
-                            text_sim,
-                            image_sim,
-                            location_sim,
-                            int(new_issue_type == self.issue_types_db[idx])
-                        ]]
-
-                        # Scale features
-                        features_scaled = self.scaler.transform(features)
-
-                        # Get XGBoost prediction probability
-                        prob = self.xgb_model.predict_proba(features_scaled)[0][1]  # Probability of being duplicate
-
-                        if prob >= 0.5:  # Threshold for XGBoost confidence
-                            similarities.append((report, prob))
-                    else:
-                        # --- CORRECTED AND RE-TUNED SIMILARITY LOGIC ---
-                        
-                        # Rule 1: Lowered strict override for very similar images/locations.
-                        if image_sim > 0.85 and location_sim > 0.9:
-                            similarities.append((report, 0.95))  # Assign a high confidence score
-                            continue  # Move to next report
-
-                        # Rule 2: Re-balanced formula giving more weight to text and location.
-                        # Text (0.4) + Location (0.4) + Image (0.2)
-                        overall_sim = (0.4 * text_sim) + (0.2 * image_sim) + (0.4 * location_sim)
-
-                        # Rule 3: Lowered the overall threshold to a more reasonable value.
-                        if overall_sim >= 0.65:
-                            similarities.append((report, overall_sim))
-                                
-                except Exception as e:
-                    print(f"Error comparing with report {idx}: {e}")
+                # Add debug information to see the scores
+                print(f"DEBUG: Comparing with Report ID {report.get('id', idx)}: "
+                      f"Text Sim={text_sim:.2f}, Image Sim={image_sim:.2f}, Loc Sim={location_sim:.2f}")
+
+                if use_xgboost:
+                    if probs[k] >= 0.5:  # Threshold for XGBoost confidence
+                        similarities.append((report, probs[k]))
                     continue
 
+                # --- CORRECTED AND RE-TUNED SIMILARITY LOGIC ---
+
+                # Rule 1: Lowered strict override for very similar images/locations.
+                if image_sim > 0.85 and location_sim > 0.9:
+                    similarities.append((report, 0.95))  # Assign a high confidence score
+                    continue  # Move to next report
+
+                # Rule 2: Re-balanced formula giving more weight to text and location.
+                # Text (0.4) + Location (0.4) + Image (0.2)
+                overall_sim = (0.4 * text_sim) + (0.2 * image_sim) + (0.4 * location_sim)
+
+                # Rule 3: Lowered the overall threshold to a more reasonable value.
+                if overall_sim >= 0.65:
+                    similarities.append((report, overall_sim))
+
             # Sort by similarity
             similarities.sort(key=lambda x: x[1], reverse=True)
 
@@ -527,8 +954,7 @@ class CivicIssueDuplicateDetector:
             with open(json_file, 'r') as f:
                 reports = json.load(f)
             
-            for report in reports:
-                self.add_report(report)
+            self.add_reports(reports)
             
             # Build clusters after loading
             if len(reports) >= 2:
@@ -635,10 +1061,7 @@ def create_flask_app():
                 return jsonify({"error": "No reports data provided"}), 400
             
             reports = data['reports']
-            count = 0
-            for report in reports:
-                if app.detector.add_report(report) is not None:
-                    count += 1
+            count = sum(index is not None for index in app.detector.add_reports(reports))
             
             # Build clusters after loading
             if count >= 2:
@@ -5,7 +5,12 @@ import sqlite3
 import io
 import datetime
 import json
-from flask import Flask, request, render_template, jsonify, send_from_directory, session, redirect, url_for, flash
+import ast
+import atexit
+import queue
+import threading
+import time
+from flask import Flask, request, render_template, jsonify, send_from_directory, session, redirect, url_for, flash, Response
 from flask.json.provider import DefaultJSONProvider
 import logging
 from flask.logging import default_handler
@@ -56,62 +61,46 @@ def handle_sqlite_error(e):
     }), 500
 
 class CustomJSONEncoder(DefaultJSONProvider):
-    def __init__(self, app):
-        super().__init__(app)
-        self.options = {
-            'ensure_ascii': False,
-            'sort_keys': False,
-            'compact': True
-        }
-
-    def default(self, obj):
-        try:
-            if isinstance(obj, datetime.datetime):
-                return obj.isoformat()
-            if isinstance(obj, sqlite3.Row):
-                return dict(obj)
-            if isinstance(obj, bytes):
-                return base64.b64encode(obj).decode('utf-8')
-            return super().default(obj)
-        except Exception as e:
-            print(f"JSON encoding error: {e}")
-            return None
-        
-    def dumps(self, obj, **kwargs):
-        def convert(o):
-            if isinstance(o, datetime.datetime):
-                return o.isoformat()
-            elif isinstance(o, sqlite3.Row):
-                return dict(o)
-            elif isinstance(o, bytes):
-                return base64.b64encode(o).decode('utf-8')
-            elif isinstance(o, dict):
-                return {k: convert(v) for k, v in o.items()}
-            elif isinstance(o, (list, tuple)):
-                return [convert(v) for v in o]
-            return o
+    """
+    JSON provider backed by pothole_serialization: datetimes, sqlite3.Row,
+    bytes and numpy values are encoded in the same single pass as everything
+    else (with orjson when it is installed), and responses skip the str step.
+    """
 
+    def dumps(self, obj, **kwargs):
         try:
-            return json.dumps(convert(obj), ensure_ascii=False, **kwargs)
+            return dumps_str(obj, indent=bool(kwargs.get('indent')))
         except Exception as e:
             print(f"JSON dumps error: {e}")
-            return json.dumps(None)
+            return 'null'
 
     def loads(self, s, **kwargs):
         try:
-            return json.loads(s, **kwargs)
+            return loads(s)
         except Exception as e:
             print(f"JSON loads error: {e}")
             return None
 
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = dumps(obj)
+        except Exception as e:
+            print(f"JSON dumps error: {e}")
+            body = b'null'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderServiceError
 
 # Import the pothole detection function from the existing file
-from pothole_detection import run_pothole_detection
-from duplication_detection_code import get_duplicate_detector
+from pothole_detection import run_pothole_detection_from_bytes, DetectionJobQueue, get_detector, annotation_store, ANNOTATION_FORMATS, result_cache
+from pothole_metrics import REGISTRY as metrics_registry, PROMETHEUS_CONTENT_TYPE, ERRORS, stage_timer
+from pothole_serialization import dumps, dumps_str, loads
+from duplication_detection_code import FeatureStore, get_duplicate_detector
+from similarity_index import SimilarityIndex
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'dev-secret-key-replace-later'
@@ -129,7 +118,12 @@ except Exception as e:
     raise e
 
 # Initialize the duplicate detector
-detector = get_duplicate_detector(location_threshold=0.1)  # 100-meter threshold
+# Features are persisted next to the complaints so restarts only embed new complaints,
+# and so is the city-wide similarity index over them
+detector = get_duplicate_detector(
+    location_threshold=0.1,  # 100-meter threshold
+    feature_store=FeatureStore(os.path.join(os.path.dirname(__file__), 'enivaran.db')),
+    similarity_index=SimilarityIndex(os.path.join(os.path.dirname(__file__), 'similarity_index')))
 
 # --- START: AI CHATBOT CONFIGURATION ---
 # IMPORTANT: Store your API key in a .env file in the root directory
@@ -148,36 +142,67 @@ except Exception as e:
     chat_model = None
 # --- END: AI CHATBOT CONFIGURATION ---
 
-def load_existing_complaints_into_detector():
+def load_existing_complaints_into_detector(chunk_size=256):
     """
     Loads all existing, non-duplicate complaints from the database into the
-    in-memory duplicate detector on application startup.
+    in-memory duplicate detector on application startup. Features stored by
+    earlier runs are read in one query up front, and image BLOBs are only
+    fetched for complaints whose image features still have to be computed.
+    Rows are read `chunk_size` complaints at a time, so at most one chunk of
+    images is held in memory.
     """
     app.logger.info("Loading existing complaints into duplicate detector...")
+    start = time.perf_counter()
+    loaded = 0
+    if detector.feature_store is not None:
+        detector.feature_store.prune()
+    stored_ids = detector.load_stored_features()
+    detector.open_similarity_index()
+    loaded_ids = []
     with sqlite3.connect(APP_DB) as conn:
         conn.row_factory = dict_factory
         # Load only original (non-duplicate) reports for comparison
-        complaints_to_load = conn.execute(
-            'SELECT id, text, location_lat, location_lon, issue_type, image FROM complaints WHERE is_duplicate = 0'
-        ).fetchall()
-
-        for complaint in complaints_to_load:
-            if not all(k in complaint for k in ['id', 'text', 'location_lat', 'location_lon', 'issue_type', 'image']):
-                app.logger.warning(f"Skipping incomplete complaint record: {complaint.get('id')}")
-                continue
-            
-            report_dict = {
-                'id': complaint['id'],
-                'text': complaint['text'],
-                'location': (complaint['location_lat'], complaint['location_lon']),
-                'issue_type': complaint['issue_type'],
-                'image_bytes': complaint['image']
-            }
-            detector.add_report(report_dict)
-    
-    app.logger.info(f"Loaded {len(complaints_to_load)} complaints into the detector.")
+        cursor = conn.execute(f'''
+            SELECT c.id, c.text, c.location_lat, c.location_lon, c.issue_type,
+                   CASE WHEN f.complaint_id IS NULL THEN c.image END AS image
+            FROM complaints c
+            LEFT JOIN {FeatureStore.TABLE} f
+                ON f.complaint_id = c.id AND f.kind = 'image' AND f.fingerprint = ?
+            WHERE c.is_duplicate = 0''', (detector.feature_fingerprints()['image'],)
+        )
+        while True:
+            complaints_to_load = cursor.fetchmany(chunk_size)
+            if not complaints_to_load:
+                break
+
+            reports = []
+            for complaint in complaints_to_load:
+                if not all(k in complaint for k in ['id', 'text', 'location_lat', 'location_lon', 'issue_type', 'image']):
+                    app.logger.warning(f"Skipping incomplete complaint record: {complaint.get('id')}")
+                    continue
+
+                reports.append({
+                    'id': complaint['id'],
+                    'text': complaint['text'],
+                    'location': (complaint['location_lat'], complaint['location_lon']),
+                    'issue_type': complaint['issue_type'],
+                    'image_bytes': complaint['image']
+                })
+            detector.add_reports(reports)
+            loaded += len(complaints_to_load)
+            loaded_ids.extend(report['id'] for report in reports)
+
+    app.logger.info(f"Loaded {loaded} complaints into the detector in {time.perf_counter() - start:.1f}s "
+                    f"({len(stored_ids)} with stored features).")
+    if detector.similarity_index is not None:
+        # Drop complaints deleted or marked duplicate since the index was saved
+        detector.similarity_index.retain(loaded_ids)
+        detector.similarity_index.save()
+        # Inserts and deletes after startup are saved periodically, so a crash loses little
+        detector.similarity_index.start_autosave()
+        atexit.register(detector.similarity_index.close)
     # Optionally build clusters after loading
-    if len(complaints_to_load) > 1:
+    if loaded > 1:
         detector.build_clusters()
         app.logger.info("Detector clusters have been built.")
 
@@ -369,9 +394,34 @@ def init_database():
                 annotated_image BLOB,
                 detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 user_id INTEGER,
+                job_id TEXT,
+                location_lat REAL,
+                location_lon REAL,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )''')
+        # Databases created before the job API / heatmap lack these columns
+        detection_columns = [row[1] for row in c.execute('PRAGMA table_info(pothole_detections)')]
+        for column, column_type in (('job_id', 'TEXT'), ('location_lat', 'REAL'), ('location_lon', 'REAL')):
+            if column not in detection_columns:
+                c.execute(f'ALTER TABLE pothole_detections ADD COLUMN {column} {column_type}')
             
+        # One row per detected pothole, so SQL can aggregate by priority, size or confidence.
+        # Legacy detections that only stored priority counts have NULL geometry.
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS detected_potholes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                detection_id INTEGER NOT NULL,
+                pothole_index INTEGER NOT NULL,
+                x1 INTEGER,
+                y1 INTEGER,
+                x2 INTEGER,
+                y2 INTEGER,
+                priority TEXT NOT NULL,
+                depth_score REAL,
+                confidence REAL,
+                FOREIGN KEY (detection_id) REFERENCES pothole_detections (id) ON DELETE CASCADE
+            )''')
+
         # Create pothole stats table
         c.execute('''
             CREATE TABLE IF NOT EXISTS pothole_stats (
@@ -399,7 +449,17 @@ def init_database():
                 UNIQUE (user_id, complaint_id)
             )''')
 
+        # Tracks one-time data migrations
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
         # Create indexes for better performance
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pothole_detections_job_id ON pothole_detections(job_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_detected_potholes_detection ON detected_potholes(detection_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_detected_potholes_priority ON detected_potholes(priority)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_complaints_user_id ON complaints(user_id)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_complaints_submitted_at ON complaints(submitted_at)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
@@ -407,6 +467,301 @@ def init_database():
         
         conn.commit()
 
+        migrate_legacy_pothole_db(conn)
+        # The counters drift if a previous run lost queued detections or failed a batch
+        reconcile_pothole_stats(conn)
+        conn.commit()
+        init_geo_tiles(conn)
+
+# --- Geo-tile Heatmap ---
+# Complaints and located pothole detections are counted per grid cell at
+# several zoom levels. Cells are an equirectangular quadtree: at zoom z the
+# world is 2^z cells wide (360°) and 2^z cells tall (180°). SQLite triggers
+# keep geo_tile_stats current on every insert, status change and delete, so
+# all write paths (including scripts) stay consistent.
+GEO_TILE_ZOOMS = (4, 8, 12, 16)
+GEO_TILE_MAX_CELLS = 512  # per axis, per request
+
+def geo_cell(lat, lon, zoom):
+    """(cell_x, cell_y) of a coordinate at `zoom`; mirrors _geo_cell_sql."""
+    n = 1 << zoom
+    return min(int((lon + 180.0) / 360.0 * n), n - 1), min(int((90.0 - lat) / 180.0 * n), n - 1)
+
+def _geo_cell_sql(lat, lon, zoom):
+    n = 1 << zoom
+    return (f"MIN(CAST(({lon} + 180.0) / 360.0 * {n} AS INTEGER), {n - 1})",
+            f"MIN(CAST((90.0 - {lat}) / 180.0 * {n} AS INTEGER), {n - 1})")
+
+def _geo_upsert_sql(lat, lon, category, key, delta, condition='1', source=''):
+    """INSERT ... ON CONFLICT statements adding `delta` to (`category`, `key`) in every zoom level's cell."""
+    statements = []
+    for zoom in GEO_TILE_ZOOMS:
+        cell_x, cell_y = _geo_cell_sql(lat, lon, zoom)
+        group_by = f' GROUP BY {key}' if source else ''
+        statements.append(f'''
+            INSERT INTO geo_tile_stats (zoom, cell_x, cell_y, category, key, count)
+            SELECT {zoom}, {cell_x}, {cell_y}, '{category}', {key}, {delta} {source}
+            WHERE {lat} IS NOT NULL AND {lon} IS NOT NULL AND {condition}{group_by}
+            ON CONFLICT (zoom, cell_x, cell_y, category, key) DO UPDATE SET count = count + excluded.count;''')
+    return ''.join(statements)
+
+def _complaint_keys(row=None):
+    """(category, key expression) pairs counted per complaint; NULL columns count as 'unknown' (key is NOT NULL)."""
+    prefix = f'{row}.' if row else ''
+    return (('issue_type', f"COALESCE(LOWER(TRIM({prefix}issue_type)), 'unknown')"),
+            ('status', f"COALESCE({prefix}status, 'unknown')"))
+
+def _complaint_upserts(row, delta):
+    lat, lon, visible = f'{row}.location_lat', f'{row}.location_lon', f'{row}.is_duplicate = 0'
+    return ''.join(_geo_upsert_sql(lat, lon, category, key, delta, visible) for category, key in _complaint_keys(row))
+
+def init_geo_tiles(conn):
+    """(Re)creates the heatmap triggers and rebuilds geo_tile_stats when the zoom levels changed."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geo_tile_stats (
+            zoom INTEGER NOT NULL,
+            cell_x INTEGER NOT NULL,
+            cell_y INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (zoom, cell_x, cell_y, category, key)
+        ) WITHOUT ROWID''')
+
+    detection_lat = '(SELECT location_lat FROM pothole_detections WHERE id = NEW.detection_id)'
+    detection_lon = '(SELECT location_lon FROM pothole_detections WHERE id = NEW.detection_id)'
+    triggers = {
+        'geo_complaints_insert': f"AFTER INSERT ON complaints BEGIN {_complaint_upserts('NEW', 1)} END",
+        'geo_complaints_update': (
+            "AFTER UPDATE OF status, issue_type, location_lat, location_lon, is_duplicate ON complaints "
+            f"BEGIN {_complaint_upserts('OLD', -1)} {_complaint_upserts('NEW', 1)} END"),
+        'geo_complaints_delete': f"AFTER DELETE ON complaints BEGIN {_complaint_upserts('OLD', -1)} END",
+        'geo_potholes_insert': (
+            "AFTER INSERT ON detected_potholes "
+            f"BEGIN {_geo_upsert_sql(detection_lat, detection_lon, 'priority', 'NEW.priority', 1)} END"),
+        # Runs before the cascade removes the detection's detected_potholes rows
+        'geo_detections_delete': (
+            "BEFORE DELETE ON pothole_detections BEGIN "
+            f"{_geo_upsert_sql('OLD.location_lat', 'OLD.location_lon', 'priority', 'priority', '-COUNT(*)', 'detection_id = OLD.id', 'FROM detected_potholes')} END"),
+    }
+    for name, body in triggers.items():
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.execute(f'CREATE TRIGGER {name} {body}')
+
+    migration = f"geo_tiles:{','.join(map(str, GEO_TILE_ZOOMS))}"
+    if not conn.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (migration,)).fetchone():
+        rebuild_geo_tiles(conn)
+        conn.execute("DELETE FROM schema_migrations WHERE name LIKE 'geo_tiles:%'")
+        conn.execute('INSERT INTO schema_migrations (name) VALUES (?)', (migration,))
+    conn.commit()
+
+def rebuild_geo_tiles(conn):
+    """Recomputes geo_tile_stats from scratch (one scan of complaints and located detections)."""
+    conn.execute('DELETE FROM geo_tile_stats')
+    for zoom in GEO_TILE_ZOOMS:
+        cell_x, cell_y = _geo_cell_sql('location_lat', 'location_lon', zoom)
+        for category, key in _complaint_keys():
+            conn.execute(f'''
+                INSERT INTO geo_tile_stats (zoom, cell_x, cell_y, category, key, count)
+                SELECT {zoom}, {cell_x}, {cell_y}, '{category}', {key}, COUNT(*) FROM complaints
+                WHERE location_lat IS NOT NULL AND location_lon IS NOT NULL AND is_duplicate = 0
+                GROUP BY 2, 3, 5''')
+        cell_x, cell_y = _geo_cell_sql('d.location_lat', 'd.location_lon', zoom)
+        conn.execute(f'''
+            INSERT INTO geo_tile_stats (zoom, cell_x, cell_y, category, key, count)
+            SELECT {zoom}, {cell_x}, {cell_y}, 'priority', p.priority, COUNT(*)
+            FROM detected_potholes p JOIN pothole_detections d ON d.id = p.detection_id
+            WHERE d.location_lat IS NOT NULL AND d.location_lon IS NOT NULL
+            GROUP BY 2, 3, 5''')
+
+# --- Pothole Detection Persistence ---
+LEGACY_POTHOLE_DB = os.path.join(os.path.dirname(__file__), 'pothole_data.db')
+POTHOLE_PRIORITY_COLUMNS = {'High': 'high_priority_count', 'Medium': 'medium_priority_count', 'Low': 'low_priority_count'}
+
+def _pothole_rows(result):
+    """Per-pothole rows (index, x1, y1, x2, y2, priority, depth, confidence) for a detection result."""
+    if 'potholes' in result:
+        return [(p['id'], *p['bbox'], p['priority'], p.get('depth_score'), p.get('confidence'))
+                for p in result['potholes']]
+    # Legacy results only kept per-priority counts
+    rows = []
+    for priority, count in (result.get('individual_priorities') or {}).items():
+        rows.extend((len(rows), None, None, None, None, priority, None, None) for _ in range(count))
+    return rows
+
+def insert_pothole_detections(conn, records):
+    """
+    Writes detections in the caller's transaction: one pothole_detections row
+    and its detected_potholes rows per record, then a single pothole_stats
+    increment for the whole batch. Records are
+    (result, input_image, input_filename, annotated_image, detected_at, user_id, job_id, location),
+    where location is a (lat, lon) pair or None.
+    """
+    counts = dict.fromkeys(POTHOLE_PRIORITY_COLUMNS, 0)
+    last_detected = None
+    for result, input_image, input_filename, annotated_image, detected_at, user_id, job_id, location in records:
+        lat, lon = location or (None, None)
+        cursor = conn.execute('''
+            INSERT INTO pothole_detections (input_image, input_filename, detection_result, annotated_image, detected_at,
+                                            user_id, job_id, location_lat, location_lon)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (input_image, input_filename, dumps_str(result), annotated_image, detected_at, user_id, job_id, lat, lon))
+        rows = _pothole_rows(result)
+        conn.executemany('''
+            INSERT INTO detected_potholes (detection_id, pothole_index, x1, y1, x2, y2, priority, depth_score, confidence)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(cursor.lastrowid, *row) for row in rows])
+        for row in rows:
+            if row[5] in counts:
+                counts[row[5]] += 1
+        last_detected = max(last_detected or detected_at, detected_at)
+    conn.execute(f'''
+        UPDATE pothole_stats SET
+            total_potholes = total_potholes + ?,
+            {', '.join(f"{column} = {column} + ?" for column in POTHOLE_PRIORITY_COLUMNS.values())},
+            last_updated = ?
+        WHERE id = 1''',
+        (sum(counts.values()), *(counts[p] for p in POTHOLE_PRIORITY_COLUMNS), last_detected))
+
+def reconcile_pothole_stats(conn):
+    """Recomputes the pothole_stats counters from the detected_potholes rows."""
+    totals = dict(conn.execute('SELECT priority, COUNT(*) FROM detected_potholes GROUP BY priority').fetchall())
+    conn.execute(f'''
+        UPDATE pothole_stats SET
+            total_potholes = ?,
+            {', '.join(f"{column} = ?" for column in POTHOLE_PRIORITY_COLUMNS.values())}
+        WHERE id = 1''',
+        (sum(totals.get(p, 0) for p in POTHOLE_PRIORITY_COLUMNS), *(totals.get(p, 0) for p in POTHOLE_PRIORITY_COLUMNS)))
+
+def migrate_legacy_pothole_db(conn, legacy_db=LEGACY_POTHOLE_DB):
+    """
+    One-time fold of the standalone pothole_data.db (pothole_images) into
+    pothole_detections / detected_potholes, after which pothole_stats is
+    recomputed from the per-pothole rows.
+    """
+    name = 'fold_pothole_data_db'
+    if conn.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (name,)).fetchone():
+        return
+    if not os.path.exists(legacy_db):
+        return
+    with sqlite3.connect(legacy_db) as legacy:
+        legacy_rows = legacy.execute('''
+            SELECT input_image, input_filename, detection_result, annotated_image, detected_at
+            FROM pothole_images ORDER BY id''').fetchall()
+
+    records = []
+    for input_image, input_filename, detection_result, annotated_image, detected_at in legacy_rows:
+        try:
+            # Stored as a Python dict repr in older versions
+            result = ast.literal_eval(detection_result)
+        except (ValueError, SyntaxError):
+            try:
+                result = json.loads(detection_result)
+            except (TypeError, ValueError):
+                app.logger.warning(f"Skipping unreadable legacy detection {input_filename!r}")
+                continue
+        records.append((result, input_image, input_filename, annotated_image, detected_at, None, None, None))
+
+    insert_pothole_detections(conn, records)
+    reconcile_pothole_stats(conn)
+    conn.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+    conn.commit()
+    app.logger.info(f"Migrated {len(records)} detections from {legacy_db}")
+
+class DetectionRecorder:
+    """
+    Write-behind persistence for /detect_pothole. `record` only enqueues; a
+    background thread drains the queue and writes up to `batch_size`
+    detections per transaction (see insert_pothole_detections), waiting at
+    most `flush_interval` seconds to fill a batch. The upload and annotated
+    image are only stored with `store_images`; otherwise just the report and
+    its per-pothole rows are.
+
+    Queued records are bounded by total size, `max_queue_bytes` (each record
+    costs RECORD_OVERHEAD plus any images it carries). When the queue is
+    full, `record` waits up to `put_timeout` seconds and then drops the
+    record (counted as pothole_errors{stage="record"}); pothole_stats is
+    reconciled from detected_potholes on the next startup.
+    """
+
+    RECORD_OVERHEAD = 1024
+
+    def __init__(self, db_path, batch_size=64, flush_interval=0.5, max_queue_bytes=32 * 1024 * 1024,
+                 put_timeout=0.1, store_images=False):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_bytes = max_queue_bytes
+        self.put_timeout = put_timeout
+        self.store_images = store_images
+        self._queue = queue.Queue()
+        self._queued_bytes = 0
+        self._space = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='detection-recorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, result, input_image=None, input_filename=None, annotated_image=None, user_id=None, job_id=None,
+               location=None):
+        if not self.store_images:
+            input_image = annotated_image = None
+        size = self.RECORD_OVERHEAD + len(input_image or b'') + len(annotated_image or b'')
+        detected_at = datetime.datetime.now().isoformat(' ')
+        with self._space:
+            # A record larger than the whole budget still goes through once the queue is empty
+            if not self._space.wait_for(lambda: self._queued_bytes == 0 or
+                                        self._queued_bytes + size <= self.max_queue_bytes, self.put_timeout):
+                ERRORS.inc(stage='record')
+                app.logger.warning(f"Detection recorder queue still full after {self.put_timeout}s, "
+                                   f"dropping detection record")
+                return
+            self._queued_bytes += size
+        self._queue.put((size, (result, input_image, input_filename, annotated_image, detected_at, user_id, job_id,
+                                location)))
+
+    def flush(self):
+        """Blocks until everything recorded so far is written."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write([record for _, record in batch])
+            with self._space:
+                self._queued_bytes -= sum(size for size, _ in batch)
+                self._space.notify_all()
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                conn.execute('PRAGMA foreign_keys = ON')
+                insert_pothole_detections(conn, batch)
+        except Exception as e:
+            app.logger.error(f"Failed to persist {len(batch)} pothole detections: {e}")
+
 # --- Initialize Application ---
 def init_app():
     """Initialize application with complete setup sequence"""
@@ -443,11 +798,41 @@ def init_app():
     except Exception as e:
         app.logger.error(f"Failed to load complaints into detector: {e}")
         # Don't raise here as this is non-critical
+
+    # Step 5: Load and warm up the pothole detection model (or start the inference worker processes)
+    # so the first request only pays for inference
+    try:
+        get_detector().preload()
+        app.logger.info("Pothole detection model loaded and warmed up")
+    except Exception as e:
+        app.logger.error(f"Failed to preload pothole detection model: {e}")
+        # Non-critical: the model will be loaded on the first detection request
         
     app.logger.info("Application initialization completed")
 
 # Initialize the application
 init_app()
+# Set POTHOLE_STORE_DETECTION_IMAGES=1 to also keep each upload and its annotated image as BLOBs
+detection_recorder = DetectionRecorder(APP_DB, store_images=os.getenv('POTHOLE_STORE_DETECTION_IMAGES', '0') == '1')
+
+def _session_user_id():
+    # Admin sessions carry a non-numeric user_id that has no users row
+    user_id = session.get('user_id')
+    return user_id if isinstance(user_id, int) else None
+
+def _request_location():
+    """Optional lat/lon form fields of a detection upload, as a (lat, lon) pair or None."""
+    try:
+        lat, lon = float(request.form['lat']), float(request.form['lon'])
+    except (KeyError, ValueError):
+        return None
+    return (lat, lon) if -90 <= lat <= 90 and -180 <= lon <= 180 else None
+
+def _record_job(job):
+    detection_recorder.record(job.result, job.image_bytes, job.source_name, None, job.user_id, job.id,
+                              job.context.get('location'))
+
+detection_jobs = DetectionJobQueue(on_complete=_record_job)
 
 
 @app.route('/detect_pothole', methods=['POST'])
@@ -459,19 +844,163 @@ def detect_pothole():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
+    # Decoded straight from the request body; nothing is written to UPLOAD_FOLDER
     filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    image_bytes = file.read()
+
+    # annotate=inline (default) embeds the annotated JPEG; annotate=lazy returns
+    # detections immediately and a URL that renders the annotation on demand.
+    annotate_mode = request.args.get('annotate', request.form.get('annotate', 'inline'))
+    if annotate_mode not in ('inline', 'lazy'):
+        return jsonify({'error': "annotate must be 'inline' or 'lazy'"}), 400
 
-    result_json, annotated_image_bytes = run_pothole_detection(file_path)
-    os.remove(file_path)
+    with stage_timer('pipeline'):
+        result_json, annotated_image_bytes = run_pothole_detection_from_bytes(
+            image_bytes, annotate=annotate_mode == 'inline', source_name=filename,
+            lazy_annotation=annotate_mode == 'lazy')
 
     if result_json is None:
         return jsonify({'error': 'Detection failed'}), 500
 
+    detection_recorder.record(result_json, image_bytes, filename, annotated_image_bytes, _session_user_id(),
+                              location=_request_location())
+
+    if annotate_mode == 'lazy':
+        annotated_image_url = url_for('detect_pothole_annotated', annotation_id=result_json['annotation_id'])
+        return jsonify({'result': result_json, 'annotated_image_url': annotated_image_url})
+
     annotated_image_b64 = base64.b64encode(annotated_image_bytes).decode('utf-8')
     return jsonify({'result': result_json, 'annotated_image_b64': annotated_image_b64})
 
+@app.route('/detect_pothole/annotated/<annotation_id>', methods=['GET'])
+@login_required
+def detect_pothole_annotated(annotation_id):
+    """Renders (or serves the cached) annotated image for a lazy detection."""
+    fmt = request.args.get('format', 'jpeg').lower()
+    if fmt not in ANNOTATION_FORMATS:
+        return jsonify({'error': f"Unsupported format. Use one of: {', '.join(ANNOTATION_FORMATS)}"}), 400
+    try:
+        quality = int(request.args.get('quality', 90))
+        max_dim = request.args.get('max_dim', type=int)
+    except ValueError:
+        return jsonify({'error': 'quality must be an integer'}), 400
+    if not 1 <= quality <= 100 or (max_dim is not None and max_dim <= 0):
+        return jsonify({'error': 'quality must be 1-100 and max_dim positive'}), 400
+
+    rendered = annotation_store.get(annotation_id, fmt, quality, max_dim)
+    if rendered is None:
+        return jsonify({'error': 'Annotation not found or expired'}), 404
+    image_bytes, mimetype = rendered
+    response = Response(image_bytes, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@app.route('/detect_pothole/jobs', methods=['POST'])
+@login_required
+def submit_detection_job():
+    """Queues a detection and returns immediately; poll the returned status_url for the result."""
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        job = detection_jobs.submit(file.read(), secure_filename(file.filename), _session_user_id(),
+                                    {'location': _request_location()})
+    except queue.Full:
+        retry_after = detection_jobs.retry_after()
+        response = jsonify({'error': 'Detection queue is full, please retry shortly.', 'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    status_url = url_for('detection_job_status', job_id=job.id)
+    response = jsonify({'job_id': job.id, 'status': job.status, 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@app.route('/detect_pothole/jobs/<job_id>', methods=['GET'])
+@login_required
+def detection_job_status(job_id):
+    """Status of a detection job; finished jobs also come back from pothole_detections after eviction or restart."""
+    job = detection_jobs.get(job_id)
+    if job is not None:
+        if job.user_id != _session_user_id() and not session.get('is_admin'):
+            return jsonify({'error': 'Job not found'}), 404
+        data = job.to_dict()
+    else:
+        with sqlite3.connect(APP_DB) as conn:
+            row = conn.execute('SELECT detection_result, user_id FROM pothole_detections WHERE job_id = ?',
+                               (job_id,)).fetchone()
+        if row is None or (row[1] != _session_user_id() and not session.get('is_admin')):
+            return jsonify({'error': 'Job not found'}), 404
+        data = {'job_id': job_id, 'status': 'done', 'result': loads(row[0]), 'error': None}
+
+    if data['status'] == 'done' and data['result'].get('annotation_id'):
+        data['annotated_image_url'] = url_for('detect_pothole_annotated', annotation_id=data['result']['annotation_id'])
+    elif data['status'] in ('queued', 'running'):
+        data['pending'] = detection_jobs.stats()['pending']
+    return jsonify(data)
+
+@app.route('/heatmap/tiles', methods=['GET'])
+@login_required
+def heatmap_tiles():
+    """
+    Per-cell complaint counts (by issue_type and status) and pothole counts
+    (by priority) for the cells covering a viewport, at the deepest
+    precomputed zoom not finer than `zoom`. Admin only.
+    """
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized access.'}), 403
+    try:
+        zoom = request.args.get('zoom', GEO_TILE_ZOOMS[-1], type=int)
+        min_lat, max_lat = float(request.args['min_lat']), float(request.args['max_lat'])
+        min_lon, max_lon = float(request.args['min_lon']), float(request.args['max_lon'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'min_lat, max_lat, min_lon and max_lon are required numbers'}), 400
+
+    zoom = max([z for z in GEO_TILE_ZOOMS if z <= zoom] or [GEO_TILE_ZOOMS[0]])
+    min_x, min_y = geo_cell(max(min(max_lat, 90), -90), max(min(min_lon, 180), -180), zoom)
+    max_x, max_y = geo_cell(max(min(min_lat, 90), -90), max(min(max_lon, 180), -180), zoom)
+    if max_x - min_x >= GEO_TILE_MAX_CELLS or max_y - min_y >= GEO_TILE_MAX_CELLS:
+        return jsonify({'error': 'Viewport too large for this zoom level, zoom out.'}), 400
+
+    # One index range per cell column keeps the work proportional to the viewport
+    columns = list(range(min_x, max_x + 1))
+    with sqlite3.connect(APP_DB) as conn:
+        rows = conn.execute(f'''
+            SELECT cell_x, cell_y, category, key, count FROM geo_tile_stats
+            WHERE zoom = ? AND cell_x IN ({','.join('?' * len(columns))}) AND cell_y BETWEEN ? AND ? AND count > 0''',
+            (zoom, *columns, min_y, max_y)).fetchall()
+
+    n = 1 << zoom
+    cells = {}
+    for cell_x, cell_y, category, key, count in rows:
+        cell = cells.get((cell_x, cell_y))
+        if cell is None:
+            cell = cells[(cell_x, cell_y)] = {
+                'x': cell_x, 'y': cell_y,
+                'bounds': [90.0 - (cell_y + 1) * 180.0 / n, cell_x * 360.0 / n - 180.0,
+                           90.0 - cell_y * 180.0 / n, (cell_x + 1) * 360.0 / n - 180.0],
+                'issue_type': {}, 'status': {}, 'priority': {}}
+        cell[category][key] = count
+    return jsonify({'zoom': zoom, 'cells': list(cells.values())})
+
+@app.route('/detect_pothole/cache_stats', methods=['GET'])
+@login_required
+def detect_pothole_cache_stats():
+    """Hit rate and memory/disk usage of the detection result cache (admin only)."""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized access.'}), 403
+    return jsonify({**result_cache.stats(), 'jobs': detection_jobs.stats()})
+
+@app.route('/metrics')
+def metrics():
+    """Detection pipeline metrics in Prometheus text format (POTHOLE_METRICS=0 disables collection)."""
+    return Response(metrics_registry.render(), mimetype=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/static/<path:filename>')
 def static_files(filename):
     # Added to serve the illustration image
@@ -717,6 +1246,8 @@ def delete_complaint(complaint_id):
             # Delete the complaint. The ON DELETE CASCADE on the upvotes table will handle related upvotes.
             cursor.execute('DELETE FROM complaints WHERE id = ?', (complaint_id,))
             conn.commit()
+            if detector.similarity_index is not None:
+                detector.similarity_index.remove(complaint_id)
             
             app.logger.info(f"Admin {session.get('username')} deleted complaint #{complaint_id}.")
             flash('Complaint deleted successfully.', 'success')
@@ -726,10 +1257,66 @@ def delete_complaint(complaint_id):
         app.logger.error(f"Database error while deleting complaint {complaint_id}: {e}")
         return jsonify({'error': 'Database operation failed.', 'details': str(e)}), 500
 
+@app.route('/similar_complaints', methods=['GET'])
+@login_required
+def similar_complaints():
+    """
+    City-wide search for complaints describing the same problem: the top `k`
+    complaints by text (default) or image similarity to `complaint_id`, or to a
+    free-text `text` query. Served from the approximate similarity index.
+    """
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Unauthorized access.'}), 403
+
+    kind = request.args.get('kind', 'text')
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
+    complaint_id = request.args.get('complaint_id', type=int)
+    text = request.args.get('text', '').strip()
+    if kind not in ('text', 'image'):
+        return jsonify({'error': "kind must be 'text' or 'image'."}), 400
+    if complaint_id is None and not text:
+        return jsonify({'error': 'Provide a complaint_id or a text query.'}), 400
+    if complaint_id is None and kind != 'text':
+        return jsonify({'error': 'Free-text queries can only search by text.'}), 400
+    if detector.similarity_index is None or detector.similarity_index.get(kind) is None:
+        return jsonify({'error': f'No {kind} similarity index is available.'}), 503
+
+    with sqlite3.connect(APP_DB) as conn:
+        conn.row_factory = dict_factory
+        query = complaint_id
+        if complaint_id is None:
+            query = {'text': text}
+        elif complaint_id not in detector.similarity_index.get(kind):
+            # Duplicates are not indexed, so they are embedded on the fly
+            row = conn.execute('SELECT text, image FROM complaints WHERE id = ?', (complaint_id,)).fetchone()
+            if not row:
+                return jsonify({'error': 'Complaint not found.'}), 404
+            query = {'text': row['text'], 'image_bytes': row['image']}
+
+        start = time.perf_counter()
+        matches = detector.find_similar(kind, query, k, exclude={complaint_id} if complaint_id is not None else ())
+        search_ms = (time.perf_counter() - start) * 1000
+
+        details = {}
+        if matches:
+            ids = [complaint for complaint, _ in matches]
+            details = {row['id']: row for row in conn.execute(f'''
+                SELECT id, text, issue_type, status, submitted_at,
+                       CAST(location_lat AS FLOAT) as location_lat, CAST(location_lon AS FLOAT) as location_lon
+                FROM complaints WHERE id IN ({','.join('?' * len(ids))})''', ids)}
+
+    return jsonify({
+        'kind': kind,
+        'complaint_id': complaint_id,
+        'search_ms': round(search_ms, 2),
+        'results': [dict(details[cid], similarity=round(similarity, 4))
+                    for cid, similarity in matches if cid in details],
+    })
+
 # --- Public & User Complaint Routes ---
 @app.route('/pothole_stats')
 def pothole_stats():
-    """Return pothole statistics"""
+    """Return pothole statistics (a single-row read; the counters are kept current by DetectionRecorder)"""
     with sqlite3.connect(APP_DB) as conn:
         conn.row_factory = dict_factory
         result = conn.execute('''
@@ -1368,10 +1955,19 @@ def debug_reset_complaints():
         return jsonify({'error': 'This route is only available in debug mode'}), 403
     
     try:
+        detection_recorder.flush()  # Queued detections would land after the reset
         with sqlite3.connect(APP_DB) as conn:
             conn.execute('PRAGMA foreign_keys = OFF')  # Temporarily disable foreign keys
             conn.execute('DELETE FROM complaints')  # Clear all complaints
-            conn.execute('DELETE FROM sqlite_sequence WHERE name="complaints"')  # Reset auto-increment
+            # Detections go too, so the O(1) pothole_stats counters and the heatmap match their tables
+            conn.execute('DELETE FROM detected_potholes')
+            conn.execute('DELETE FROM pothole_detections')
+            conn.execute('DELETE FROM geo_tile_stats')
+            # Reset auto-increment
+            conn.execute("DELETE FROM sqlite_sequence WHERE name IN ('complaints', 'pothole_detections', 'detected_potholes')")
+            conn.execute(f'DELETE FROM {FeatureStore.TABLE}')  # Stored features of the cleared complaints
+            if detector.similarity_index is not None:
+                detector.similarity_index.retain(())  # Complaint ids are reused after the reset
             conn.execute('UPDATE pothole_stats SET total_potholes = 0, high_priority_count = 0, medium_priority_count = 0, low_priority_count = 0')  # Reset stats
             conn.commit()
             flash('All complaints have been cleared successfully.', 'success')
@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from pothole_detection import (DEFAULT_MODEL_PATH, LETTERBOX, MODEL_VARIANTS, Preprocessor,
+                               box_iou, determine_road_priority, find_images, load_model, logger,
+                               score_detections, variant_model_path)
+
+
+# --- Building Variants ---
+
+def build_optimized(model_path, output_path):
+    """
+    Writes the graph after onnxruntime's basic and extended optimizations.
+    Layout (NCHWc) transforms are left out so the file stays portable across
+    CPUs; load_model applies them and caches the result per host.
+    """
+    import onnxruntime as ort
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_options.optimized_model_filepath = output_path
+    ort.InferenceSession(model_path, sess_options=sess_options, providers=['CPUExecutionProvider'])
+
+
+def _quant_preprocess(model_path):
+    """Runs shape inference and graph cleanup ahead of quantization; returns the path of the prepared model."""
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    prepared_path = f"{os.path.splitext(model_path)[0]}.quant-prep.onnx"
+    # ONNX shape inference is enough for the exported YOLO graph; symbolic inference would also need sympy.
+    quant_pre_process(model_path, prepared_path, skip_symbolic_shape=True)
+    return prepared_path
+
+
+def build_int8_dynamic(model_path, output_path):
+    """Quantizes weights to INT8 ahead of time; activations are quantized per batch at runtime."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    prepared_path = _quant_preprocess(model_path)
+    try:
+        # ConvInteger on the CPU provider only takes uint8 weights.
+        quantize_dynamic(prepared_path, output_path, weight_type=QuantType.QUInt8)
+    finally:
+        os.remove(prepared_path)
+
+
+class ImageCalibrationReader:
+    """
+    Feeds calibration images to onnxruntime's static quantizer, preprocessed
+    exactly like inference inputs.
+    """
+
+    def __init__(self, image_paths, input_name, imgsz=640, letterbox=LETTERBOX):
+        self.image_paths = list(image_paths)
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.preprocessor = Preprocessor(letterbox)
+        self._index = 0
+
+    def get_next(self):
+        while self._index < len(self.image_paths):
+            image = cv2.imread(self.image_paths[self._index])
+            self._index += 1
+            if image is None:
+                continue
+            out = np.empty((1, 3, self.imgsz, self.imgsz), dtype=np.float32)
+            self.preprocessor(image, self.imgsz, out[0])
+            return {self.input_name: out}
+        return None
+
+    def rewind(self):
+        self._index = 0
+
+
+def build_int8_static(model_path, output_path, calibration_images, letterbox=LETTERBOX):
+    """
+    Quantizes weights and activations to INT8 (QDQ format) using activation
+    ranges observed on `calibration_images`.
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    if not calibration_images:
+        raise ValueError("Static quantization needs calibration images (--images)")
+    input_name = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    prepared_path = _quant_preprocess(model_path)
+    try:
+        reader = ImageCalibrationReader(calibration_images, input_name, letterbox=letterbox)
+        quantize_static(prepared_path, output_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+    finally:
+        os.remove(prepared_path)
+
+
+def build_variants(model_path, variants, calibration_images=None):
+    """Builds each requested variant next to `model_path`; returns {variant: path}."""
+    built = {}
+    for variant in variants:
+        if variant == 'fp32':
+            continue
+        output_path = variant_model_path(model_path, variant)
+        start = time.perf_counter()
+        if variant == 'optimized':
+            build_optimized(model_path, output_path)
+        elif variant == 'int8_dynamic':
+            build_int8_dynamic(model_path, output_path)
+        elif variant == 'int8_static':
+            build_int8_static(model_path, output_path, calibration_images)
+        size_mb = os.path.getsize(output_path) / 1e6
+        logger.info(f"Built {variant} variant {output_path} ({size_mb:.1f} MB) in {time.perf_counter() - start:.1f}s")
+        built[variant] = output_path
+    return built
+
+
+# --- Accuracy vs. Latency ---
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Greedily matches candidate boxes to reference boxes (highest IoU first).
+    Returns (matched, confidence deltas of the matched pairs).
+    """
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0, []
+    iou = box_iou(reference['bbox'], candidate['bbox'])
+    matched, deltas = 0, []
+    for flat in np.argsort(iou, axis=None)[::-1]:
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        if np.isnan(iou[i, j]):
+            continue
+        iou[i, :] = np.nan
+        iou[:, j] = np.nan
+        matched += 1
+        deltas.append(abs(float(reference['confidence'][i]) - float(candidate['confidence'][j])))
+    return matched, deltas
+
+
+def _run_variant(model, images, conf_threshold, proximity_threshold, runs):
+    """Returns per-image (detections, road priority) and per-inference latencies in ms."""
+    outputs, latencies = [], []
+    for image in images:
+        for _ in range(runs):
+            start = time.perf_counter()
+            detections = model(image, conf=conf_threshold)
+            latencies.append((time.perf_counter() - start) * 1000)
+        score_detections(image, detections)
+        road_priority = determine_road_priority(detections, proximity_threshold, image.shape[:2])[0]
+        outputs.append((detections, road_priority))
+    return outputs, latencies
+
+
+def compare_variants(model_path, variants, image_paths, conf_threshold=0.25, proximity_threshold=150,
+                     iou_threshold=0.5, runs=3, letterbox=LETTERBOX):
+    """
+    Runs every available variant over `image_paths` and reports latency and
+    agreement with the FP32 model: detection precision/recall/F1 (boxes
+    matched at `iou_threshold`), mean confidence drift, and how often the
+    per-pothole and road priorities are unchanged.
+    """
+    images = [img for img in (cv2.imread(p) for p in image_paths) if img is not None]
+    if not images:
+        raise ValueError("No readable images to compare on")
+
+    reference = None
+    report = {}
+    for variant in ['fp32'] + [v for v in variants if v != 'fp32']:
+        path = variant_model_path(model_path, variant)
+        if not os.path.exists(path):
+            logger.warning(f"Skipping {variant}: {path} not found (build it first)")
+            continue
+        # Compare the graphs themselves, not whatever is in the session-optimization cache.
+        model = load_model(path, letterbox=letterbox, cache_optimized=False)
+        model(images[0], conf=conf_threshold)  # warmup
+        outputs, latencies = _run_variant(model, images, conf_threshold, proximity_threshold, runs)
+        if reference is None:
+            reference = outputs
+
+        ref_total = cand_total = matched = priority_same = road_same = 0
+        deltas = []
+        for (ref_det, ref_road), (det, road) in zip(reference, outputs):
+            m, d = match_detections(ref_det, det, iou_threshold)
+            ref_total += len(ref_det)
+            cand_total += len(det)
+            matched += m
+            deltas.extend(d)
+            road_same += ref_road == road
+            if len(ref_det) and len(det):
+                iou = box_iou(ref_det['bbox'], det['bbox'])
+                best = iou.argmax(axis=1)
+                hit = iou[np.arange(len(ref_det)), best] >= iou_threshold
+                priority_same += int(np.count_nonzero(hit & (ref_det['priority'] == det['priority'][best])))
+
+        precision = matched / cand_total if cand_total else 1.0
+        recall = matched / ref_total if ref_total else 1.0
+        report[variant] = {
+            'path': path,
+            'size_mb': round(os.path.getsize(path) / 1e6, 2),
+            'latency_ms_median': round(float(np.median(latencies)), 2),
+            'latency_ms_p95': round(float(np.percentile(latencies, 95)), 2),
+            'detections': cand_total,
+            'precision': round(precision, 4),
+            'recall': round(recall, 4),
+            'f1': round(2 * precision * recall / (precision + recall), 4) if precision + recall else 0.0,
+            'mean_confidence_delta': round(float(np.mean(deltas)), 4) if deltas else 0.0,
+            'pothole_priority_agreement': round(priority_same / ref_total, 4) if ref_total else 1.0,
+            'road_priority_agreement': round(road_same / len(images), 4),
+        }
+    fp32_latency = report['fp32']['latency_ms_median']
+    for row in report.values():
+        row['speedup'] = round(fp32_latency / row['latency_ms_median'], 2) if row['latency_ms_median'] else None
+    return report
+
+
+def print_report(report):
+    print(f"{'variant':>13} {'MB':>7} {'median ms':>10} {'p95 ms':>8} {'speedup':>8} "
+          f"{'precision':>9} {'recall':>7} {'f1':>6} {'conf Δ':>7} {'road prio':>9}")
+    for variant, row in report.items():
+        print(f"{variant:>13} {row['size_mb']:>7.2f} {row['latency_ms_median']:>10.2f} {row['latency_ms_p95']:>8.2f} "
+              f"{row['speedup']:>7.2f}x {row['precision']:>9.3f} {row['recall']:>7.3f} {row['f1']:>6.3f} "
+              f"{row['mean_confidence_delta']:>7.3f} {row['road_priority_agreement']:>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build optimized / INT8 variants of the pothole model and compare them against FP32.")
+    parser.add_argument("command", choices=['build', 'compare'],
+                        help="'build' writes variants next to the model; 'compare' reports accuracy vs. latency.")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL_PATH, help="Path to the FP32 ONNX model.")
+    parser.add_argument("--variants", nargs='+', choices=MODEL_VARIANTS,
+                        default=['optimized', 'int8_dynamic', 'int8_static'], help="Variants to build or compare.")
+    parser.add_argument("--images", type=str, help="Directory of sample images (calibration for 'build', evaluation for 'compare').")
+    parser.add_argument("--max-images", type=int, default=100, help="Use at most this many sample images.")
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold for 'compare'.")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU at which a variant's box matches an FP32 box.")
+    parser.add_argument("--runs", type=int, default=3, help="Timed inferences per image for 'compare'.")
+    parser.add_argument("--report", type=str, help="Optional path to write the 'compare' report as JSON.")
+
+    args = parser.parse_args()
+    sample_images = find_images(args.images)[:args.max_images] if args.images else []
+
+    if args.command == 'build':
+        built = build_variants(args.model, args.variants, sample_images)
+        print(json.dumps(built, indent=2))
+        print("Select a variant with POTHOLE_MODEL_VARIANT=<variant> (or --variant on pothole_detection.py).")
+    else:
+        if not sample_images:
+            parser.error("'compare' needs --images")
+        report = compare_variants(args.model, args.variants, sample_images, conf_threshold=args.conf,
+                                  iou_threshold=args.iou, runs=args.runs)
+        print_report(report)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+        best = min(report, key=lambda v: report[v]['latency_ms_median'])
+        print(f"Fastest: {best} ({report[best]['speedup']}x, F1 {report[best]['f1']} vs fp32, "
+              f"pothole priority agreement {report[best]['pothole_priority_agreement']:.1%})")
@@ -1,11 +1,26 @@
 import os
+import atexit
 import cv2
 import numpy as np
 import logging
 import time
 import json
 import argparse
-from collections import Counter
+import hashlib
+import multiprocessing
+import threading
+import queue
+import sqlite3
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import closing
+
+from pothole_metrics import (DETECTIONS_PER_IMAGE, ERRORS, INPUT_IMAGES, STAGE_SECONDS, resolution_bucket,
+                             stage_timer)
+from pothole_serialization import dumps_str, loads
 
 # --- Configuration ---
 # Ensure uploads directory exists
@@ -22,9 +37,266 @@ logger = logging.getLogger(__name__)
 
 # --- Core Model and Logic Functions ---
 
-def load_model(model_path):
+LETTERBOX = os.getenv('POTHOLE_LETTERBOX', '0') == '1'
+
+# Inference core budget: POTHOLE_INFERENCE_WORKERS processes x POTHOLE_INFERENCE_THREADS
+# intra-op threads within POTHOLE_INFERENCE_CORES (0 = fill in from the other two / all cores).
+# With no workers, inference runs in-process on the MicroBatcher thread.
+INFERENCE_WORKERS = int(os.getenv('POTHOLE_INFERENCE_WORKERS', '0'))
+INFERENCE_THREADS = int(os.getenv('POTHOLE_INFERENCE_THREADS', '0'))
+INFERENCE_CORES = int(os.getenv('POTHOLE_INFERENCE_CORES', '0'))
+
+
+def core_budget(workers=None, intra_op_threads=None, cores=None):
+    """
+    Splits `cores` (default: all) into workers x intra-op threads, filling in
+    whichever of the two is unset so their product stays within the budget.
+    Returns (workers, intra_op_threads).
+    """
+    cores = cores or os.cpu_count() or 1
+    if not workers:
+        workers = max(1, cores // (intra_op_threads or 1))
+    if not intra_op_threads:
+        intra_op_threads = max(1, cores // workers)
+    return workers, intra_op_threads
+
+
+# One record per detected pothole. `priority` indexes PRIORITY_LEVELS / PRIORITY_COLORS.
+DETECTION_DTYPE = np.dtype([
+    ('bbox', np.int32, (4,)),
+    ('confidence', np.float32),
+    ('area_ratio', np.float64),
+    ('depth_score', np.float64),
+    ('priority', np.int8),
+])
+PRIORITY_LEVELS = ('Low', 'Medium', 'High')
+PRIORITY_COLORS = ((0, 255, 0), (0, 165, 255), (0, 0, 255))  # Green, Orange, Red
+LOW, MEDIUM, HIGH = range(3)
+
+
+def empty_detections():
+    return np.empty(0, dtype=DETECTION_DTYPE)
+
+
+class ImageTransform:
+    """
+    Records how an original image was mapped into the model input so that
+    boxes predicted in model space can be mapped back.
+    """
+    __slots__ = ('scale_x', 'scale_y', 'pad_x', 'pad_y', 'width', 'height')
+
+    def __init__(self, scale_x, scale_y, pad_x, pad_y, width, height):
+        self.scale_x = scale_x
+        self.scale_y = scale_y
+        self.pad_x = pad_x
+        self.pad_y = pad_y
+        self.width = width
+        self.height = height
+
+    def to_original(self, boxes):
+        """Maps an (N, 4) array of model-space xyxy boxes to clipped original-image coordinates."""
+        boxes = np.asarray(boxes, dtype=np.float64)
+        out = np.empty_like(boxes)
+        out[:, 0::2] = (boxes[:, 0::2] - self.pad_x) / self.scale_x
+        out[:, 1::2] = (boxes[:, 1::2] - self.pad_y) / self.scale_y
+        np.clip(out[:, 0::2], 0, self.width, out=out[:, 0::2])
+        np.clip(out[:, 1::2], 0, self.height, out=out[:, 1::2])
+        return out
+
+
+class Preprocessor:
+    """
+    Turns BGR images into normalized RGB NCHW float32 model input.
+
+    Resizing writes into a reusable per-thread uint8 canvas, and the
+    BGR->RGB swap, /255 scaling and HWC->CHW transpose happen in a single
+    ufunc pass that writes straight into the (also per-thread, reusable)
+    input batch buffer handed to `session.run`. With `letterbox=True` the
+    aspect ratio is preserved and the remainder is padded, as YOLO expects.
+    """
+
+    def __init__(self, letterbox=LETTERBOX, swap_rb=True, pad_value=114):
+        self.letterbox = letterbox
+        self.swap_rb = swap_rb
+        self.pad_value = pad_value
+        self._local = threading.local()
+
+    def _canvas(self, imgsz):
+        canvases = self._local.__dict__.setdefault('canvases', {})
+        canvas = canvases.get(imgsz)
+        if canvas is None:
+            canvas = canvases[imgsz] = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+        return canvas
+
+    def batch_buffer(self, imgsz, batch_size):
+        """Returns this thread's float32 (batch_size, 3, imgsz, imgsz) input buffer, grown as needed."""
+        buffers = self._local.__dict__.setdefault('batches', {})
+        buf = buffers.get(imgsz)
+        if buf is None or buf.shape[0] < batch_size:
+            buf = buffers[imgsz] = np.empty((batch_size, 3, imgsz, imgsz), dtype=np.float32)
+        return buf[:batch_size]
+
+    def resize(self, img, imgsz=640, canvas=None):
+        """
+        Resizes (or letterboxes) `img` into a uint8 (imgsz, imgsz, 3) canvas.
+        Allocates a new canvas unless one is passed in. Returns (canvas, ImageTransform).
+        """
+        h, w = img.shape[:2]
+        if canvas is None:
+            canvas = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+        if not self.letterbox:
+            cv2.resize(img, (imgsz, imgsz), dst=canvas)
+            return canvas, ImageTransform(imgsz / w, imgsz / h, 0, 0, w, h)
+
+        r = min(imgsz / h, imgsz / w)
+        new_w, new_h = max(1, int(round(w * r))), max(1, int(round(h * r)))
+        pad_x, pad_y = (imgsz - new_w) // 2, (imgsz - new_h) // 2
+        canvas.fill(self.pad_value)
+        cv2.resize(img, (new_w, new_h), dst=canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w])
+        return canvas, ImageTransform(new_w / w, new_h / h, pad_x, pad_y, w, h)
+
+    def normalize_into(self, canvas, out):
+        """Writes `canvas` into the (3, H, W) float32 view `out` as RGB scaled to [0, 1]."""
+        src = canvas[..., ::-1] if self.swap_rb else canvas
+        np.multiply(src.transpose(2, 0, 1), np.float32(1.0 / 255.0), out=out, dtype=np.float32)
+        return out
+
+    def __call__(self, img, imgsz=640, out=None):
+        """
+        Preprocesses one image into `out` (a (3, imgsz, imgsz) float32 view) using
+        this thread's canvas. Returns (out, ImageTransform).
+        """
+        canvas, transform = self.resize(img, imgsz, self._canvas(imgsz))
+        if out is None:
+            out = np.empty((3, imgsz, imgsz), dtype=np.float32)
+        return self.normalize_into(canvas, out), transform
+
+
+class ONNXWrapper:
+    """
+    Wraps an onnxruntime session with the YOLO pre- and post-processing used by
+    `assess_road_image`. Calling the wrapper runs a single image; `predict_batch`
+    runs several images through one `session.run` when the model has a dynamic
+    batch dimension.
+    """
+
+    def __init__(self, session, letterbox=LETTERBOX):
+        self.session = session
+        model_input = session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Exported YOLO models either declare a symbolic batch dim ('batch', None) or a fixed 1.
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        self.preprocessor = Preprocessor(letterbox=letterbox)
+
+    def infer(self, img_batch):
+        """
+        Runs an NCHW float32 batch through the model and returns one raw output
+        row per image. Falls back to one run per image for fixed-batch models.
+        """
+        with stage_timer('inference'):
+            if self.dynamic_batch:
+                return list(self.session.run(None, {self.input_name: img_batch})[0])
+            return [self.session.run(None, {self.input_name: img_batch[i:i + 1]})[0][0] for i in range(len(img_batch))]
+
+    @staticmethod
+    def postprocess(output, transform, conf=0.25, iou_threshold=0.45):
+        """
+        Decodes one raw output row, applies NMS and maps boxes back to the
+        original image. Returns a DETECTION_DTYPE array with `bbox` and
+        `confidence` filled in.
+        """
+        with stage_timer('postprocess'):
+            output_data = output.T
+            valid_detections = output_data[output_data[:, 4] > conf]
+            if len(valid_detections) == 0:
+                return empty_detections()
+
+            cx, cy, bw, bh, scores = valid_detections[:, :5].T
+            x1, y1 = cx - bw / 2, cy - bh / 2
+            # NMSBoxes takes (x, y, w, h) rectangles.
+            indices = cv2.dnn.NMSBoxes(np.stack([x1, y1, bw, bh], axis=1), scores, conf, iou_threshold)
+            if len(indices) == 0:
+                return empty_detections()
+
+            indices = np.asarray(indices).reshape(-1)
+            boxes = np.stack([x1, y1, x1 + bw, y1 + bh], axis=1)[indices]
+
+            detections = np.zeros(len(indices), dtype=DETECTION_DTYPE)
+            detections['bbox'] = transform.to_original(boxes)
+            detections['confidence'] = scores[indices]
+            return detections
+
+    def __call__(self, img, conf=0.25, imgsz=640):
+        img_batch = self.preprocessor.batch_buffer(imgsz, 1)
+        with stage_timer('preprocess'):
+            _, transform = self.preprocessor(img, imgsz, out=img_batch[0])
+        return self.postprocess(self.infer(img_batch)[0], transform, conf)
+
+    def predict_batch(self, images, conf=0.25, imgsz=640, max_batch_size=16):
+        """
+        Runs a list of images through the model in chunks of `max_batch_size`.
+        Returns one DETECTION_DTYPE array per image.
+        """
+        results = []
+        for start in range(0, len(images), max_batch_size):
+            chunk = images[start:start + max_batch_size]
+            img_batch = self.preprocessor.batch_buffer(imgsz, len(chunk))
+            with stage_timer('preprocess'):
+                transforms = [self.preprocessor(img, imgsz, out=img_batch[i])[1] for i, img in enumerate(chunk)]
+            outputs = self.infer(img_batch)
+            results.extend(self.postprocess(out, t, conf) for out, t in zip(outputs, transforms))
+        return results
+
+
+# --- Model Variants ---
+
+# Variants are produced by optimize_pothole_model.py next to the FP32 model,
+# e.g. pothole_detector_v1.int8_dynamic.onnx.
+MODEL_VARIANTS = ('fp32', 'optimized', 'int8_dynamic', 'int8_static')
+MODEL_VARIANT = os.getenv('POTHOLE_MODEL_VARIANT', 'fp32')
+# Where optimized session graphs are cached. They are specific to this host's CPU, so the default is a
+# host-local temp directory rather than next to the (possibly shared or checked-in) model.
+MODEL_CACHE_DIR = os.getenv('POTHOLE_MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pothole_model_cache'))
+
+
+def variant_model_path(model_path, variant):
+    """Returns the file name of `variant` of the FP32 model at `model_path`."""
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant '{variant}', expected one of {MODEL_VARIANTS}")
+    if variant == 'fp32':
+        return model_path
+    stem, ext = os.path.splitext(model_path)
+    return f"{stem}.{variant}{ext}"
+
+
+def resolve_model_path(model_path, variant=MODEL_VARIANT):
+    """Returns the path of the configured variant, falling back to `model_path` if it was never built."""
+    path = variant_model_path(model_path, variant)
+    if path != model_path and not os.path.exists(path):
+        logger.warning(f"Model variant '{variant}' not found at {path}, using {model_path}")
+        return model_path
+    return path
+
+
+def optimized_cache_path(model_path, sha256):
+    """
+    Path of the session-optimized graph cached for the model at `model_path`
+    whose content hash is `sha256`. The graph contains optimizations specific
+    to this onnxruntime version and CPU, so both the content hash and the
+    version are part of the name, and the cache stays host-local.
+    """
+    import onnxruntime as ort
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(MODEL_CACHE_DIR, f"{stem}.{sha256[:16]}.ort-{ort.__version__}.opt.onnx")
+
+
+def load_model(model_path, letterbox=LETTERBOX, intra_op_threads=None, cache_optimized=True, sha256=None):
     """
     Loads the YOLO ONNX model and wraps it for consistent inference.
+    `intra_op_threads` caps onnxruntime's thread pool (default: one thread per core).
+    With `cache_optimized`, the first load serializes the fully optimized graph
+    and later loads of the same model content use it with graph optimization
+    turned off. `sha256` is the model file's digest if the caller already has it.
     """
     try:
         if not os.path.exists(model_path):
@@ -34,69 +306,673 @@ def load_model(model_path):
         import onnxruntime as ort
 
         providers = ['CPUExecutionProvider']
-        session = ort.InferenceSession(model_path, providers=providers)
-
-        class ONNXWrapper:
-            def __init__(self, session):
-                self.session = session
-
-            def __call__(self, img, conf=0.25, imgsz=640):
-                h_orig, w_orig = img.shape[:2]
-                img_resized = cv2.resize(img, (imgsz, imgsz))
-                img_normalized = img_resized.transpose(2, 0, 1).astype('float32') / 255.0
-                img_batch = np.expand_dims(img_normalized, axis=0)
+        sess_options = ort.SessionOptions()
+        if intra_op_threads:
+            sess_options.intra_op_num_threads = intra_op_threads
+            sess_options.inter_op_num_threads = 1
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
 
-                outputs = self.session.run(None, {'images': img_batch})
-                
-                output_data = outputs[0][0].T
-                
-                valid_detections = output_data[output_data[:, 4] > conf]
-                if len(valid_detections) == 0:
-                    return [type('obj', (object,), {'boxes': type('obj', (object,), {'xyxy': [], 'conf': []})()})()]
-                
-                box_coords = valid_detections[:, :4]
-                scores = valid_detections[:, 4]
-
-                x1 = box_coords[:, 0] - box_coords[:, 2] / 2
-                y1 = box_coords[:, 1] - box_coords[:, 3] / 2
-                x2 = box_coords[:, 0] + box_coords[:, 2] / 2
-                y2 = box_coords[:, 1] + box_coords[:, 3] / 2
-                boxes_for_nms = np.stack([x1, y1, x2, y2], axis=1)
-
-                indices = cv2.dnn.NMSBoxes(boxes_for_nms.tolist(), scores.tolist(), conf, 0.45)
-                if len(indices) == 0:
-                    return [type('obj', (object,), {'boxes': type('obj', (object,), {'xyxy': [], 'conf': []})()})()]
-
-                indices = indices.flatten()
-                final_boxes_normalized = boxes_for_nms[indices]
-                final_scores = scores[indices]
-
-                w_scale, h_scale = w_orig / imgsz, h_orig / imgsz
-                final_boxes_scaled = []
-                for box in final_boxes_normalized:
-                    final_boxes_scaled.append([
-                        int(box[0] * w_scale), int(box[1] * h_scale),
-                        int(box[2] * w_scale), int(box[3] * h_scale)
-                    ])
-                
-                class MockBoxes:
-                    def __init__(self, boxes, confs):
-                        self.xyxy = np.array(boxes)
-                        self.conf = np.array(confs)
-
-                class MockResult:
-                    def __init__(self, boxes, confs):
-                        self.boxes = MockBoxes(boxes, confs)
-                
-                return [MockResult(final_boxes_scaled, final_scores)]
+        session = None
+        if cache_optimized:
+            cache_path = optimized_cache_path(model_path, sha256 or _file_sha256(model_path))
+            if os.path.exists(cache_path):
+                sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                try:
+                    session = ort.InferenceSession(cache_path, sess_options=sess_options, providers=providers)
+                    logger.info(f"Using cached optimized graph {cache_path}")
+                except Exception as e:
+                    logger.warning(f"Cached optimized graph {cache_path} unusable, rebuilding: {e}")
+                    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if session is None:
+                # Written under a per-process name and renamed, so parallel loads never see a partial file.
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                try:
+                    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+                    sess_options.optimized_model_filepath = tmp_path
+                except OSError as e:
+                    logger.warning(f"Could not create model cache directory {MODEL_CACHE_DIR}: {e}")
+                session = ort.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+                try:
+                    os.replace(tmp_path, cache_path)
+                except OSError as e:
+                    logger.warning(f"Could not cache optimized graph at {cache_path}: {e}")
+        else:
+            session = ort.InferenceSession(model_path, sess_options=sess_options, providers=providers)
 
-        model = ONNXWrapper(session)
+        model = ONNXWrapper(session, letterbox=letterbox)
         logger.info("ONNX model loaded successfully.")
         return model
     except Exception as e:
         logger.error(f"Failed to load ONNX model: {e}", exc_info=True)
         raise
 
+
+# --- Model Registry ---
+
+def _file_sha256(path, chunk_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _ModelEntry:
+    """A loaded model plus the file fingerprint it was loaded from."""
+    __slots__ = ('model', 'mtime', 'size', 'sha256', 'last_check', 'reload_lock')
+
+    def __init__(self, model, mtime, size, sha256):
+        self.model = model
+        self.mtime = mtime
+        self.size = size
+        self.sha256 = sha256
+        self.last_check = time.monotonic()
+        self.reload_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded ONNX models, keyed by absolute model path.
+    Requested paths are mapped to the configured `variant` (see
+    `resolve_model_path`), and the variant file is what gets watched.
+
+    Each model is loaded and warmed up once. On access the model file is
+    re-checked at most every `check_interval` seconds; if its mtime or size
+    changed and its SHA-256 differs, the request that noticed builds and warms
+    up a new session while other threads keep using the old one, then swaps it
+    in with a single reference assignment.
+    """
+
+    def __init__(self, warmup_runs=2, check_interval=5.0, warmup_size=640, variant=MODEL_VARIANT,
+                 intra_op_threads=None):
+        self.warmup_runs = warmup_runs
+        self.check_interval = check_interval
+        self.warmup_size = warmup_size
+        self.variant = variant
+        self.intra_op_threads = intra_op_threads
+        self._entries = {}
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def _load_entry(self, path):
+        stat = os.stat(path)
+        sha256 = _file_sha256(path)
+        model = load_model(path, intra_op_threads=self.intra_op_threads, sha256=sha256)
+        self._warmup(model)
+        return _ModelEntry(model, stat.st_mtime, stat.st_size, sha256)
+
+    def _warmup(self, model):
+        """Runs a few throwaway inferences so the first real request is not the slow one."""
+        if self.warmup_runs <= 0:
+            return
+        dummy = np.zeros((self.warmup_size, self.warmup_size, 3), dtype=np.uint8)
+        start = time.perf_counter()
+        for _ in range(self.warmup_runs):
+            model(dummy)
+        logger.info(f"Model warmup ({self.warmup_runs} runs) took {time.perf_counter() - start:.3f}s")
+
+    def _resolve(self, model_path):
+        path = self._resolved.get(model_path)
+        if path is None:
+            path = os.path.abspath(resolve_model_path(model_path, self.variant))
+            self._resolved[model_path] = path
+        return path
+
+    def get(self, model_path):
+        """Returns the loaded model for `model_path`, loading or hot-reloading it if needed."""
+        path = self._resolve(model_path)
+        entry = self._entries.get(path)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is None:
+                    entry = self._load_entry(path)
+                    self._entries[path] = entry
+            return entry.model
+
+        if time.monotonic() - entry.last_check >= self.check_interval:
+            self._maybe_reload(path, entry)
+        return self._entries[path].model
+
+    def _maybe_reload(self, path, entry):
+        # Only one thread checks/reloads a given model; the rest keep serving the current session.
+        if not entry.reload_lock.acquire(blocking=False):
+            return
+        try:
+            entry.last_check = time.monotonic()
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logger.warning(f"Model file {path} unavailable, keeping loaded session: {e}")
+                return
+            if stat.st_mtime == entry.mtime and stat.st_size == entry.size:
+                return
+
+            sha256 = _file_sha256(path)
+            if sha256 == entry.sha256:
+                entry.mtime, entry.size = stat.st_mtime, stat.st_size
+                return
+
+            logger.info(f"Model file {path} changed, reloading")
+            try:
+                new_entry = self._load_entry(path)
+            except Exception as e:
+                logger.error(f"Hot reload of {path} failed, keeping previous session: {e}")
+                return
+            with self._lock:
+                self._entries[path] = new_entry
+            logger.info(f"Model {path} hot-swapped (sha256 {sha256[:12]})")
+        finally:
+            entry.reload_lock.release()
+
+    def preload(self, model_paths):
+        """Loads and warms up models ahead of the first request, e.g. at application startup."""
+        for model_path in model_paths:
+            self.get(model_path)
+
+    def fingerprint(self, model_path):
+        """Returns the SHA-256 of the currently loaded version of `model_path`, or None."""
+        entry = self._entries.get(self._resolve(model_path))
+        return entry.sha256 if entry else None
+
+
+DEFAULT_MODEL_PATH = "pothole_detector_v1.onnx"
+# In-process sessions get the whole inference budget (the batcher runs one session.run at a time).
+model_registry = ModelRegistry(intra_op_threads=INFERENCE_THREADS or INFERENCE_CORES or None)
+
+
+def get_model(model_path=DEFAULT_MODEL_PATH):
+    """Returns the shared, warmed-up model for `model_path` from the process-wide registry."""
+    return model_registry.get(model_path)
+
+
+# --- Micro-batching ---
+
+BATCH_WINDOW_MS = float(os.getenv('POTHOLE_BATCH_WINDOW_MS', '10'))
+BATCH_MAX_SIZE = int(os.getenv('POTHOLE_BATCH_MAX_SIZE', '8'))
+
+
+class MicroBatcher:
+    """
+    Collects concurrent inference requests for up to `window_ms` (or until
+    `max_batch_size` are waiting), runs them through a single `session.run`
+    and hands each caller back its own result.
+
+    Resizing and post-processing run on the calling threads; the worker thread
+    normalizes each resized canvas straight into its reusable batch buffer and
+    runs the stacked `session.run`. The model is
+    looked up in the registry per batch, so hot reloads apply here too.
+    Exposes the same `__call__`/`predict_batch` interface as `ONNXWrapper`.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, registry=None,
+                 max_batch_size=BATCH_MAX_SIZE, window_ms=BATCH_WINDOW_MS):
+        self.model_path = model_path
+        self.registry = registry or model_registry
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._worker, name='pothole-batcher', daemon=True)
+                    self._thread.start()
+
+    def submit(self, img, imgsz=640):
+        """
+        Queues one image and returns a Future resolving to (raw model output row,
+        ImageTransform).
+        """
+        self._ensure_started()
+        future = Future()
+        # The canvas must outlive this call, so it is not taken from the thread-local pool.
+        with stage_timer('preprocess'):
+            canvas, transform = self.registry.get(self.model_path).preprocessor.resize(img, imgsz)
+        self._queue.put((canvas, transform, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            # Canvases of different input sizes cannot share one NCHW batch.
+            by_size = {}
+            for item in batch:
+                by_size.setdefault(item[0].shape[0], []).append(item)
+            for imgsz, items in by_size.items():
+                try:
+                    model = self.registry.get(self.model_path)
+                    img_batch = model.preprocessor.batch_buffer(imgsz, len(items))
+                    with stage_timer('normalize'):
+                        for i, (canvas, _, _) in enumerate(items):
+                            model.preprocessor.normalize_into(canvas, img_batch[i])
+                    outputs = model.infer(img_batch)
+                except Exception as e:
+                    ERRORS.inc(stage='inference')
+                    for _, _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, transform, future), output in zip(items, outputs):
+                    future.set_result((output, transform))
+
+    def __call__(self, img, conf=0.25, imgsz=640):
+        output, transform = self.submit(img, imgsz).result()
+        return ONNXWrapper.postprocess(output, transform, conf)
+
+    def predict_batch(self, images, conf=0.25, imgsz=640):
+        futures = [self.submit(img, imgsz) for img in images]
+        return [ONNXWrapper.postprocess(*f.result(), conf) for f in futures]
+
+    def preload(self):
+        self.registry.preload([self.model_path])
+
+    def fingerprint(self):
+        """SHA-256 of the model version that serves requests, loading it if needed."""
+        self.registry.get(self.model_path)
+        return self.registry.fingerprint(self.model_path)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(model_path=DEFAULT_MODEL_PATH):
+    """Returns the process-wide MicroBatcher for `model_path`."""
+    batcher = _batchers.get(model_path)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = _batchers.setdefault(model_path, MicroBatcher(model_path))
+    return batcher
+
+
+# --- Process Inference Executor ---
+
+def _inference_worker(model_path, letterbox, intra_op_threads, max_batch_size, tasks, results):
+    """
+    Body of an InferenceExecutor process: normalizes canvases straight out of
+    shared memory into its input batch, runs whatever is queued (up to
+    `max_batch_size`) through one session.run and sends back post-processed
+    detections. A None task makes it exit once earlier tasks are done.
+    """
+    cv2.setNumThreads(1)
+    model = load_model(model_path, letterbox=letterbox, intra_op_threads=intra_op_threads)
+    results.put(('ready', os.getpid()))
+    blocks = {}
+    while True:
+        batch = [tasks.get()]
+        while batch[-1] is not None and len(batch) < max_batch_size:
+            try:
+                batch.append(tasks.get_nowait())
+            except queue.Empty:
+                break
+        by_size = {}
+        for task in batch:
+            if task is not None:
+                by_size.setdefault(task[2], []).append(task)
+        for imgsz, items in by_size.items():
+            try:
+                img_batch = model.preprocessor.batch_buffer(imgsz, len(items))
+                for i, (_, block_name, _, _, _) in enumerate(items):
+                    block = blocks.get(block_name)
+                    if block is None:
+                        block = blocks[block_name] = shared_memory.SharedMemory(name=block_name)
+                    canvas = np.ndarray((imgsz, imgsz, 3), dtype=np.uint8, buffer=block.buf)
+                    model.preprocessor.normalize_into(canvas, img_batch[i])
+                start = time.perf_counter()
+                outputs = model.infer(img_batch)
+                elapsed = time.perf_counter() - start
+                for (request_id, _, _, transform, conf), output in zip(items, outputs):
+                    results.put(('result', request_id, ONNXWrapper.postprocess(output, transform, conf), None, elapsed))
+                    elapsed = None  # reported once per session.run
+            except Exception as e:
+                for request_id, *_ in items:
+                    results.put(('result', request_id, None, f"{type(e).__name__}: {e}", None))
+        if batch[-1] is None:
+            return
+
+
+class _InferenceWorker:
+    """One executor process, its task queue and the request ids it has not answered yet."""
+    __slots__ = ('generation', 'process', 'tasks', 'pending', 'ready', 'retiring', 'restart_at')
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.process = None
+        self.tasks = None
+        self.pending = set()
+        self.ready = threading.Event()
+        self.retiring = False
+        self.restart_at = 0.0
+
+
+class InferenceExecutor:
+    """
+    Runs inference in `workers` processes with `intra_op_threads` onnxruntime
+    threads each, sized by `core_budget` so request threads never call
+    session.run themselves and the total thread count stays within `cores`.
+
+    Callers resize images into shared-memory canvases that workers normalize
+    in place, so pixels are never pickled; only the small post-processed
+    detection arrays come back. Each request goes to the least loaded worker,
+    which micro-batches whatever is queued to it. A worker that dies fails
+    only its in-flight requests (RuntimeError) and is restarted with backoff.
+    A changed model file is rolled out by starting a new set of workers and
+    retiring the old ones as the new ones become ready.
+    Exposes the same `__call__`/`predict_batch` interface as `ONNXWrapper`.
+    """
+
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, workers=INFERENCE_WORKERS, intra_op_threads=INFERENCE_THREADS,
+                 cores=INFERENCE_CORES, letterbox=LETTERBOX, max_batch_size=BATCH_MAX_SIZE, max_inflight=None,
+                 check_interval=5.0, variant=MODEL_VARIANT):
+        self.model_path = os.path.abspath(resolve_model_path(model_path, variant))
+        self.workers, self.intra_op_threads = core_budget(workers, intra_op_threads, cores)
+        self.letterbox = letterbox
+        self.max_batch_size = max_batch_size
+        self.check_interval = check_interval
+        self.preprocessor = Preprocessor(letterbox)
+        # Bounds the shared-memory canvases in use; submit blocks beyond it.
+        self._slots = threading.BoundedSemaphore(max_inflight or self.workers * max_batch_size * 2)
+        self._context = multiprocessing.get_context()
+        self._results = None
+        self._handles = []
+        self._pending = {}  # request id -> (worker, future, block, nbytes)
+        self._blocks = []
+        self._free_blocks = {}  # nbytes -> [SharedMemory]
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._generation = 0
+        self._restart_failures = 0
+        self._sha256 = None
+        self._stat = None
+        self._collector = None
+        self._closed = False
+
+    def _ensure_started(self):
+        if self._collector is not None:
+            return
+        with self._lock:
+            if self._collector is not None:
+                return
+            if self._closed:
+                raise RuntimeError("Inference executor is closed")
+            self._stat = os.stat(self.model_path)
+            self._sha256 = _file_sha256(self.model_path)
+            # Workers inherit the tracker, so attaching a block there does not unlink it when they exit.
+            resource_tracker.ensure_running()
+            self._results = self._context.Queue()
+            self._handles = [self._spawn(_InferenceWorker(0)) for _ in range(self.workers)]
+            self._collector = threading.Thread(target=self._collect, name='pothole-inference-collector', daemon=True)
+            self._collector.start()
+            atexit.register(self.close)
+        logger.info(f"Inference executor: {self.workers} workers x {self.intra_op_threads} threads "
+                    f"for {self.model_path}")
+
+    def _spawn(self, handle):
+        handle.tasks = self._context.Queue()
+        handle.ready.clear()
+        handle.process = self._context.Process(
+            target=_inference_worker, name=f'pothole-inference-{handle.generation}', daemon=True,
+            args=(self.model_path, self.letterbox, self.intra_op_threads, self.max_batch_size,
+                  handle.tasks, self._results))
+        handle.process.start()
+        return handle
+
+    def _acquire_block(self, nbytes):
+        with self._lock:
+            free = self._free_blocks.get(nbytes)
+            if free:
+                return free.pop()
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        with self._lock:
+            self._blocks.append(block)
+        return block
+
+    def _release(self, request_id):
+        """Frees a request's canvas and slot; returns its Future, or None if it was already settled."""
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+            if entry is None:
+                return None
+            handle, future, block, nbytes = entry
+            handle.pending.discard(request_id)
+            self._free_blocks.setdefault(nbytes, []).append(block)
+        self._slots.release()
+        return future
+
+    def submit(self, img, imgsz=640, conf=0.25):
+        """Queues one image and returns a Future resolving to its DETECTION_DTYPE array."""
+        self._ensure_started()
+        nbytes = imgsz * imgsz * 3
+        self._slots.acquire()
+        block = None
+        try:
+            block = self._acquire_block(nbytes)
+            canvas = np.ndarray((imgsz, imgsz, 3), dtype=np.uint8, buffer=block.buf)
+            with stage_timer('preprocess'):
+                _, transform = self.preprocessor.resize(img, imgsz, canvas)
+            del canvas
+            future = Future()
+            with self._lock:
+                live = [h for h in self._handles if h.process is not None and not h.retiring]
+                handle = min([h for h in live if h.ready.is_set()] or live, key=lambda h: len(h.pending), default=None)
+                if handle is None:
+                    raise RuntimeError("No inference worker is available")
+                request_id = self._next_id
+                self._next_id += 1
+                # Registered before queuing, so the answer always finds its Future.
+                self._pending[request_id] = (handle, future, block, nbytes)
+                handle.pending.add(request_id)
+                try:
+                    handle.tasks.put((request_id, block.name, imgsz, transform, conf))
+                except Exception:
+                    del self._pending[request_id]
+                    handle.pending.discard(request_id)
+                    raise
+            return future
+        except Exception:
+            if block is not None:
+                with self._lock:
+                    self._free_blocks.setdefault(nbytes, []).append(block)
+            self._slots.release()
+            raise
+
+    def __call__(self, img, conf=0.25, imgsz=640):
+        return self.submit(img, imgsz, conf).result()
+
+    def predict_batch(self, images, conf=0.25, imgsz=640):
+        futures = [self.submit(img, imgsz, conf) for img in images]
+        return [f.result() for f in futures]
+
+    def preload(self, timeout=120.0):
+        """Starts the workers and waits until each has loaded its model."""
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        for handle in list(self._handles):
+            if not handle.ready.wait(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError(f"Inference worker not ready after {timeout:.0f}s")
+
+    def fingerprint(self):
+        """SHA-256 of the model file the workers serve."""
+        self._ensure_started()
+        return self._sha256
+
+    # Collector thread
+
+    def _collect(self):
+        last_check = last_reload_check = time.monotonic()
+        while not self._closed:
+            try:
+                self._handle_message(self._results.get(timeout=0.2))
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error(f"Inference executor failed to handle a worker message: {e}", exc_info=True)
+            now = time.monotonic()
+            if now - last_check >= 0.2:
+                last_check = now
+                self._check_workers(now)
+            if now - last_reload_check >= self.check_interval:
+                last_reload_check = now
+                self._maybe_reload()
+
+    def _handle_message(self, message):
+        if message[0] == 'ready':
+            self._worker_ready(message[1])
+            return
+        _, request_id, detections, error, seconds = message
+        if seconds is not None:
+            STAGE_SECONDS.observe(seconds, stage='inference')
+        future = self._release(request_id)
+        if future is None:
+            return
+        if error is not None:
+            ERRORS.inc(stage='inference')
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(detections)
+
+    def _worker_ready(self, pid):
+        with self._lock:
+            handle = next((h for h in self._handles if h.process is not None and h.process.pid == pid), None)
+            if handle is None:
+                return
+            handle.ready.set()
+            self._restart_failures = 0
+            if handle.generation != self._generation:
+                return
+            # One old worker retires for each new one that can take over.
+            old = next((h for h in self._handles if h.generation < handle.generation and not h.retiring), None)
+            if old is not None:
+                old.retiring = True
+                if old.process is not None:
+                    old.tasks.put(None)
+                else:
+                    self._handles.remove(old)  # was waiting to be restarted
+                if all(h.ready.is_set() for h in self._handles if h.generation == self._generation):
+                    logger.info(f"Inference workers now serving model sha256 {self._sha256[:12]}")
+
+    def _check_workers(self, now):
+        for handle in list(self._handles):
+            process = handle.process
+            if process is None:
+                if now >= handle.restart_at and not self._closed:
+                    with self._lock:
+                        if not handle.retiring:
+                            self._spawn(handle)
+                continue
+            if process.is_alive():
+                continue
+            # Answers sent before the worker exited are already in the pipe.
+            while True:
+                try:
+                    self._handle_message(self._results.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                handle.process = None
+                handle.tasks.cancel_join_thread()
+                handle.tasks.close()
+                lost = list(handle.pending)
+                if handle.retiring:
+                    self._handles.remove(handle)
+            for request_id in lost:
+                future = self._release(request_id)
+                if future is not None:
+                    future.set_exception(RuntimeError(
+                        f"Inference worker {process.pid} exited with code {process.exitcode}"))
+            if handle.retiring:
+                continue
+            ERRORS.inc(stage='inference_worker')
+            delay = min(30.0, 0.5 * 2 ** self._restart_failures)
+            self._restart_failures += 1
+            handle.restart_at = now + delay
+            logger.error(f"Inference worker {process.pid} died (exit code {process.exitcode}), "
+                         f"failed {len(lost)} in-flight requests; restarting in {delay:.1f}s")
+
+    def _maybe_reload(self):
+        try:
+            stat = os.stat(self.model_path)
+        except OSError as e:
+            logger.warning(f"Model file {self.model_path} unavailable, keeping inference workers: {e}")
+            return
+        if stat.st_mtime == self._stat.st_mtime and stat.st_size == self._stat.st_size:
+            return
+        self._stat = stat
+        sha256 = _file_sha256(self.model_path)
+        if sha256 == self._sha256:
+            return
+        logger.info(f"Model file {self.model_path} changed, starting new inference workers")
+        with self._lock:
+            self._sha256 = sha256
+            self._generation += 1
+            self._handles.extend(self._spawn(_InferenceWorker(self._generation)) for _ in range(self.workers))
+
+    def close(self, timeout=5.0):
+        """Stops the workers after their queued requests and frees the shared memory."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            handles = list(self._handles)
+        if self._collector is not None:
+            self._collector.join(timeout)
+        for handle in handles:
+            if handle.process is not None:
+                handle.tasks.put(None)
+        for handle in handles:
+            if handle.process is not None:
+                handle.process.join(timeout)
+                if handle.process.is_alive():
+                    handle.process.terminate()
+        for request_id in list(self._pending):
+            future = self._release(request_id)
+            if future is not None:
+                future.set_exception(RuntimeError("Inference executor closed"))
+        for block in self._blocks:
+            try:
+                block.close()
+                block.unlink()
+            except (BufferError, OSError):
+                pass
+
+
+_executors = {}
+
+
+def get_detector(model_path=DEFAULT_MODEL_PATH):
+    """
+    Returns the process-wide inference frontend for `model_path`: an
+    InferenceExecutor when POTHOLE_INFERENCE_WORKERS is set, else the
+    in-process MicroBatcher.
+    """
+    if INFERENCE_WORKERS <= 0:
+        return get_batcher(model_path)
+    executor = _executors.get(model_path)
+    if executor is None:
+        with _batchers_lock:
+            executor = _executors.get(model_path)
+            if executor is None:
+                executor = _executors[model_path] = InferenceExecutor(model_path)
+    return executor
+
+
 def estimate_pothole_depth(image, contour):
     """
     Estimates pothole depth score (0-1) based on shadow analysis.
@@ -116,6 +992,57 @@ def estimate_pothole_depth(image, contour):
         logger.warning(f"Could not estimate depth: {e}")
         return 0.0
 
+class DepthScorer:
+    """
+    Scores pothole depth for many axis-aligned boxes on one image.
+
+    The image is converted to grayscale once and integral images of intensity
+    and squared intensity are built, so each box's mean and standard deviation
+    (and hence its depth score) cost O(1) regardless of box size. Scores match
+    `estimate_pothole_depth` on the equivalent rectangular contour.
+    """
+
+    def __init__(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        self.height, self.width = gray.shape[:2]
+        self.sum, self.sqsum = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    def score_boxes(self, bboxes):
+        """Returns a float64 depth score (0-1) per row of an (N, 4) xyxy box array."""
+        bboxes = np.asarray(bboxes).reshape(-1, 4)
+        if len(bboxes) == 0:
+            return np.zeros(0, dtype=np.float64)
+        # A filled rectangle contour covers both edge rows/columns, hence the +1.
+        x1 = np.clip(np.minimum(bboxes[:, 0], bboxes[:, 2]), 0, self.width)
+        x2 = np.clip(np.maximum(bboxes[:, 0], bboxes[:, 2]) + 1, 0, self.width)
+        y1 = np.clip(np.minimum(bboxes[:, 1], bboxes[:, 3]), 0, self.height)
+        y2 = np.clip(np.maximum(bboxes[:, 1], bboxes[:, 3]) + 1, 0, self.height)
+        count = ((x2 - x1) * (y2 - y1)).astype(np.float64)
+
+        def box_sum(table):
+            return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+        valid = count > 0
+        n = np.where(valid, count, 1.0)
+        mean = box_sum(self.sum) / n
+        std = np.sqrt(np.maximum(box_sum(self.sqsum) / n - mean * mean, 0.0))
+
+        darkness_score = 1 - (mean / 255.0)
+        contrast_score = np.where(count > 1, np.minimum(std / 50.0, 1.0), 0.0)
+        scores = np.clip((0.7 * darkness_score) + (0.3 * contrast_score), 0.0, 1.0)
+        return np.where(valid, scores, 0.0)
+
+
+def estimate_pothole_depths(image, bboxes):
+    """Batched depth scores (0-1) for an (N, 4) array of xyxy boxes on one image."""
+    if len(bboxes) == 0:
+        return np.zeros(0, dtype=np.float64)
+    try:
+        return DepthScorer(image).score_boxes(bboxes)
+    except Exception as e:
+        logger.warning(f"Could not estimate depths: {e}")
+        return np.zeros(len(bboxes), dtype=np.float64)
+
 def get_individual_pothole_priority(area_ratio, depth_score):
     """
     Determines an individual pothole's priority ('High', 'Medium', 'Low').
@@ -128,31 +1055,79 @@ def get_individual_pothole_priority(area_ratio, depth_score):
     else:
         return 'Low', (0, 255, 0)  # Green
 
-def determine_road_priority(potholes_list, proximity_threshold, image_shape):
+def assign_priorities(area_ratio, depth_score):
+    """
+    Vectorized `get_individual_pothole_priority`: returns an int8 array of
+    LOW/MEDIUM/HIGH codes for arrays of area ratios and depth scores.
+    """
+    combined_score = (0.6 * area_ratio * 100) + (0.4 * depth_score)
+    high = (combined_score > 0.6) | ((area_ratio > 0.01) & (depth_score > 0.6))
+    medium = (combined_score > 0.3) | ((area_ratio > 0.005) & (depth_score > 0.4))
+    return np.select([high, medium], [HIGH, MEDIUM], LOW).astype(np.int8)
+
+def box_centers(bboxes):
+    """Integer (x, y) centers of an (N, 4) xyxy box array."""
+    return np.stack([(bboxes[:, 0] + bboxes[:, 2]) // 2, (bboxes[:, 1] + bboxes[:, 3]) // 2], axis=1)
+
+def cluster_potholes(positions, proximity_threshold):
+    """
+    Groups pothole centers into clusters.
+
+    Points are taken in index order; each point not yet clustered seeds a new
+    cluster containing itself plus every remaining point closer than
+    `proximity_threshold` to the seed. Neighbours are found through a uniform
+    grid hash with cell size `proximity_threshold`, so only the 3x3 block of
+    cells around a seed is searched and cost scales with local density rather
+    than the total number of detections.
+    Returns a list of index lists.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    n = len(positions)
+    if n == 0:
+        return []
+    if not proximity_threshold > 0:
+        return [[i] for i in range(n)]
+
+    cells = np.floor_divide(positions, proximity_threshold).astype(np.int64)
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)])
+    ends = np.r_[starts[1:], n]
+    grid = {(int(sorted_cells[s][0]), int(sorted_cells[s][1])): np.sort(order[s:e]) for s, e in zip(starts, ends)}
+
+    processed = np.zeros(n, dtype=bool)
+    clusters = []
+    for i in range(n):
+        if processed[i]:
+            continue
+        processed[i] = True
+        cx, cy = cells[i]
+        candidates = [grid[key] for key in ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)) if key in grid]
+        candidates = np.concatenate(candidates)
+        candidates = candidates[~processed[candidates]]
+        if len(candidates):
+            diff = positions[candidates] - positions[i]
+            members = np.sort(candidates[np.sqrt(np.einsum('ij,ij->i', diff, diff)) < proximity_threshold])
+            processed[members] = True
+            clusters.append([i] + members.tolist())
+        else:
+            clusters.append([i])
+    return clusters
+
+def determine_road_priority(detections, proximity_threshold, image_shape):
     """
     Determines the overall road priority based on all detected potholes.
+    `detections` is a DETECTION_DTYPE array with priorities assigned.
     """
-    if not potholes_list:
+    if len(detections) == 0:
         return 'Low', (0, 255, 0), []
     
-    high_count = sum(1 for p in potholes_list if p['priority'] == 'High')
-    medium_count = sum(1 for p in potholes_list if p['priority'] == 'Medium')
+    high_count = int(np.count_nonzero(detections['priority'] == HIGH))
+    medium_count = int(np.count_nonzero(detections['priority'] == MEDIUM))
     
-    clusters, processed = [], set()
-    for i, p1 in enumerate(potholes_list):
-        if i in processed: continue
-        cluster, q = [i], [i]
-        processed.add(i)
-        while q:
-            curr = q.pop(0)
-            for j, p2 in enumerate(potholes_list):
-                if j not in processed and np.linalg.norm(np.array(p1['position']) - np.array(p2['position'])) < proximity_threshold:
-                    processed.add(j)
-                    cluster.append(j)
-                    q.append(j)
-        clusters.append(cluster)
+    clusters = cluster_potholes(box_centers(detections['bbox']), proximity_threshold)
     
-    total_area_ratio = sum(p['area_ratio'] for p in potholes_list)
+    total_area_ratio = float(detections['area_ratio'].sum())
     
     if (high_count >= 2 or (high_count >= 1 and medium_count >= 2) or
         total_area_ratio > 0.05 or len([c for c in clusters if len(c) >= 3]) > 0):
@@ -166,75 +1141,1072 @@ def determine_road_priority(potholes_list, proximity_threshold, image_shape):
 
 # --- Main Assessment Function for Images ---
 
-def assess_road_image(image_path, model, conf_threshold=0.25, proximity_threshold=150):
+# (factor, flag) pairs for libjpeg's DCT-domain downscaling, largest first.
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def encoded_image_size(image_bytes):
+    """Returns (width, height) from the image header without decoding pixels, or None if unknown."""
+    try:
+        from PIL import Image
+        import io
+        return Image.open(io.BytesIO(image_bytes)).size
+    except Exception:
+        return None
+
+
+def decode_image(image_bytes, min_short_side=None):
     """
-    Assesses a single image, returning a JSON report and an annotated image.
+    Decodes encoded image bytes to BGR. With `min_short_side`, JPEGs are
+    decoded at the largest 1/2, 1/4 or 1/8 reduction whose shorter side stays
+    at least that long, which skips most of the IDCT work and memory for
+    photos far larger than the model input.
+    Returns (image, (width, height) of the full-resolution image).
     """
+    with stage_timer('decode'):
+        size = encoded_image_size(image_bytes) if min_short_side else None
+        flag = cv2.IMREAD_COLOR
+        if size:
+            for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+                if min(size) // factor >= min_short_side:
+                    flag = reduced_flag
+                    break
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    if image is None:
+        ERRORS.inc(stage='decode')
+        raise ValueError("Could not decode image bytes")
+    if flag == cv2.IMREAD_COLOR:
+        INPUT_IMAGES.inc(resolution=resolution_bucket(image.shape[1], image.shape[0]))
+        return image, (image.shape[1], image.shape[0])
+    width, height = size
+    INPUT_IMAGES.inc(resolution=resolution_bucket(width, height))
+    # The header size is before EXIF rotation, imdecode's output is after it.
+    if (image.shape[1] > image.shape[0]) != (width > height):
+        width, height = height, width
+    return image, (width, height)
+
+
+def rescale_assessment(assessment, image_size):
+    """Maps pothole boxes of an assessment made on a downscaled decode back to `image_size` pixels, in place."""
+    src_w, src_h = assessment['image_size']
+    width, height = image_size
+    if (src_w, src_h) == (width, height):
+        return assessment
+    sx, sy = width / src_w, height / src_h
+    for pothole in assessment['potholes']:
+        x1, y1, x2, y2 = pothole['bbox']
+        pothole['bbox'] = [min(int(x1 * sx), width), min(int(y1 * sy), height),
+                           min(int(x2 * sx), width), min(int(y2 * sy), height)]
+    assessment['image_size'] = [width, height]
+    return assessment
+
+
+def _read_image(image_path):
     if isinstance(image_path, str):
-        image = cv2.imread(image_path)
+        with stage_timer('decode'):
+            image = cv2.imread(image_path)
         if image is None:
+            ERRORS.inc(stage='decode')
             raise ValueError(f"Could not read image: {image_path}")
-    else: # Assumes image_path is a numpy array
-        image = image_path
+        INPUT_IMAGES.inc(resolution=resolution_bucket(image.shape[1], image.shape[0]))
+        return image
+    return image_path  # Assumes image_path is a numpy array
 
-    annotated_image = image.copy()
+
+def score_detections(image, detections):
+    """Fills in `area_ratio`, `depth_score` and `priority` of a DETECTION_DTYPE array in place."""
+    if len(detections) == 0:
+        return detections
+    h, w = image.shape[:2]
+    bboxes = detections['bbox']
+    detections['area_ratio'] = np.abs((bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])) / (h * w)
+    detections['depth_score'] = estimate_pothole_depths(image, bboxes)
+    detections['priority'] = assign_priorities(detections['area_ratio'], detections['depth_score'])
+    return detections
+
+
+def _build_assessment(image_path, image, detections, proximity_threshold, annotate=True):
+    """
+    Turns raw model detections for one image into the report dict and, if
+    `annotate` is set, the annotated image (otherwise None).
+    """
     h, w = image.shape[:2]
-    image_area = h * w
-    
-    results = model(image, conf=conf_threshold)
-    detections = results[0].boxes
-    
-    potholes_list = []
-    if len(detections.xyxy) > 0:
-        for i in range(len(detections.xyxy)):
-            x1, y1, x2, y2 = map(int, detections.xyxy[i])
-            confidence = float(detections.conf[i])
-            
-            contour = np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], dtype=np.int32)
-            area_ratio = cv2.contourArea(contour) / image_area
-            depth_score = estimate_pothole_depth(image, contour)
-            priority, color = get_individual_pothole_priority(area_ratio, depth_score)
-            
-            potholes_list.append({
-                'id': i, 'position': ((x1 + x2) // 2, (y1 + y2) // 2),
-                'bbox': [x1, y1, x2, y2], 'area_ratio': area_ratio,
-                'depth_score': depth_score, 'priority': priority, 'confidence': confidence
-            })
-            
-            cv2.rectangle(annotated_image, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(annotated_image, f"{priority} ({confidence:.2f})", (x1, y1 - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
     
-    road_priority, road_color, clusters = determine_road_priority(potholes_list, proximity_threshold, (h, w))
+    with stage_timer('depth'):
+        score_detections(image, detections)
+    DETECTIONS_PER_IMAGE.observe(len(detections))
+    bboxes = detections['bbox'].tolist()
+    confidences = detections['confidence'].tolist()
+    priorities = [PRIORITY_LEVELS[code] for code in detections['priority'].tolist()]
     
-    for i, cluster in enumerate(clusters):
-        if len(cluster) > 1:
-            points = np.array([potholes_list[idx]['position'] for idx in cluster]).astype(np.int32)
-            hull = cv2.convexHull(points.reshape(-1, 1, 2))
-            cv2.polylines(annotated_image, [hull], True, (255, 0, 255), 2)
+    with stage_timer('road_priority'):
+        road_priority, _, clusters = determine_road_priority(detections, proximity_threshold, (h, w))
+    multi_clusters = [c for c in clusters if len(c) > 1]
     
-    cv2.putText(annotated_image, f"Road Priority: {road_priority}", (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX, 1, road_color, 3)
-    
-    priority_counts = Counter(p['priority'] for p in potholes_list)
     source_name = os.path.basename(image_path) if isinstance(image_path, str) else "image_from_memory"
 
     assessment_data = {
         "source": source_name, "road_priority": road_priority,
-        "total_potholes": len(potholes_list),
-        "priority_distribution": dict(priority_counts),
-        "cluster_count": len([c for c in clusters if len(c) > 1]),
-        "potholes": [{k: p[k] for k in ('id', 'bbox', 'priority', 'depth_score', 'confidence')} for p in potholes_list]
+        "image_size": [w, h],
+        "total_potholes": len(detections),
+        "priority_distribution": dict(Counter(priorities)),
+        "cluster_count": len(multi_clusters),
+        "clusters": multi_clusters,
+        "potholes": [
+            {'id': i, 'bbox': bbox, 'priority': priority, 'depth_score': depth, 'confidence': confidence}
+            for i, (bbox, priority, depth, confidence)
+            in enumerate(zip(bboxes, priorities, detections['depth_score'].tolist(), confidences))
+        ]
     }
     
-    return json.dumps(assessment_data, indent=2), annotated_image
+    annotated_image = render_annotated_image(image, assessment_data) if annotate else None
+    return assessment_data, annotated_image
+
+
+# --- Annotation Rendering ---
+
+def render_annotated_image(image, assessment, max_dim=None):
+    """
+    Draws an assessment report (as produced by `assess_road_image`) onto a
+    copy of `image`. With `max_dim`, the image is downscaled first so large
+    frames are neither copied nor drawn on at full resolution. `image` may be
+    smaller than the assessed image (see `image_size`); boxes are scaled to fit.
+    """
+    with stage_timer('annotate'):
+        h, w = image.shape[:2]
+        scale = min(1.0, max_dim / max(h, w)) if max_dim else 1.0
+        if scale < 1.0:
+            annotated_image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                                         interpolation=cv2.INTER_AREA)
+        else:
+            annotated_image = image.copy()
+        src_w, src_h = assessment.get('image_size', (w, h))
+        sx, sy = annotated_image.shape[1] / src_w, annotated_image.shape[0] / src_h
+
+        centers = {}
+        for pothole in assessment['potholes']:
+            bx1, by1, bx2, by2 = pothole['bbox']
+            x1, y1, x2, y2 = int(bx1 * sx), int(by1 * sy), int(bx2 * sx), int(by2 * sy)
+            color = PRIORITY_COLORS[PRIORITY_LEVELS.index(pothole['priority'])]
+            cv2.rectangle(annotated_image, (x1, y1), (x2, y2), color, 2)
+            cv2.putText(annotated_image, f"{pothole['priority']} ({pothole['confidence']:.2f})", (x1, y1 - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+            centers[pothole['id']] = ((x1 + x2) // 2, (y1 + y2) // 2)
+
+        for cluster in assessment.get('clusters', []):
+            points = np.array([centers[idx] for idx in cluster], dtype=np.int32)
+            hull = cv2.convexHull(points.reshape(-1, 1, 2))
+            cv2.polylines(annotated_image, [hull], True, (255, 0, 255), 2)
+
+        road_priority = assessment['road_priority']
+        cv2.putText(annotated_image, f"Road Priority: {road_priority}", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1, PRIORITY_COLORS[PRIORITY_LEVELS.index(road_priority)], 3)
+        return annotated_image
+
+
+ANNOTATION_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'jpg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY),
+    'png': ('.png', 'image/png', None),
+}
+
+
+def encode_image(image, fmt='jpeg', quality=90):
+    """Encodes an image to bytes in one of ANNOTATION_FORMATS. Returns (bytes, mimetype)."""
+    if fmt not in ANNOTATION_FORMATS:
+        raise ValueError(f"Unsupported image format: {fmt}")
+    ext, mimetype, quality_flag = ANNOTATION_FORMATS[fmt]
+    params = [quality_flag, int(quality)] if quality_flag is not None else []
+    with stage_timer('encode'):
+        success, encoded = cv2.imencode(ext, image, params)
+    if not success:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return encoded.tobytes(), mimetype
+
+
+class AnnotationStore:
+    """
+    Keeps recent uploads (as their original encoded bytes) together with their
+    assessment so the annotated image can be rendered on demand, in any
+    supported format/quality/size, after the detection response was sent.
+    Rendered images are cached; both tiers are LRU-bounded by total bytes.
+    """
+
+    def __init__(self, max_source_bytes=128 * 1024 * 1024, max_rendered_bytes=64 * 1024 * 1024):
+        self.max_source_bytes = max_source_bytes
+        self.max_rendered_bytes = max_rendered_bytes
+        self._sources = OrderedDict()
+        self._source_bytes = 0
+        self._rendered = OrderedDict()
+        self._rendered_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, image_bytes, assessment):
+        """Registers an upload and its assessment; returns the annotation id."""
+        annotation_id = uuid.uuid4().hex
+        with self._lock:
+            self._sources[annotation_id] = (image_bytes, assessment)
+            self._source_bytes += len(image_bytes)
+            while self._source_bytes > self.max_source_bytes and self._sources:
+                _, (evicted, _) = self._sources.popitem(last=False)
+                self._source_bytes -= len(evicted)
+        return annotation_id
+
+    def get(self, annotation_id, fmt='jpeg', quality=90, max_dim=None):
+        """Returns (bytes, mimetype) of the rendered annotation, or None if the id is unknown or evicted."""
+        key = (annotation_id, fmt, int(quality), max_dim)
+        with self._lock:
+            cached = self._rendered.get(key)
+            if cached is not None:
+                self._rendered.move_to_end(key)
+                return cached
+            source = self._sources.get(annotation_id)
+            if source is None:
+                return None
+            self._sources.move_to_end(annotation_id)
+
+        image_bytes, assessment = source
+        min_short_side = None
+        if max_dim and 'image_size' in assessment:
+            min_short_side = -(-max_dim * min(assessment['image_size']) // max(assessment['image_size']))
+        try:
+            image, _ = decode_image(image_bytes, min_short_side)
+        except ValueError:
+            return None
+        rendered = encode_image(render_annotated_image(image, assessment, max_dim), fmt, quality)
+
+        with self._lock:
+            if key not in self._rendered:
+                self._rendered[key] = rendered
+                self._rendered_bytes += len(rendered[0])
+            while self._rendered_bytes > self.max_rendered_bytes and self._rendered:
+                _, (evicted, _) = self._rendered.popitem(last=False)
+                self._rendered_bytes -= len(evicted)
+        return rendered
+
+
+annotation_store = AnnotationStore()
+
+
+# --- Tiled Inference for High-Resolution Images ---
+
+def _tile_origins(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)  # Last tile is flush with the far edge
+    return origins
+
+
+def _nms_keep(detections, iou_threshold):
+    if len(detections) < 2:
+        return np.arange(len(detections))
+    bboxes = detections['bbox'].astype(np.float32)
+    rects = np.stack([bboxes[:, 0], bboxes[:, 1], bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]], axis=1)
+    # The field is an unaligned strided view into the records, which NMSBoxes misreads
+    keep = cv2.dnn.NMSBoxes(rects, np.ascontiguousarray(detections['confidence']), 0.0, iou_threshold)
+    return np.asarray(keep, dtype=np.int64).reshape(-1)
+
+
+def nms_detections(detections, iou_threshold=0.45):
+    """Class-agnostic NMS over a DETECTION_DTYPE array; returns the kept rows, highest confidence first."""
+    return detections[_nms_keep(detections, iou_threshold)]
+
+
+def _cut_by_tile(bboxes, x, y, tile_w, tile_h, image_w, image_h, margin=2):
+    """Which (full-image) boxes of the tile at (x, y) touch a tile edge that lies inside the image."""
+    return (((bboxes[:, 0] <= x + margin) & (x > 0)) | ((bboxes[:, 1] <= y + margin) & (y > 0)) |
+            ((bboxes[:, 2] >= x + tile_w - margin) & (x + tile_w < image_w)) |
+            ((bboxes[:, 3] >= y + tile_h - margin) & (y + tile_h < image_h)))
+
+
+def merge_cut_detections(detections, cut, ios_threshold=0.5):
+    """
+    Merges each box cut by a tile edge (`cut`) into the kept box it overlaps
+    most, when their intersection covers at least `ios_threshold` of the
+    smaller box: IoU misses a fragment inside the whole box from the
+    neighbouring tile. Merged boxes are the union of both, with the higher
+    confidence. Smallest cut boxes are merged first.
+    """
+    detections = detections.copy()
+    bboxes = detections['bbox']
+    areas = (bboxes[:, 2] - bboxes[:, 0]).astype(np.int64) * (bboxes[:, 3] - bboxes[:, 1])
+    alive = np.ones(len(detections), dtype=bool)
+    for i in np.flatnonzero(cut)[np.argsort(areas[cut], kind='stable')]:
+        others = np.flatnonzero(alive)
+        others = others[others != i]
+        if not len(others):
+            break
+        ios = box_ios(bboxes[i], bboxes[others])[0]
+        best = int(np.argmax(ios))
+        if ios[best] < ios_threshold:
+            continue
+        j = others[best]
+        bboxes[j, :2] = np.minimum(bboxes[i, :2], bboxes[j, :2])
+        bboxes[j, 2:] = np.maximum(bboxes[i, 2:], bboxes[j, 2:])
+        detections['confidence'][j] = max(detections['confidence'][i], detections['confidence'][j])
+        alive[i] = False
+    return detections[alive]
+
+
+def detect_tiled(image, model, conf=0.25, tile_size=640, overlap=0.2, tile_batch_size=8, max_workers=2,
+                 iou_threshold=0.45):
+    """
+    Runs detection on overlapping `tile_size` tiles of a large image so small
+    potholes are not lost to downscaling.
+
+    Tiles are views into `image` (no copies) and go through the model
+    `tile_batch_size` at a time on up to `max_workers` threads, so peak
+    input-tensor memory is bounded by tile_batch_size * max_workers tiles.
+    Boxes are shifted into full-image coordinates and merged with cross-tile
+    NMS; boxes cut by a tile edge are then merged into the boxes containing
+    most of them (see `merge_cut_detections`), so a pothole split by a tile
+    edge is counted once. `overlap` should exceed the size of the largest
+    expected pothole, relative to the tile, for boxes cut at a tile edge to
+    be recovered whole by a neighbouring tile.
+    """
+    h, w = image.shape[:2]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = [(x, y) for y in _tile_origins(h, tile_size, stride) for x in _tile_origins(w, tile_size, stride)]
+    batches = [origins[i:i + tile_batch_size] for i in range(0, len(origins), tile_batch_size)]
+
+    def run_batch(batch):
+        tiles = [image[y:y + tile_size, x:x + tile_size] for x, y in batch]
+        results = model.predict_batch(tiles, conf=conf, imgsz=tile_size)
+        cuts = []
+        for (x, y), detections in zip(batch, results):
+            detections['bbox'] += np.array([x, y, x, y], dtype=np.int32)
+            cuts.append(_cut_by_tile(detections['bbox'], x, y, min(tile_size, w - x), min(tile_size, h - y), w, h))
+        return results, cuts
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        per_batch = list(pool.map(run_batch, batches))
+    logger.info(f"Tiled inference: {len(origins)} tiles of {tile_size}px for a {w}x{h} image")
+    detections = np.concatenate([d for results, _ in per_batch for d in results])
+    cut = np.concatenate([c for _, cuts in per_batch for c in cuts])
+    keep = _nms_keep(detections, iou_threshold)
+    return merge_cut_detections(detections[keep], cut[keep])
+
+
+def assess_road_image(image_path, model, conf_threshold=0.25, proximity_threshold=150, tile_size=None,
+                      tile_overlap=0.2, tile_batch_size=8, annotate=True, as_dict=False):
+    """
+    Assesses a single image, returning a JSON report and an annotated image.
+    Pass `tile_size` (e.g. 640) to run tiled inference on large images instead
+    of downscaling the whole frame to one model input. With `annotate=False`
+    the annotated image is None; use `render_annotated_image` later if needed.
+    With `as_dict=True` the report is returned as a dict, for callers that
+    serialize it themselves further down the line.
+    """
+    image = _read_image(image_path)
+    # End-to-end model time, including any wait for a micro-batch to fill
+    with stage_timer('detect'):
+        if tile_size and max(image.shape[:2]) > tile_size:
+            detections = detect_tiled(image, model, conf_threshold, tile_size, tile_overlap, tile_batch_size)
+        else:
+            detections = model(image, conf=conf_threshold)
+    assessment, annotated_image = _build_assessment(image_path, image, detections, proximity_threshold, annotate)
+    return (assessment if as_dict else dumps_str(assessment, indent=True)), annotated_image
+
+
+def assess_road_images(image_paths, model=None, conf_threshold=0.25, proximity_threshold=150, as_dict=False):
+    """
+    Assesses a list of images (paths or arrays) with batched inference.
+    Returns a list of (JSON report, annotated image) tuples in input order,
+    or (dict, annotated image) with `as_dict=True`.
+    If no model is given, the process-wide detector (see `get_detector`) is used.
+    """
+    if model is None:
+        model = get_detector()
+    images = [_read_image(p) for p in image_paths]
+    results = model.predict_batch(images, conf=conf_threshold)
+    assessed = [_build_assessment(p, img, detections, proximity_threshold)
+                for p, img, detections in zip(image_paths, images, results)]
+    if as_dict:
+        return assessed
+    return [(dumps_str(assessment, indent=True), annotated) for assessment, annotated in assessed]
+
+
+# --- Video Assessment ---
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU matrix between (N, 4) and (M, 4) xyxy box arrays."""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    iy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def box_ios(boxes_a, boxes_b):
+    """Pairwise intersection over the smaller box's area between (N, 4) and (M, 4) xyxy box arrays."""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    iy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    smaller = np.minimum(area_a[:, None], area_b[None, :])
+    return np.where(smaller > 0, inter / np.where(smaller > 0, smaller, 1), 0.0)
+
+
+class _Track:
+    __slots__ = ('track_id', 'bbox', 'hits', 'misses', 'first_frame', 'last_frame',
+                 'max_confidence', 'max_depth_score', 'priority')
+
+    def __init__(self, track_id, frame_idx, bbox, confidence, depth_score, priority):
+        self.track_id = track_id
+        self.bbox = bbox
+        self.hits = 1
+        self.misses = 0
+        self.first_frame = frame_idx
+        self.last_frame = frame_idx
+        self.max_confidence = confidence
+        self.max_depth_score = depth_score
+        self.priority = priority
+
+    def update(self, frame_idx, bbox, confidence, depth_score, priority):
+        self.bbox = bbox
+        self.hits += 1
+        self.misses = 0
+        self.last_frame = frame_idx
+        self.max_confidence = max(self.max_confidence, confidence)
+        self.max_depth_score = max(self.max_depth_score, depth_score)
+        self.priority = max(self.priority, priority)
+
+
+class IoUTracker:
+    """
+    Greedy IoU tracker so each physical pothole is counted once across frames.
+
+    Detections are matched to live tracks in order of descending IoU; a track
+    that goes unmatched for more than `max_age` processed frames is retired.
+    Only tracks seen at least `min_hits` times are reported.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=3, min_hits=1):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.active = []
+        self.finished = []
+        self._next_id = 0
+
+    def update(self, frame_idx, detections):
+        """Feeds one frame's scored DETECTION_DTYPE array; returns the track id of each detection."""
+        track_ids = [-1] * len(detections)
+        unmatched_tracks = set(range(len(self.active)))
+        if self.active and len(detections):
+            iou = box_iou([t.bbox for t in self.active], detections['bbox'])
+            while True:
+                t_idx, d_idx = np.unravel_index(np.argmax(iou), iou.shape)
+                if iou[t_idx, d_idx] < self.iou_threshold:
+                    break
+                det = detections[d_idx]
+                self.active[t_idx].update(frame_idx, det['bbox'].tolist(), float(det['confidence']),
+                                          float(det['depth_score']), int(det['priority']))
+                track_ids[d_idx] = self.active[t_idx].track_id
+                unmatched_tracks.discard(t_idx)
+                iou[t_idx, :] = -1
+                iou[:, d_idx] = -1
+
+        for t_idx in unmatched_tracks:
+            self.active[t_idx].misses += 1
+        for d_idx, det in enumerate(detections):
+            if track_ids[d_idx] == -1:
+                track = _Track(self._next_id, frame_idx, det['bbox'].tolist(), float(det['confidence']),
+                               float(det['depth_score']), int(det['priority']))
+                self._next_id += 1
+                self.active.append(track)
+                track_ids[d_idx] = track.track_id
+
+        still_active = []
+        for track in self.active:
+            (self.finished if track.misses > self.max_age else still_active).append(track)
+        self.active = still_active
+        return track_ids
+
+    def tracks(self):
+        """All confirmed tracks, finished and active, in creation order."""
+        tracks = [t for t in self.finished + self.active if t.hits >= self.min_hits]
+        return sorted(tracks, key=lambda t: t.track_id)
+
+
+class _FrameReader:
+    """
+    Decodes a video on a background thread into a bounded queue so decoding
+    overlaps inference. Frames that will not be inferred are only grabbed
+    (not decoded into BGR) unless `decode_all` is set, e.g. for writing an
+    annotated output video.
+    """
+    _END = object()
+
+    def __init__(self, capture, stride, decode_all, queue_size=8):
+        self.capture = capture
+        self.stride = stride
+        self.decode_all = decode_all
+        self.frame_count = 0
+        self.frames = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pothole-video-reader', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        frame_idx = 0
+        try:
+            while not self._stop.is_set():
+                wanted = frame_idx % self.stride == 0
+                if wanted or self.decode_all:
+                    ok, frame = self.capture.read()
+                else:
+                    ok, frame = self.capture.grab(), None
+                if not ok:
+                    break
+                if frame is not None:
+                    self.frames.put((frame_idx, frame))
+                frame_idx += 1
+                self.frame_count = frame_idx
+        finally:
+            self.frames.put(self._END)
+
+    def __iter__(self):
+        while True:
+            item = self.frames.get()
+            if item is self._END:
+                return
+            yield item
+
+    def close(self):
+        self._stop.set()
+        # Drain so a reader blocked on a full queue can exit.
+        while self._thread.is_alive():
+            try:
+                self.frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _draw_tracked(frame, detections, track_ids):
+    for (x1, y1, x2, y2), code, track_id in zip(detections['bbox'].tolist(), detections['priority'].tolist(), track_ids):
+        color = PRIORITY_COLORS[code]
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame, f"#{track_id} {PRIORITY_LEVELS[code]}", (x1, y1 - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+
+def assess_road_video(video_path, model, conf_threshold=0.25, proximity_threshold=150, stride=5,
+                      output_video_path=None, iou_threshold=0.3, max_age=3, min_hits=1):
+    """
+    Assesses a video, running inference on every `stride`-th frame and
+    tracking potholes across frames so each one is counted once.
+    Optionally writes an annotated copy of the video. Returns a summary dict.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    writer = None
+    if output_video_path:
+        writer = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+    tracker = IoUTracker(iou_threshold=iou_threshold, max_age=max_age, min_hits=min_hits)
+    reader = _FrameReader(capture, stride, decode_all=writer is not None)
+    frame_priorities = Counter()
+    frames_processed = 0
+    last_detections, last_track_ids = empty_detections(), []
+    start = time.perf_counter()
+    try:
+        for frame_idx, frame in reader:
+            if frame_idx % stride == 0:
+                last_detections = score_detections(frame, model(frame, conf=conf_threshold))
+                last_track_ids = tracker.update(frame_idx, last_detections)
+                frame_priority, _, _ = determine_road_priority(last_detections, proximity_threshold, frame.shape[:2])
+                frame_priorities[frame_priority] += 1
+                frames_processed += 1
+            if writer is not None:
+                # Skipped frames reuse the latest detections so boxes do not flicker.
+                _draw_tracked(frame, last_detections, last_track_ids)
+                writer.write(frame)
+    finally:
+        reader.close()
+        capture.release()
+        if writer is not None:
+            writer.release()
+    elapsed = time.perf_counter() - start
+    frames_seen = reader.frame_count
+
+    tracks = tracker.tracks()
+    road_priority = next((p for p in ('High', 'Medium', 'Low') if frame_priorities[p]), 'Low')
+    return {
+        "source": os.path.basename(video_path),
+        "road_priority": road_priority,
+        "total_potholes": len(tracks),
+        "priority_distribution": dict(Counter(PRIORITY_LEVELS[t.priority] for t in tracks)),
+        "frame_priority_distribution": dict(frame_priorities),
+        "frames_total": frames_seen,
+        "frames_processed": frames_processed,
+        "stride": stride,
+        "video_fps": fps,
+        "processing_seconds": round(elapsed, 3),
+        "processing_fps": round(frames_seen / elapsed, 2) if elapsed > 0 else None,
+        "potholes": [{
+            "id": t.track_id,
+            "first_seen_s": round(t.first_frame / fps, 3),
+            "last_seen_s": round(t.last_frame / fps, 3),
+            "frames_detected": t.hits,
+            "last_bbox": t.bbox,
+            "priority": PRIORITY_LEVELS[t.priority],
+            "depth_score": t.max_depth_score,
+            "confidence": t.max_confidence,
+        } for t in tracks],
+    }
+
+
+# --- Directory / Manifest Batch Mode ---
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+_worker_model = None
+
+
+def find_images(directory):
+    """Recursively lists image files under `directory`, sorted for a stable processing order."""
+    found = []
+    for root, _, files in os.walk(directory):
+        found.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(found)
+
+
+def read_manifest(manifest_path):
+    """Reads one image path per line; blank lines and '#' comments are skipped, relative paths resolve against the manifest."""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    paths = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(line if os.path.isabs(line) else os.path.join(base, line))
+    return paths
+
+
+def _init_batch_worker(model_path, intra_op_threads, letterbox):
+    global _worker_model
+    # Each worker gets its own session; keep OpenCV from spawning a second thread pool per process.
+    cv2.setNumThreads(1)
+    _worker_model = load_model(model_path, letterbox=letterbox, intra_op_threads=intra_op_threads)
+
+
+def _assess_batch_item(task):
+    image_path, annotated_path, conf_threshold, proximity_threshold, tile_size = task
+    try:
+        assessment, annotated_image = assess_road_image(image_path, _worker_model, conf_threshold,
+                                                        proximity_threshold, tile_size=tile_size,
+                                                        annotate=bool(annotated_path), as_dict=True)
+        if annotated_path:
+            os.makedirs(os.path.dirname(annotated_path), exist_ok=True)
+            cv2.imwrite(annotated_path, annotated_image)
+        return image_path, assessment, None
+    except Exception as e:
+        ERRORS.inc(stage='batch_item')
+        return image_path, None, str(e)
+
+
+def assess_image_batch(image_paths, output_jsonl, model_path=DEFAULT_MODEL_PATH, output_dir=None,
+                       checkpoint_path=None, workers=None, intra_op_threads=None, conf_threshold=0.25,
+                       proximity_threshold=150, tile_size=None, letterbox=LETTERBOX):
+    """
+    Assesses many images on a process pool, streaming one JSON line per image
+    to `output_jsonl` and, if `output_dir` is given, annotated images mirroring
+    the input layout.
+
+    Every worker process holds its own ONNX session limited to
+    `intra_op_threads`, and workers * intra_op_threads is kept at the core
+    count so onnxruntime threads do not oversubscribe the machine. Finished
+    images are appended to a checkpoint file (default: `<output_jsonl>.checkpoint`);
+    rerunning with the same arguments skips them. Failed images are logged to
+    the JSONL but not checkpointed, so they are retried on resume.
+    Returns a dict of counts.
+    """
+    workers, intra_op_threads = core_budget(workers, intra_op_threads)
+    checkpoint_path = checkpoint_path or f"{output_jsonl}.checkpoint"
+
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            done = {line.rstrip('\n') for line in f if line.strip()}
+    pending = [p for p in image_paths if p not in done]
+    logger.info(f"Batch: {len(image_paths)} images, {len(image_paths) - len(pending)} already done, "
+                f"{workers} workers x {intra_op_threads} threads")
+    if not pending:
+        return {"total": len(image_paths), "skipped": len(image_paths), "succeeded": 0, "failed": 0}
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in pending])
+    tasks = []
+    for path in pending:
+        annotated_path = None
+        if output_dir:
+            rel = os.path.relpath(os.path.abspath(path), root)
+            annotated_path = os.path.join(output_dir, f"{os.path.splitext(rel)[0]}_assessed.jpg")
+        tasks.append((path, annotated_path, conf_threshold, proximity_threshold, tile_size))
+
+    succeeded = failed = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=_init_batch_worker,
+                              initargs=(model_path, intra_op_threads, letterbox)) as pool, \
+            open(output_jsonl, 'a') as results_file, open(checkpoint_path, 'a') as checkpoint_file:
+        for image_path, result, error in pool.imap_unordered(_assess_batch_item, tasks, chunksize=4):
+            if error is None:
+                results_file.write(dumps_str({"image": image_path, "result": result}) + '\n')
+                results_file.flush()
+                checkpoint_file.write(image_path + '\n')
+                checkpoint_file.flush()
+                succeeded += 1
+            else:
+                results_file.write(dumps_str({"image": image_path, "error": error}) + '\n')
+                results_file.flush()
+                logger.warning(f"Failed to assess {image_path}: {error}")
+                failed += 1
+            if (succeeded + failed) % 100 == 0:
+                rate = (succeeded + failed) / (time.perf_counter() - start)
+                logger.info(f"Batch progress: {succeeded + failed}/{len(tasks)} ({rate:.1f} images/s)")
+
+    return {"total": len(image_paths), "skipped": len(image_paths) - len(pending),
+            "succeeded": succeeded, "failed": failed}
+
+
+# --- Detection Result Cache ---
+
+# Kept out of the source tree; set POTHOLE_RESULT_CACHE_DB to a persistent path, or to '' for memory only.
+RESULT_CACHE_DB = os.getenv('POTHOLE_RESULT_CACHE_DB', os.path.join(tempfile.gettempdir(), 'pothole_cache.db'))
+# Part of every cache key; bump it when the pipeline's output changes for the same model and thresholds.
+RESULT_CACHE_VERSION = 2
+
+
+class ResultCache:
+    """
+    Content-addressed cache of assessments (and, optionally, annotated JPEGs).
+
+    Keys hash the image bytes together with the model version and thresholds,
+    so re-uploads of the same photo skip the pipeline while a model hot swap
+    or a threshold change naturally misses. Lookups go to an in-memory LRU
+    first and then to an SQLite table (`db_path=None` keeps memory only).
+    Concurrent misses for the same key wait on one in-flight computation;
+    those waits are counted as `coalesced`, apart from hits and misses.
+    """
+
+    def __init__(self, db_path=RESULT_CACHE_DB, max_entries=512, max_bytes=128 * 1024 * 1024,
+                 max_disk_entries=20000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()  # key -> (result, annotated_bytes, size)
+        self._memory_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._disk_ready = False
+
+    @staticmethod
+    def key(image_bytes, model_version, conf_threshold, proximity_threshold):
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"|{model_version}|{conf_threshold:g}|{proximity_threshold:g}".encode())
+        return digest.hexdigest()
+
+    # SQLite tier
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        if not self._disk_ready:
+            conn.execute('''CREATE TABLE IF NOT EXISTS detection_cache (
+                                key TEXT PRIMARY KEY,
+                                result TEXT NOT NULL,
+                                annotated_image BLOB,
+                                last_access REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_detection_cache_access ON detection_cache(last_access)')
+            self._disk_ready = True
+        return conn
+
+    def _disk_get(self, key):
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute('SELECT result, annotated_image FROM detection_cache WHERE key = ?',
+                                   (key,)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE detection_cache SET last_access = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            logger.warning(f"Result cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        return loads(row[0]), row[1], len(row[0])
+
+    def _disk_put(self, key, payload, annotated_bytes):
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute('''INSERT INTO detection_cache (key, result, annotated_image, last_access)
+                                VALUES (?, ?, ?, ?)
+                                ON CONFLICT(key) DO UPDATE SET
+                                    result = excluded.result,
+                                    annotated_image = COALESCE(excluded.annotated_image, annotated_image),
+                                    last_access = excluded.last_access''',
+                             (key, payload, annotated_bytes, time.time()))
+                with self._lock:
+                    self._counts['disk_writes'] += 1
+                    prune = self._counts['disk_writes'] % 100 == 0
+                if prune:
+                    conn.execute('''DELETE FROM detection_cache WHERE key IN (
+                                        SELECT key FROM detection_cache ORDER BY last_access DESC
+                                        LIMIT -1 OFFSET ?)''', (self.max_disk_entries,))
+        except sqlite3.Error as e:
+            logger.warning(f"Result cache write failed: {e}")
+
+    # Memory tier
+
+    def _memory_put(self, key, result, annotated_bytes, result_size):
+        size = result_size + (len(annotated_bytes) if annotated_bytes else 0)
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= old[2]
+                annotated_bytes = annotated_bytes or old[1]
+            self._memory[key] = (result, annotated_bytes, size)
+            self._memory_bytes += size
+            while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def _memory_get(self, key):
+        """Memory-tier lookup; the caller holds the lock."""
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        self._memory.move_to_end(key)
+        self._counts['memory_hits'] += 1
+        return entry[0], entry[1]
+
+    def _disk_or_miss(self, key):
+        entry = self._disk_get(key) if self.db_path else None
+        if entry is None:
+            with self._lock:
+                self._counts['misses'] += 1
+            return None
+        self._memory_put(key, *entry)
+        with self._lock:
+            self._counts['disk_hits'] += 1
+        return entry[:2]
+
+    def get(self, key):
+        """Returns (result, annotated_bytes or None), or None on a miss."""
+        with self._lock:
+            entry = self._memory_get(key)
+        if entry is not None:
+            return entry
+        return self._disk_or_miss(key)
+
+    def put(self, key, result, annotated_bytes=None):
+        """Stores an assessment; an existing annotated image is kept if `annotated_bytes` is None."""
+        # Serialized once: its length sizes the memory entry and it is what the SQLite tier stores.
+        payload = dumps_str(result)
+        self._memory_put(key, result, annotated_bytes, len(payload))
+        if self.db_path:
+            self._disk_put(key, payload, annotated_bytes)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached (result, annotated_bytes) for `key`, or runs
+        `compute()` once for all concurrent callers asking for the same key.
+        """
+        # The memory lookup and the in-flight registration share one critical section,
+        # so two identical requests cannot both miss and both compute
+        with self._lock:
+            entry = self._memory_get(key)
+            if entry is not None:
+                return entry
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self._counts['coalesced'] += 1
+        if not leader:
+            return future.result()
+        try:
+            entry = self._disk_or_miss(key)
+            if entry is None:
+                entry = compute()
+                self.put(key, *entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self):
+        """Hit/miss counters plus the size of both tiers."""
+        with self._lock:
+            counts = dict(self._counts)
+            stats = {"memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+                     "inflight": len(self._inflight)}
+        hits = counts.get('memory_hits', 0) + counts.get('disk_hits', 0)
+        lookups = hits + counts.get('misses', 0)
+        stats.update({name: counts.get(name, 0) for name in ('memory_hits', 'disk_hits', 'misses', 'coalesced')})
+        # Coalesced callers waited on an in-flight miss; they are neither hits nor misses
+        stats["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        if self.db_path:
+            try:
+                with closing(self._connect()) as conn:
+                    stats["disk_entries"], stats["disk_bytes"] = conn.execute(
+                        '''SELECT COUNT(*), COALESCE(SUM(LENGTH(result) + COALESCE(LENGTH(annotated_image), 0)), 0)
+                           FROM detection_cache''').fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Result cache stats failed: {e}")
+        return stats
+
+
+result_cache = ResultCache(RESULT_CACHE_DB or None)
+
+
+# --- Asynchronous Detection Jobs ---
+
+JOB_WORKERS = int(os.getenv('POTHOLE_JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.getenv('POTHOLE_JOB_QUEUE_SIZE', '32'))
+
+
+class DetectionJob:
+    """
+    State of one queued detection; `status` is queued, running, done or failed.
+    `context` carries caller data (e.g. a location) through to `on_complete`.
+    """
+    __slots__ = ('id', 'status', 'result', 'error', 'user_id', 'source_name', 'image_bytes', 'context',
+                 'created_at', 'finished_at')
+
+    def __init__(self, image_bytes, source_name=None, user_id=None, context=None):
+        self.id = uuid.uuid4().hex
+        self.context = context or {}
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.user_id = user_id
+        self.source_name = source_name
+        self.image_bytes = image_bytes
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {'job_id': self.id, 'status': self.status, 'result': self.result, 'error': self.error,
+                'created_at': self.created_at, 'finished_at': self.finished_at}
+
+
+class DetectionJobQueue:
+    """
+    Runs detections on `workers` background threads behind a queue of at most
+    `max_pending` jobs, so web workers only enqueue and poll. `submit` raises
+    queue.Full when the queue is at capacity; `retry_after` estimates when a
+    slot frees up. Jobs run with lazy annotation (see `annotation_store`), and
+    finished jobs are kept for polling up to `max_finished`, oldest dropped
+    first. `on_complete(job)` runs on the worker after each successful job.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, max_finished=1024, on_complete=None):
+        self.workers = workers
+        self.max_finished = max_finished
+        self.on_complete = on_complete
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._avg_seconds = 1.0
+        self._threads = []
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._worker, name=f'detection-job-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def submit(self, image_bytes, source_name=None, user_id=None, context=None):
+        """Queues a detection and returns its DetectionJob; raises queue.Full if the queue is full."""
+        self._ensure_started()
+        job = DetectionJob(image_bytes, source_name, user_id, context)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained one slot per worker."""
+        return max(1, int(np.ceil(self._avg_seconds * self._queue.qsize() / max(1, self.workers))))
+
+    def stats(self):
+        with self._lock:
+            statuses = Counter(job.status for job in self._jobs.values())
+        return {'pending': self._queue.qsize(), 'capacity': self._queue.maxsize, 'workers': self.workers,
+                'avg_job_seconds': round(self._avg_seconds, 3), **statuses}
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.status = 'running'
+            start = time.perf_counter()
+            result, _ = run_pothole_detection_from_bytes(job.image_bytes, annotate=False, lazy_annotation=True,
+                                                         source_name=job.source_name)
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.perf_counter() - start)
+            if result is None:
+                job.status, job.error = 'failed', 'Detection failed'
+            else:
+                job.status, job.result = 'done', result
+                if self.on_complete is not None:
+                    try:
+                        self.on_complete(job)
+                    except Exception as e:
+                        logger.error(f"Job completion hook failed for {job.id}: {e}", exc_info=True)
+            job.finished_at = time.time()
+            job.image_bytes = None  # kept by annotation_store for as long as rendering needs it
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
 
 
 # --- Main Execution Block ---
 
 # --- Flask Integration Functions ---
 
-def run_pothole_detection(image_path):
+def run_pothole_detection(image_path, annotate=True):
     """
     Flask-ready entry point for pothole detection from file path.
     Returns:
@@ -242,53 +2214,80 @@ def run_pothole_detection(image_path):
         annotated_image_bytes: Annotated image as bytes (for SQLite BLOB)
     """
     try:
-        model = load_model("pothole_detector_v1.onnx")
-        json_output, annotated_image = assess_road_image(image_path, model)
-        
-        # Convert JSON string back to dict and add image path
-        result_dict = json.loads(json_output)
-        result_dict['image_path'] = image_path
-        
-        # Convert annotated image to bytes
-        success, img_encoded = cv2.imencode('.jpg', annotated_image)
-        if not success:
-            return None, None
-            
-        return result_dict, img_encoded.tobytes()
-        
-    except Exception as e:
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+    except OSError as e:
         logger.error(f"Error in run_pothole_detection: {e}", exc_info=True)
         return None, None
 
-def run_pothole_detection_from_bytes(image_bytes):
+    result_dict, annotated_image_bytes = run_pothole_detection_from_bytes(
+        image_bytes, annotate=annotate, source_name=os.path.basename(image_path))
+    if result_dict is not None:
+        result_dict['image_path'] = image_path
+    return result_dict, annotated_image_bytes
+
+def run_pothole_detection_from_bytes(image_bytes, annotate=True, source_name=None, conf_threshold=0.25,
+                                     proximity_threshold=150, use_cache=True, lazy_annotation=False):
     """
     Flask-ready entry point for pothole detection from image bytes.
+    With `annotate=False` no annotated image is drawn or encoded. With
+    `lazy_annotation=True` as well, the upload is kept in `annotation_store`
+    and `result_json['annotation_id']` can be used to render it later.
+    Large JPEGs are decoded at reduced resolution; boxes (and
+    `proximity_threshold`) are still in full-resolution pixels. Depth scores
+    are measured on the reduced decode, where averaging lowers the intensity
+    spread, so the contrast term (at most 0.3 of the score) and hence
+    `depth_score` can come out slightly lower than on a full decode.
+    Results are looked up in / stored to `result_cache` unless `use_cache` is off.
     Returns:
         result_json: JSON-serializable dict with detection info
-        annotated_image_bytes: Annotated image as bytes (for SQLite BLOB)
+        annotated_image_bytes: Annotated JPEG as bytes (for SQLite BLOB), or None if not annotated
     """
     try:
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img is None:
-            return None, None
-            
-        # Run detection
-        model = load_model("pothole_detector_v1.onnx")
-        json_output, annotated_image = assess_road_image(img, model)
-        
-        # Convert JSON string back to dict
-        result_dict = json.loads(json_output)
-        
-        # Convert annotated image to bytes
-        success, img_encoded = cv2.imencode('.jpg', annotated_image)
-        if not success:
-            return None, None
-            
-        return result_dict, img_encoded.tobytes()
+        decoded = []
+
+        def decode():
+            # Large photos are decoded at reduced resolution, never below the model input size.
+            if not decoded:
+                decoded.append(decode_image(image_bytes, min_short_side=640))
+            return decoded[0]
+
+        detector = get_detector()
+
+        def compute():
+            img, image_size = decode()
+            # Clustering runs on the (possibly reduced) decode's pixels
+            scale = img.shape[1] / image_size[0]
+            assessment, _ = assess_road_image(img, detector, conf_threshold, proximity_threshold * scale,
+                                              annotate=False, as_dict=True)
+            result = rescale_assessment(assessment, image_size)
+            annotated_bytes = encode_image(render_annotated_image(img, result), 'jpeg', 95)[0] if annotate else None
+            return result, annotated_bytes
+
+        if use_cache:
+            model_version = f"{detector.fingerprint()}{'+letterbox' if LETTERBOX else ''}+v{RESULT_CACHE_VERSION}"
+            key = result_cache.key(image_bytes, model_version, conf_threshold, proximity_threshold)
+            result, annotated_image_bytes = result_cache.get_or_compute(key, compute)
+            if annotate and annotated_image_bytes is None:
+                # Cached without an annotation: draw it from the cached report instead of re-detecting.
+                annotated_image_bytes = encode_image(render_annotated_image(decode()[0], result), 'jpeg', 95)[0]
+                result_cache.put(key, result, annotated_image_bytes)
+        else:
+            result, annotated_image_bytes = compute()
+
+        # The cached dict is shared between requests; per-request fields go on a copy.
+        result_dict = dict(result)
+        if source_name:
+            result_dict['source'] = source_name
+
+        if not annotate:
+            if lazy_annotation:
+                result_dict['annotation_id'] = annotation_store.put(image_bytes, result_dict)
+            return result_dict, None
+        return result_dict, annotated_image_bytes
         
     except Exception as e:
+        ERRORS.inc(stage='detection')
         logger.error(f"Error in run_pothole_detection_from_bytes: {e}", exc_info=True)
         return None, None
 
@@ -296,19 +2295,47 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pothole Detection and Road Priority Assessment for Images.")
     parser.add_argument("--image", type=str, help="Path to a single image for analysis.")
     parser.add_argument("--model", type=str, default="pothole_detector_v1.onnx", help="Path to the ONNX model file.")
+    parser.add_argument("--variant", type=str, default=MODEL_VARIANT, choices=MODEL_VARIANTS,
+                        help="Model variant built by optimize_pothole_model.py (default: $POTHOLE_MODEL_VARIANT or fp32).")
     parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold for detection.")
+    parser.add_argument("--tile", type=int, default=0,
+                        help="Tile size for tiled inference on high-resolution images (0 = disabled, e.g. 640).")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Fractional overlap between tiles.")
+    parser.add_argument("--tile-batch", type=int, default=8, help="Number of tiles per inference batch.")
+    parser.add_argument("--video", type=str, help="Path to a video file for analysis.")
+    parser.add_argument("--stride", type=int, default=5, help="Run inference on every Nth video frame.")
+    parser.add_argument("--output-video", type=str, help="Optional path for an annotated copy of the video.")
+    parser.add_argument("--dir", type=str, help="Directory of images to assess (recursive).")
+    parser.add_argument("--manifest", type=str, help="Text file listing one image path per line.")
+    parser.add_argument("--output-jsonl", type=str, default="pothole_results.jsonl",
+                        help="Results file for --dir/--manifest (one JSON object per line).")
+    parser.add_argument("--output-dir", type=str, help="Directory for annotated images in --dir/--manifest mode.")
+    parser.add_argument("--checkpoint", type=str, help="Checkpoint file for resuming (default: <output-jsonl>.checkpoint).")
+    parser.add_argument("--workers", type=int, help="Worker processes for --dir/--manifest (default: cores / threads).")
+    parser.add_argument("--threads", type=int, help="onnxruntime intra-op threads per worker (default: cores / workers).")
 
     args = parser.parse_args()
 
     try:
-        model = load_model(args.model)
-        
-        if args.image:
+        model_path = resolve_model_path(args.model, args.variant)
+        if args.dir or args.manifest:
+            image_paths = find_images(args.dir) if args.dir else read_manifest(args.manifest)
+            summary = assess_image_batch(
+                image_paths, args.output_jsonl, model_path=model_path, output_dir=args.output_dir,
+                checkpoint_path=args.checkpoint, workers=args.workers, intra_op_threads=args.threads,
+                conf_threshold=args.conf, tile_size=args.tile)
+            print("\n--- Batch Summary ---")
+            print(json.dumps(summary, indent=2))
+
+        elif args.image:
             if not os.path.exists(args.image):
                 logger.error(f"Image file not found: {args.image}")
             else:
+                model = load_model(model_path)
                 logger.info(f"--- Processing Image: {args.image} ---")
-                json_output, annotated_image = assess_road_image(args.image, model, conf_threshold=args.conf)
+                json_output, annotated_image = assess_road_image(
+                    args.image, model, conf_threshold=args.conf, tile_size=args.tile,
+                    tile_overlap=args.tile_overlap, tile_batch_size=args.tile_batch)
                 
                 output_path = f"{os.path.splitext(args.image)[0]}_assessed.jpg"
                 cv2.imwrite(output_path, annotated_image)
@@ -317,9 +2344,28 @@ if __name__ == "__main__":
                 print(json_output)
                 logger.info(f"Annotated image saved to: {output_path}")
         
+        elif args.video:
+            if not os.path.exists(args.video):
+                logger.error(f"Video file not found: {args.video}")
+            else:
+                model = load_model(model_path)
+                logger.info(f"--- Processing Video: {args.video} ---")
+                summary = assess_road_video(args.video, model, conf_threshold=args.conf, stride=args.stride,
+                                            output_video_path=args.output_video)
+
+                summary_path = f"{os.path.splitext(args.video)[0]}_summary.json"
+                with open(summary_path, 'w') as f:
+                    json.dump(summary, f, indent=2)
+
+                print("\n--- Video Assessment Summary ---")
+                print(json.dumps({k: v for k, v in summary.items() if k != 'potholes'}, indent=2))
+                logger.info(f"Summary saved to: {summary_path}")
+                if args.output_video:
+                    logger.info(f"Annotated video saved to: {args.output_video}")
+
         else:
             parser.print_help()
-            logger.warning("No input file specified. Use the --image argument.")
+            logger.warning("No input specified. Use --image, --video, --dir or --manifest.")
 
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}", exc_info=True)
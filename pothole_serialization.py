@@ -0,0 +1,73 @@
+import base64
+import datetime
+import json
+import math
+import sqlite3
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder produces the same JSON, just slower
+    orjson = None
+
+# NaN and infinities are not valid JSON; both encoders below write them as null.
+
+
+def _default(obj):
+    """Encodes the types results carry that JSON has no native form for."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _finite(obj):
+    """Copy of `obj` with NaN and infinities replaced by None, as orjson encodes them."""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    if isinstance(obj, (np.generic, np.ndarray, sqlite3.Row, set, frozenset)):
+        return _finite(_default(obj))
+    return obj
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj, indent=False):
+        """Encodes `obj` to UTF-8 JSON bytes in a single pass."""
+        options = _ORJSON_OPTIONS | orjson.OPT_INDENT_2 if indent else _ORJSON_OPTIONS
+        return orjson.dumps(obj, default=_default, option=options)
+
+    loads = orjson.loads
+else:
+    _compact = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default, allow_nan=False)
+    _indented = json.JSONEncoder(ensure_ascii=False, indent=2, default=_default, allow_nan=False)
+
+    def dumps(obj, indent=False):
+        """Encodes `obj` to UTF-8 JSON bytes in a single pass (two if it holds NaN or infinities)."""
+        encoder = _indented if indent else _compact
+        try:
+            return encoder.encode(obj).encode('utf-8')
+        except ValueError:
+            return encoder.encode(_finite(obj)).encode('utf-8')
+
+    loads = json.loads
+
+
+def dumps_str(obj, indent=False):
+    """Like dumps, for text sinks (SQLite TEXT columns, JSONL files, stdout)."""
+    return dumps(obj, indent).decode('utf-8')
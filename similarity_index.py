@@ -0,0 +1,483 @@
+import math
+import os
+import threading
+
+import numpy as np
+
+# Inverted lists scanned per query; more is slower and closer to exact search
+SIMILARITY_NPROBE = int(os.getenv('SIMILARITY_NPROBE', '16'))
+# Below this many vectors the index stays one list, i.e. an exact scan
+MIN_TRAIN_SIZE = 1024
+# Retrain the coarse quantizer once the index has grown this much since the last training
+RETRAIN_GROWTH = 4
+# Seconds between background saves of an index that has changed
+SIMILARITY_SAVE_INTERVAL = float(os.getenv('SIMILARITY_SAVE_INTERVAL', '300'))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+ASSIGN_CHUNK = 16384
+# Rows of int8 codes widened to float32 at a time while scoring; small enough to stay in cache
+SCORE_CHUNK = 64
+
+
+def normalize_rows(vectors):
+    """Returns `vectors` as a new float32 2-D array with unit-length rows (zero rows stay zero)"""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    np.nan_to_num(vectors, copy=False)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def quantize(vectors):
+    """
+    int8 codes and per-row float32 scales with vectors ~= codes * scales[:, None]
+    (a quarter of the float32 size; the rounding error is far below the
+    differences between neighbours).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = (np.abs(vectors).max(axis=1, initial=0.0) / 127).astype(np.float32)
+    codes = np.rint(vectors / np.where(scales > 0, scales, 1)[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def dequantize(codes, scales):
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def _scores(codes, scales, query):
+    """codes * scales @ query, widening SCORE_CHUNK rows at a time into a reused float32 buffer"""
+    out = np.empty(len(codes), dtype=np.float32)
+    buf = np.empty((min(SCORE_CHUNK, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_CHUNK):
+        chunk = codes[start:start + SCORE_CHUNK]
+        np.copyto(buf[:len(chunk)], chunk)
+        np.dot(buf[:len(chunk)], query, out=out[start:start + len(chunk)])
+    return out * scales
+
+
+def _nearest(vectors, centroids):
+    """
+    Index of the most similar centroid for each (normalized) row, in chunks to
+    bound memory. Also takes int8 codes: a positive per-row scale does not
+    change the argmax.
+    """
+    assign = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        assign[start:start + ASSIGN_CHUNK] = (chunk @ centroids.T).argmax(axis=1)
+    return assign
+
+
+def spherical_kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """k-means under cosine similarity: centroids are kept unit length. Returns (k, dim) centroids."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        present = np.nonzero(counts)[0]
+        sums[present] = np.add.reduceat(vectors[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[present])
+        # Empty lists are reseeded with random vectors
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class _InvertedList:
+    """Ids and int8-quantized vectors of one IVF cell, in arrays whose capacity doubles when full"""
+    __slots__ = ('ids', 'codes', 'scales', 'size')
+
+    def __init__(self, dim, capacity=16):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.codes = np.empty((capacity, dim), dtype=np.int8)
+        self.scales = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def append(self, ids, codes, scales):
+        """Appends rows; returns the position of the first"""
+        start, end = self.size, self.size + len(ids)
+        if end > len(self.ids):
+            capacity = max(end, 2 * len(self.ids))
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_codes = np.empty((capacity, self.codes.shape[1]), dtype=np.int8)
+            grown_scales = np.empty(capacity, dtype=np.float32)
+            grown_ids[:start] = self.ids[:start]
+            grown_codes[:start] = self.codes[:start]
+            grown_scales[:start] = self.scales[:start]
+            self.ids, self.codes, self.scales = grown_ids, grown_codes, grown_scales
+        self.ids[start:end] = ids
+        self.codes[start:end] = codes
+        self.scales[start:end] = scales
+        self.size = end
+        return start
+
+    def pop(self, position):
+        """Removes the row at `position` by moving the last row into it; returns the moved id or None"""
+        last = self.size - 1
+        moved = None
+        if position != last:
+            self.ids[position] = self.ids[last]
+            self.codes[position] = self.codes[last]
+            self.scales[position] = self.scales[last]
+            moved = int(self.ids[position])
+        self.size = last
+        return moved
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour search by cosine similarity over vectors
+    keyed by integer id (inverted file with scalar-quantized vectors, IVF-SQ8).
+    Vectors are filed under the nearest of ~sqrt(n) spherical k-means
+    centroids, and a query only scans the `nprobe` lists whose centroids
+    are most similar to it. Inserts and deletes are incremental and only
+    file vectors under the current centroids. Once the index has grown
+    RETRAIN_GROWTH-fold the centroids are retrained on a background thread,
+    which swaps in the new centroids and lists when done, so the cost is
+    amortized like an array doubling and never paid by an insert or a query.
+    Until MIN_TRAIN_SIZE vectors are stored the index is a single list,
+    searched exactly. Vectors are held as int8 codes with a per-vector
+    scale, a quarter of the memory of float32, and scored in float32.
+    """
+
+    def __init__(self, dim, fingerprint=None, nprobe=SIMILARITY_NPROBE):
+        self.dim = dim
+        self.fingerprint = fingerprint
+        self.nprobe = max(1, nprobe)
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = [_InvertedList(dim)]
+        self._where = {}  # id -> (list number, position)
+        self._lock = threading.RLock()
+        self._training = None  # background retraining thread
+        self._changed = None  # ids inserted or deleted since the retraining snapshot
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, item_id):
+        return int(item_id) in self._where
+
+    def _assign(self, vectors):
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.intp)
+        return _nearest(vectors, self.centroids)
+
+    def add(self, ids, vectors):
+        """Inserts (or replaces) one vector per id"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return
+        vectors = normalize_rows(vectors)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d vectors, got {vectors.shape[1]}-d")
+        with self._lock:
+            self._insert(ids, vectors)
+            if (self._training is None and len(self) >= MIN_TRAIN_SIZE
+                    and len(self) >= RETRAIN_GROWTH * max(self.trained_size, 1)):
+                self._training = threading.Thread(target=self._retrain, name='similarity-index-train', daemon=True)
+                self._training.start()
+
+    def _insert(self, ids, vectors):
+        """Files normalized `vectors` under the current centroids; the caller holds the lock"""
+        for item_id in ids:
+            if item_id in self._where:
+                self._remove(item_id)
+        assign = self._assign(vectors)
+        codes, scales = quantize(vectors)
+        for list_no in np.unique(assign):
+            rows = np.nonzero(assign == list_no)[0]
+            start = self._lists[list_no].append([ids[r] for r in rows], codes[rows], scales[rows])
+            for offset, r in enumerate(rows):
+                self._where[ids[r]] = (int(list_no), start + offset)
+        if self._changed is not None:
+            self._changed.update(ids)
+
+    def _remove(self, item_id):
+        list_no, position = self._where.pop(item_id)
+        moved = self._lists[list_no].pop(position)
+        if moved is not None:
+            self._where[moved] = (list_no, position)
+        if self._changed is not None:
+            self._changed.add(item_id)
+
+    def remove(self, item_id):
+        """Deletes the vector of `item_id`; returns whether it was indexed"""
+        with self._lock:
+            if int(item_id) not in self._where:
+                return False
+            self._remove(int(item_id))
+            return True
+
+    def retain(self, ids):
+        """Deletes every vector whose id is not in `ids`; returns how many were deleted"""
+        keep = {int(i) for i in ids}
+        with self._lock:
+            stale = [item_id for item_id in self._where if item_id not in keep]
+            for item_id in stale:
+                self._remove(item_id)
+        return len(stale)
+
+    def _stored(self, item_id):
+        list_no, position = self._where[item_id]
+        lst = self._lists[list_no]
+        return lst.codes[position].astype(np.float32) * lst.scales[position]
+
+    def vector(self, item_id):
+        """The stored (normalized) vector of `item_id`, or None"""
+        with self._lock:
+            if int(item_id) not in self._where:
+                return None
+            return self._stored(int(item_id))
+
+    def _all(self):
+        ids = np.concatenate([lst.ids[:lst.size] for lst in self._lists])
+        codes = np.concatenate([lst.codes[:lst.size] for lst in self._lists])
+        scales = np.concatenate([lst.scales[:lst.size] for lst in self._lists])
+        return ids, codes, scales
+
+    def train(self):
+        """Retrains the centroids on the calling thread, after any background retraining in progress"""
+        while True:
+            with self._lock:
+                training = self._training
+                if training is None:
+                    self._training = threading.current_thread()
+                    break
+            training.join()
+        self._retrain()
+
+    def wait(self):
+        """Blocks until a background retraining in progress has been swapped in"""
+        training = self._training
+        if training is not None and training is not threading.current_thread():
+            training.join()
+
+    def _retrain(self):
+        """
+        Trains centroids on a snapshot of the stored vectors and refiles the
+        snapshot into new lists without holding the lock; then, under the
+        lock, replays the inserts and deletes made meanwhile and swaps the
+        new centroids and lists in.
+        """
+        try:
+            with self._lock:
+                ids, codes, scales = self._all()
+                self._changed = set()
+            nlist = max(1, int(math.sqrt(len(ids))))
+            fresh = IVFIndex(self.dim, self.fingerprint, self.nprobe)
+            if nlist > 1:
+                rows = slice(None)
+                if len(ids) > nlist * KMEANS_SAMPLE_PER_LIST:
+                    rows = np.random.default_rng(0).choice(len(ids), nlist * KMEANS_SAMPLE_PER_LIST, replace=False)
+                fresh.centroids = spherical_kmeans(dequantize(codes[rows], scales[rows]), nlist)
+                fresh._lists = [_InvertedList(self.dim) for _ in range(nlist)]
+            fresh._file(ids, codes, scales, fresh._assign(codes))
+            trained_size = len(ids)
+            del ids, codes, scales
+
+            with self._lock:
+                changed = list(self._changed)
+                for item_id in changed:
+                    if item_id in fresh._where:
+                        fresh._remove(item_id)
+                current = [item_id for item_id in changed if item_id in self._where]
+                if current:
+                    fresh._insert(current, np.stack([self._stored(item_id) for item_id in current]))
+                self.centroids, self._lists, self._where = fresh.centroids, fresh._lists, fresh._where
+                self.trained_size = trained_size
+        except Exception as e:
+            print(f"Error retraining similarity index: {e}")
+        finally:
+            with self._lock:
+                self._changed = None
+                self._training = None
+
+    def _file(self, ids, codes, scales, assign):
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=len(self._lists))
+        start = 0
+        for list_no, count in enumerate(counts):
+            rows = order[start:start + count]
+            start += count
+            if not count:
+                continue
+            lst = self._lists[list_no]
+            lst.append(ids[rows], codes[rows], scales[rows])
+            self._where.update((int(item_id), (list_no, position)) for position, item_id in enumerate(ids[rows]))
+
+    def search(self, query, k=10, nprobe=None, exclude=()):
+        """
+        Returns up to `k` (id, cosine similarity) pairs most similar to
+        `query`, best first, skipping ids in `exclude`.
+        """
+        query = normalize_rows(np.ravel(query))[0]
+        if len(query) != self.dim:
+            raise ValueError(f"Expected a {self.dim}-d query, got {len(query)}-d")
+        with self._lock:
+            if self.centroids is None:
+                probe = [0]
+            else:
+                nprobe = min(nprobe or self.nprobe, len(self._lists))
+                probe = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+            ids = [self._lists[p].ids[:self._lists[p].size] for p in probe]
+            scores = [_scores(self._lists[p].codes[:self._lists[p].size], self._lists[p].scales[:self._lists[p].size],
+                              query) for p in probe]
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        if exclude:
+            keep = ~np.isin(ids, np.fromiter(exclude, dtype=np.int64))
+            ids, scores = ids[keep], scores[keep]
+        if len(ids) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def save(self, path):
+        """
+        Writes the index to `path` (.npz), replacing it atomically.
+        """
+        with self._lock:
+            ids, codes, scales = self._all()
+            sizes = np.array([lst.size for lst in self._lists], dtype=np.int64)
+            centroids = self.centroids if self.centroids is not None else np.zeros((0, self.dim), np.float32)
+            trained_size = self.trained_size
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, dim=self.dim, fingerprint=str(self.fingerprint or ''), centroids=centroids,
+                     trained_size=trained_size, list_sizes=sizes, ids=ids, codes=codes, scales=scales)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, fingerprint=None, nprobe=SIMILARITY_NPROBE):
+        """
+        Reads an index written by save. Returns None when there is none or it
+        was built from vectors of another model (`fingerprint` differs).
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['fingerprint']) != str(fingerprint or ''):
+                return None
+            index = cls(int(data['dim']), fingerprint, nprobe)
+            centroids = data['centroids']
+            sizes = data['list_sizes']
+            ids = data['ids']
+            codes, scales = data['codes'], data['scales']
+            index.trained_size = int(data['trained_size'])
+        if len(centroids):
+            index.centroids = centroids.astype(np.float32)
+            index._lists = [_InvertedList(index.dim) for _ in range(len(centroids))]
+        index._file(ids, codes, scales, np.repeat(np.arange(len(sizes)), sizes))
+        return index
+
+
+class SimilarityIndex:
+    """
+    One IVFIndex per feature kind ('image', 'text') of the complaints in the
+    duplicate detector, persisted as <directory>/<kind>.npz. Kinds without a
+    model fingerprint (the detector's fallback features) are not indexed.
+    Changed kinds are saved by save(), and every `interval` seconds once
+    start_autosave() is called, so a crash loses at most that much.
+    """
+
+    def __init__(self, directory, nprobe=SIMILARITY_NPROBE):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.fingerprints = {}
+        self.indexes = {}
+        self._unsaved = set()  # kinds changed since their last save
+        self._unsaved_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._autosave = None
+
+    def _path(self, kind):
+        return os.path.join(self.directory, f"{kind}.npz")
+
+    def _changed(self, kind):
+        with self._unsaved_lock:
+            self._unsaved.add(kind)
+
+    def open(self, fingerprints):
+        """Loads the saved index of each kind in `fingerprints` that was built by the same model"""
+        self.fingerprints = {kind: fp for kind, fp in fingerprints.items() if fp}
+        self.indexes = {}
+        for kind, fingerprint in self.fingerprints.items():
+            try:
+                index = IVFIndex.load(self._path(kind), fingerprint, self.nprobe)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading {kind} similarity index: {e}")
+                index = None
+            if index is not None:
+                self.indexes[kind] = index
+
+    def add(self, kind, ids, vectors):
+        """Inserts the vectors whose ids are not indexed yet"""
+        if kind not in self.fingerprints:
+            return
+        index = self.indexes.get(kind)
+        rows = [j for j, item_id in enumerate(ids)
+                if item_id is not None and (index is None or item_id not in index)]
+        if not rows:
+            return
+        if index is None:
+            index = self.indexes[kind] = IVFIndex(len(vectors[rows[0]]), self.fingerprints[kind], self.nprobe)
+        index.add([ids[j] for j in rows], [vectors[j] for j in rows])
+        self._changed(kind)
+
+    def get(self, kind):
+        return self.indexes.get(kind)
+
+    def remove(self, item_id):
+        """Deletes `item_id` from every kind"""
+        for kind, index in self.indexes.items():
+            if index.remove(item_id):
+                self._changed(kind)
+
+    def retain(self, ids):
+        """Deletes ids that are no longer in `ids` (e.g. complaints deleted while the app was down)"""
+        ids = set(ids)
+        for kind, index in self.indexes.items():
+            if index.retain(ids):
+                self._changed(kind)
+
+    def save(self):
+        """Saves the kinds changed since their last save"""
+        with self._unsaved_lock:
+            kinds, self._unsaved = self._unsaved, set()
+        if not kinds:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for kind in kinds:
+            index = self.indexes.get(kind)
+            if index is None:
+                continue
+            try:
+                index.save(self._path(kind))
+            except OSError as e:
+                print(f"Error saving {kind} similarity index: {e}")
+                self._changed(kind)
+
+    def start_autosave(self, interval=SIMILARITY_SAVE_INTERVAL):
+        """Saves changed kinds every `interval` seconds on a background thread until close()"""
+        if self._autosave is not None or interval <= 0:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                self.save()
+
+        self._autosave = threading.Thread(target=run, name='similarity-index-autosave', daemon=True)
+        self._autosave.start()
+
+    def close(self):
+        """Stops the autosave thread and saves what changed since"""
+        self._stop.set()
+        if self._autosave is not None:
+            self._autosave.join()
+            self._autosave = None
+        self.save()
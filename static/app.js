@@ -116,7 +116,16 @@ const ToolsApp = () => {
 
         const formData = new FormData(event.target);
 
-        fetch('/detect_pothole', { 
+        // Queue the detection, then poll the job until it finishes
+        const pollJob = (statusUrl) => fetch(statusUrl)
+            .then(response => response.json())
+            .then(job => {
+                if (job.status === 'done') return job;
+                if (job.status === 'failed' || job.error) throw new Error(job.error || 'Detection failed');
+                return new Promise(resolve => setTimeout(resolve, 500)).then(() => pollJob(statusUrl));
+            });
+
+        fetch('/detect_pothole/jobs', { 
             method: 'POST', 
             body: formData 
         })
@@ -127,9 +136,10 @@ const ToolsApp = () => {
             }
             return response.json();
         })
+        .then(job => pollJob(job.status_url))
         .then(data => {
             setPotholeResult(data.result);
-            setAnnotatedImageSrc('data:image/jpeg;base64,' + data.annotated_image_b64);
+            setAnnotatedImageSrc(data.annotated_image_url || '');
         })
         .catch(err => setPotholeError(err.message))
         .finally(() => setPotholeLoading(false));
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+dd = pytest.importorskip('duplication_detection_code')
+
+
+@pytest.fixture
+def make_detector(monkeypatch):
+    # Basic image features and the TF-IDF text fallback, so no model weights are needed
+    def unavailable(*args, **kwargs):
+        raise RuntimeError('model unavailable in tests')
+
+    monkeypatch.setattr(dd.models, 'resnet50', unavailable)
+    monkeypatch.setattr(dd, 'SentenceTransformer', unavailable)
+    return lambda: dd.CivicIssueDuplicateDetector(location_threshold=0.1)
+
+
+def make_reports(n=24, seed=0):
+    rng = np.random.default_rng(seed)
+    issue_types = ['pothole', 'garbage', 'streetlight']
+    words = ['deep', 'large', 'broken', 'road', 'near', 'school', 'market', 'dangerous', 'water', 'night']
+    return [{'id': i,
+             'text': ' '.join(rng.choice(words, size=6)),
+             'location': (12.97 + rng.normal(0, 0.0005), 77.59 + rng.normal(0, 0.0005)),
+             'issue_type': issue_types[int(rng.integers(len(issue_types)))]}
+            for i in range(n)]
+
+
+def test_batched_add_trains_the_same_xgboost_model_as_sequential_adds(make_detector):
+    reports = make_reports()
+    sequential = make_detector()
+    for report in reports:
+        sequential.add_report(dict(report))
+    batched = make_detector()
+    batched.add_reports([dict(report) for report in reports])
+
+    assert sequential.xgb_model is not None and batched.xgb_model is not None
+    # Trained once, on the reports up to the one that gave an issue type its 5th report
+    assert batched.scaler.n_samples_seen_ == sequential.scaler.n_samples_seen_
+    np.testing.assert_allclose(batched.scaler.mean_, sequential.scaler.mean_)
+    pairs = np.random.default_rng(1).uniform(0, 1, size=(50, 4))
+    pairs[:, 3] = 1
+    np.testing.assert_allclose(batched.xgb_model.predict_proba(batched.scaler.transform(pairs)),
+                               sequential.xgb_model.predict_proba(sequential.scaler.transform(pairs)))
+
+
+def test_spatial_index_finds_neighbours_across_the_antimeridian():
+    # 360 degrees is not a whole number of 1 km cells
+    index = dd.SpatialIndex(1.0)
+    rng = np.random.default_rng(0)
+    locations = [(rng.uniform(-1, 1), rng.uniform(-10, 10)) for _ in range(300)]  # Keeps the grid path in use
+    locations += [(rng.uniform(-0.01, 0.01), rng.choice([-1, 1]) * rng.uniform(179.97, 180)) for _ in range(200)]
+    locations += [(0.0, 179.99), (0.0, -179.99)]
+    for i, location in enumerate(locations):
+        index.add(i, 'pothole', location)
+
+    coords = np.array(locations)
+    for location in locations[300:]:
+        found, _ = index.query('pothole', location, 3.0)
+        distances = dd.haversine_km(location[0], location[1], coords[:, 0], coords[:, 1])
+        assert found.tolist() == np.flatnonzero(distances <= 3.0).tolist()
+
+    found, _ = index.query('pothole', (0.0, 179.99), 3.0)
+    assert len(locations) - 1 in found.tolist()
@@ -0,0 +1,36 @@
+import datetime
+import importlib
+import sys
+
+import numpy as np
+import pytest
+
+import pothole_serialization
+
+
+@pytest.fixture(params=['orjson', 'stdlib'])
+def serialization(request, monkeypatch):
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setitem(sys.modules, 'orjson', None)  # makes `import orjson` fail
+    yield importlib.reload(pothole_serialization)
+    monkeypatch.undo()
+    importlib.reload(pothole_serialization)
+
+
+def test_non_finite_floats_are_null(serialization):
+    result = {'depth_score': float('nan'), 'scores': [float('inf'), -np.inf, np.float32('nan')],
+              'boxes': np.array([[np.nan, 1.0]]), 'confidence': np.float64(0.5)}
+    assert serialization.dumps(result) == \
+        b'{"depth_score":null,"scores":[null,null,null],"boxes":[[null,1.0]],"confidence":0.5}'
+    assert serialization.loads(serialization.dumps(result, indent=True)) == \
+        {'depth_score': None, 'scores': [None, None, None], 'boxes': [[None, 1.0]], 'confidence': 0.5}
+
+
+def test_encoders_agree(serialization):
+    result = {'source': 'road.jpg', 'image_size': np.array([640, 480]), 'total_potholes': np.int64(2),
+              'detected_at': datetime.datetime(2024, 5, 1, 12, 30), 'clusters': [[0, 1]], 'note': 'café'}
+    assert serialization.dumps(result) == (b'{"source":"road.jpg","image_size":[640,480],"total_potholes":2,'
+                                           b'"detected_at":"2024-05-01T12:30:00","clusters":[[0,1]],'
+                                           b'"note":"caf\xc3\xa9"}')